@@ -29,15 +29,27 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import builtins
 import collections
+import concurrent.futures
 import errno
 import functools
+import gc
+import hashlib
 import inspect
+import json
+import math
 import os
+import posixpath
 import re
+import select
 import serial
+import socket
 import stat
+import struct
 import sys
+import tempfile
+import threading
 import time
 import types
 
@@ -138,6 +150,139 @@ class CPboardRemoteError(CPboardError):
             return sys.exc_info()[2].tb_next
 
 
+def backoff(initial=0.01, maximum=0.5, factor=2):
+    """Generate exponentially growing poll intervals"""
+    interval = initial
+    while True:
+        yield interval
+        interval = min(interval * factor, maximum)
+
+def wait_for(predicate, timeout, what=None):
+    """Poll predicate with backoff until it returns a true value which is returned
+
+    Raises TimeoutError if it doesn't happen within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    for interval in backoff():
+        res = predicate()
+        if res:
+            return res
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(errno.ETIMEDOUT, "timeout waiting for", what)
+        time.sleep(min(interval, remaining))
+
+
+class Tracer:
+    """Record spans in the Chrome trace event format (chrome://tracing, ui.perfetto.dev)
+
+    Example:
+        tracer = cpboard.Tracer()
+        cpboard.set_tracer(tracer)
+        board.exec('print(1)')
+        tracer.save('trace.json')
+    """
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.epoch = time.perf_counter()
+
+    def add(self, name, cat, start, end, args):
+        event = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': (start - self.epoch) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': threading.get_ident(),
+            'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def summary(self):
+        """Return the round trips, bytes each way and the time blocked on the link (seconds)"""
+        res = {'round_trips': 0, 'bytes_written': 0, 'bytes_read': 0, 'blocked': 0.0}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            if event['cat'] != 'repl':
+                continue
+            name = event['name']
+            if name == 'execute':
+                res['round_trips'] += 1
+            elif name == 'write':
+                res['bytes_written'] += event['args'].get('bytes', 0)
+            elif name in ('read', 'read_until'):
+                res['bytes_read'] += event['args'].get('bytes', 0)
+                if name == 'read_until':
+                    res['blocked'] += event['dur'] / 1e6
+        return res
+
+    def save(self, path):
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def set(self, **kwargs):
+        self.args.update(kwargs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is not None:
+            self.args['error'] = exception_type.__name__
+        self.tracer.add(self.name, self.cat, self.start, time.perf_counter(), self.args)
+
+
+class _NullSpan:
+    def set(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        pass
+
+
+_null_span = _NullSpan()
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Trace to tracer (a Tracer), None turns tracing off"""
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def trace(name, cat='board', **args):
+    """Return a context manager recording a span if tracing is on (see Tracer)"""
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _Span(tracer, name, cat, args)
+
+
 # supervisor/messages/default.h:
 MSG_NEWLINE = b"\r\n"
 MSG_SAFE_MODE_CRASH = b"Looks like our core CircuitPython code crashed hard. Whoops!"
@@ -156,6 +301,8 @@ class REPL:
         self.write_chunk_size = 32
         self.safe_mode = False
         self.session = b''
+        # Counts soft reboots and resets, anything that clears the Python state on the board
+        self.reboots = 0
 
     def __enter__(self):
         self.reset()
@@ -169,17 +316,25 @@ class REPL:
         return self.board.serial
 
     def read(self):
-        try:
-            if self.serial.inWaiting():
-                data = self.serial.read(self.serial.inWaiting())
-            else:
-                data = b''
-        except OSError as e:
-            raise CPboardError('read error', session=self.session) from e
-        self.session += data
+        with trace('read', 'repl') as span:
+            try:
+                if self.serial.inWaiting():
+                    data = self.serial.read(self.serial.inWaiting())
+                else:
+                    data = b''
+            except OSError as e:
+                raise CPboardError('read error', session=self.session) from e
+            self.session += data
+            span.set(bytes=len(data))
         return data
 
     def read_until(self, ending, timeout=10, out=None):
+        with trace('read_until', 'repl', ending=repr(ending)) as span:
+            data = self._read_until(ending, timeout, out)
+            span.set(bytes=len(data))
+        return data
+
+    def _read_until(self, ending, timeout, out):
         data = b''
         timeout_count = 0
         while True:
@@ -211,22 +366,23 @@ class REPL:
         if not isinstance(data, bytes):
             data = bytes(data, encoding='utf8')
 
-        for i in range(0, len(data), chunk_size):
-            chunk = data[i:min(i + chunk_size, len(data))]
-            self.session += chunk
-            try:
-                self.serial.write(chunk)
-            except OSError as e:
-                raise CPboardError('write error', session=self.session) from e
-            time.sleep(0.01)
+        with trace('write', 'repl', bytes=len(data)):
+            for i in range(0, len(data), chunk_size):
+                chunk = data[i:min(i + chunk_size, len(data))]
+                self.session += chunk
+                try:
+                    self.serial.write(chunk)
+                except OSError as e:
+                    raise CPboardError('write error', session=self.session) from e
+                time.sleep(0.01)
 
-    def reset(self):
+    def reset(self, timeout=10):
         # Use read() since serial.reset_input_buffer() fails with termios.error now and then
         self.read()
         self.session = b''
         self.write(b'\r' + REPL.CHAR_CTRL_C + REPL.CHAR_CTRL_C) # interrupt any running program
         self.write(b'\r' + REPL.CHAR_CTRL_B) # enter or reset friendly repl
-        data = self.read_until(b'>>> ')
+        data = self.read_until(b'>>> ', timeout=timeout)
 
 
     def result(self, timeout=10, out=None):
@@ -241,6 +397,10 @@ class REPL:
         return output, error
 
     def execute(self, code, timeout=10, async=False, out=None):
+        with trace('execute', 'repl', code_bytes=len(code)):
+            return self._execute(code, timeout, async, out)
+
+    def _execute(self, code, timeout, async, out):
         self.read() # Throw away
 
         self.write(REPL.CHAR_CTRL_A)
@@ -257,18 +417,35 @@ class REPL:
         else:
             return self.result(timeout=timeout, out=out)
 
-    def run(self):
+    def _soft_reboot(self, timeout=10):
+        """Ctrl-D and read up to the code file output, return False if there's no code file
+
+        Raises CPboardError if the board is in safe mode.
+        """
+        self.reset(timeout=timeout)
+
+        self.write(REPL.CHAR_CTRL_D)
+        self.reboots += 1
+        # The wait message comes right away in safe mode and when there's no code file
+        data = self.read_until((b' output:\r\n', MSG_WAIT_BEFORE_REPL), timeout=timeout)
+        self.safe_mode = b'Running in safe mode' in data
         if self.safe_mode:
             raise CPboardError("Can't run in safe mode", session=self.session)
+        return data.endswith(b' output:\r\n')
 
-        self.reset()
+    def soft_reboot(self, timeout=10):
+        """Soft reboot and get back to the prompt without waiting for the code file to finish"""
+        self._soft_reboot(timeout)
+        self.reset(timeout=timeout)
 
-        self.write(REPL.CHAR_CTRL_D)
-        data = self.read_until(b' output:\r\n')
-        if b'Running in safe mode' in data:
-            self.safe_mode = True
+    def run(self):
+        if self.safe_mode:
             raise CPboardError("Can't run in safe mode", session=self.session)
 
+        if not self._soft_reboot():
+            self.read_until(MSG_NEWLINE)
+            return b''
+
         # TODO: MSG_SAFE_MODE_CRASH
         # TODO: BROWNOUT
 
@@ -316,14 +493,14 @@ class Disk:
         mountpoint = self.mountpoint
         self.mountpoint = None
 
-        start_time = time.monotonic()
-        unmounted = False
-        while not unmounted and start_time - time.monotonic() < 30:
+        def unmount():
             try:
                 sh.pumount(mountpoint)
-                unmounted = True
-            except sh.ErrorReturnCode_5:
-                time.sleep(0.1)
+            except sh.ErrorReturnCode_5: # busy
+                return False
+            return True
+
+        wait_for(unmount, 30, mountpoint)
 
     def sync(self):
         disk_device = os.path.basename(self.dev)[:-1]
@@ -373,6 +550,12 @@ class ReplDisk(Disk):
         return self._eval('__import__("os").%s' % do)
 
     def copy(self, src, dst, sync=True, force=False):
+        with trace('copy', 'disk', src=src, dst=dst) as span, self.board.lock:
+            copied = self._copy(src, dst, force)
+            span.set(copied=copied, bytes=os.stat(src).st_size if copied else 0)
+            return copied
+
+    def _copy(self, src, dst, force):
         #print('copy(%r, %r)' % (src, dst))
 
         if not force and self.exists(dst) and os.stat(src).st_size  == self.stat(dst).st_size:
@@ -454,9 +637,12 @@ class Firmware:
     @property
     def info(self):
         with self.disk as disk:
-            fname = os.path.join(disk.path, 'INFO_UF2.TXT')
-            with open(fname, 'r') as f:
-                info = f.read()
+            return self._read_info(disk)
+
+    def _read_info(self, disk):
+        fname = os.path.join(disk.path, 'INFO_UF2.TXT')
+        with open(fname, 'r') as f:
+            info = f.read()
         lines = info.splitlines()
         res = {}
         res['header'] = lines[0]
@@ -466,13 +652,301 @@ class Firmware:
         return res
 
     def upload(self, fw):
+        self.flash(fw)
+
+    def flash(self, fw, board_id=None):
+        """Copy a UF2 file to the bootloader drive and return INFO_UF2.TXT
+
+        The drive is only mounted once. If board_id is given it has to match the Board-ID in INFO_UF2.TXT,
+        if it doesn't the board is sent back to the firmware it was running.
+        """
         with open(fw, 'rb') as f:
             header = f.read(32)
         if header[0:4] != b'UF2\n':
             raise ValueError('Only UF2 files are supported')
         self.board.close()
         with self.disk as disk:
+            info = self._read_info(disk)
+            if board_id and info.get('Board-ID') and info['Board-ID'] != board_id:
+                self._leave_bootloader(disk)
+                raise ValueError('Firmware is for %s, not %s' % (board_id, info['Board-ID']))
             disk.copy(fw, sync=False)
+        return info
+
+    def _leave_bootloader(self, disk):
+        # The bootloader stays until it gets a firmware, give it back the current one
+        current = os.path.join(disk.path, 'CURRENT.UF2')
+        if not os.path.exists(current):
+            return
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fw = os.path.join(tmpdir, 'CURRENT.UF2')
+            shutil.copy(current, fw)
+            disk.copy(fw, sync=False)
+
+
+class UF2File:
+    """Parsed UF2 firmware file
+
+    https://github.com/Microsoft/uf2
+    """
+    MAGIC_START0 = 0x0A324655
+    MAGIC_START1 = 0x9E5D5157
+    MAGIC_END = 0x0AB16F30
+    FLAG_NOT_MAIN_FLASH = 0x00000001
+    FLAG_FAMILY_ID = 0x00002000
+    FLAG_EXTENSION_TAGS = 0x00008000
+    TAG_VERSION = 0x9fc7bc
+    TAG_DEVICE = 0x650d9d
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[0:4] != b'UF2\n':
+            raise ValueError('Only UF2 files are supported')
+
+        self.family_id = None
+        self.tags = {}
+        chunks = {}
+        for offset in range(0, len(data) - 511, 512):
+            block = data[offset:offset + 512]
+            start0, start1, flags, addr, size, blockno, numblocks, family_id = struct.unpack('<8I', block[:32])
+            end, = struct.unpack('<I', block[508:])
+            if start0 != self.MAGIC_START0 or start1 != self.MAGIC_START1 or end != self.MAGIC_END or size > 476:
+                raise ValueError('Bad UF2 block: %d' % (offset // 512,))
+            if flags & self.FLAG_NOT_MAIN_FLASH:
+                continue
+            if flags & self.FLAG_FAMILY_ID:
+                self.family_id = family_id
+            chunks[addr] = block[32:32 + size]
+            if flags & self.FLAG_EXTENSION_TAGS:
+                self._parse_tags(block, (32 + size + 3) & ~3)
+
+        self.payload = b''.join(chunks[addr] for addr in sorted(chunks))
+        self.hash = hashlib.sha1(self.payload).hexdigest()
+
+    def _parse_tags(self, block, pos):
+        while pos + 4 <= 508:
+            size = block[pos]
+            if size < 4:
+                break
+            tag = block[pos + 1] | block[pos + 2] << 8 | block[pos + 3] << 16
+            self.tags[tag] = block[pos + 4:pos + size].decode('utf-8', errors='replace')
+            pos += (size + 3) & ~3
+
+    @property
+    def version(self):
+        return self.tags.get(self.TAG_VERSION)
+
+    @property
+    def board_id(self):
+        return self.tags.get(self.TAG_DEVICE)
+
+    def is_current(self, uname):
+        """Check if the board with this os.uname() is already running this firmware
+
+        The version ('<git tag> on <build date>') and machine ('<board> with <mcu>') strings
+        are compiled into the firmware.
+        """
+        if self.version:
+            return self.version in uname.version
+        return uname.version.encode() in self.payload and uname.machine.encode() in self.payload
+
+
+# Shipped in the plugin package since cpboard is a plain module
+BOARDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pytest_circuitpython', 'boards.json')
+
+
+class UsbDevice:
+    """USB device found in sysfs
+
+    Mimics the usb.core.Device attributes used by CPboard without needing usb permissions.
+    ttys and disks are the /dev/serial/by-path and /dev/disk/by-path entries belonging to the device.
+    """
+    def __init__(self, sysfs, idVendor, idProduct, serial_number=None, product=None):
+        self.sysfs = sysfs
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+        self.serial_number = serial_number
+        self.product = product
+        self.ttys = []
+        self.disks = []
+
+    @property
+    def port_numbers(self):
+        # sysfs name is <bus>-<port>.<port>...
+        ports = os.path.basename(self.sysfs).partition('-')[2]
+        return [int(port) for port in ports.split('.')]
+
+    def __repr__(self):
+        return 'UsbDevice(%04x:%04x, %r)' % (self.idVendor, self.idProduct, os.path.basename(self.sysfs))
+
+
+def _sysfs_read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _sysfs_usb_device(root, path):
+    """Walk up from a sysfs device path to the USB device it belongs to"""
+    top = os.path.realpath(os.path.join(root, 'sys'))
+    path = os.path.realpath(path)
+    while path.startswith(top) and path != top:
+        if os.path.exists(os.path.join(path, 'idVendor')):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def enumerate_usb(root='/'):
+    """Find USB devices with a serial port or a disk
+
+    root is prepended to the /dev and /sys paths so a fake tree can be used for testing.
+    Returns a list of UsbDevice sorted on the sysfs path.
+    """
+    devices = {}
+
+    def add(by_path_dir, sysfs_class, attr):
+        by_path_dir = os.path.join(root, by_path_dir)
+        try:
+            names = sorted(os.listdir(by_path_dir))
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(by_path_dir, name)
+            devname = os.path.basename(os.path.realpath(path))
+            sysfs = _sysfs_usb_device(root, os.path.join(root, 'sys', 'class', sysfs_class, devname))
+            if not sysfs:
+                continue
+            dev = devices.get(sysfs)
+            if dev is None:
+                try:
+                    vid = int(_sysfs_read(os.path.join(sysfs, 'idVendor')), 16)
+                    pid = int(_sysfs_read(os.path.join(sysfs, 'idProduct')), 16)
+                except (TypeError, ValueError):
+                    continue
+                dev = UsbDevice(sysfs, vid, pid, serial_number=_sysfs_read(os.path.join(sysfs, 'serial')),
+                                product=_sysfs_read(os.path.join(sysfs, 'product')))
+                devices[sysfs] = dev
+            getattr(dev, attr).append(path)
+
+    add('dev/serial/by-path', 'tty', 'ttys')
+    add('dev/disk/by-path', 'block', 'disks')
+
+    return [devices[key] for key in sorted(devices)]
+
+
+class BoardRegistry:
+    """Known boards and the attached USB devices
+
+    The boards are loaded from a JSON file mapping build names to USB VID:PID's:
+
+        {
+            "metro_m4_express": {
+                "usb": ["239a:8021"],
+                "bootloader": ["239a:0021"]
+            }
+        }
+
+    The attached devices are enumerated once and cached, call refresh() to look again.
+    """
+    def __init__(self, boards=None, root='/'):
+        self.root = root
+        self.boards = {}
+        self.usb_ids = {}
+        self._devices = None
+        self._lock = threading.Lock()
+        if boards:
+            self.update(boards)
+
+    @classmethod
+    def load(cls, fnames=None, root='/'):
+        """Load the boards from fnames or BOARDS_FILE and the files in $CPBOARD_BOARDS (separated by os.pathsep)"""
+        if fnames is None:
+            fnames = [BOARDS_FILE]
+            fnames.extend(fname for fname in os.environ.get('CPBOARD_BOARDS', '').split(os.pathsep) if fname)
+        registry = cls(root=root)
+        for fname in fnames:
+            with open(fname, 'r') as f:
+                registry.update(json.load(f))
+        return registry
+
+    def update(self, boards):
+        def usb_ids(ids):
+            res = []
+            for id in ids:
+                vendor, _, product = id.partition(':')
+                res.append((int(vendor, 16), int(product, 16)))
+            return res
+
+        for name, board in boards.items():
+            entry = {
+                'usb': usb_ids(board.get('usb', [])),
+                'bootloader': usb_ids(board.get('bootloader', [])),
+            }
+            self.boards[name] = entry
+            for usb_id in entry['usb']:
+                self.usb_ids[usb_id] = (name, False)
+            for usb_id in entry['bootloader']:
+                self.usb_ids[usb_id] = (name, True)
+
+    def refresh(self):
+        with self._lock:
+            self._devices = None
+
+    @property
+    def devices(self):
+        # flash_fleet() refreshes from many threads
+        with self._lock:
+            if self._devices is None:
+                self._devices = enumerate_usb(self.root)
+            return self._devices
+
+    def lookup(self, dev):
+        """Return (build_name, bootloader) for a device, build_name is None if unknown"""
+        return self.usb_ids.get((dev.idVendor, dev.idProduct), (None, False))
+
+    def find(self, **kwargs):
+        """Return attached devices where all the keyword arguments match the UsbDevice attributes"""
+        return [dev for dev in self.devices if all(getattr(dev, k, None) == v for k, v in kwargs.items())]
+
+    def find_build_name(self, name, bootloader=False):
+        try:
+            usb_ids = self.boards[name]['bootloader' if bootloader else 'usb']
+        except KeyError:
+            raise ValueError("Unknown build name: " + name)
+        if not usb_ids:
+            raise ValueError("Unknown %sbuild name: %s" % ('bootloader ' if bootloader else '', name))
+        return [dev for dev in self.devices if (dev.idVendor, dev.idProduct) in usb_ids]
+
+    def as_list(self):
+        res = []
+        for dev in self.devices:
+            build_name, bootloader = self.lookup(dev)
+            res.append({
+                'build_name': build_name,
+                'bootloader': bootloader,
+                'usb': '%04x:%04x' % (dev.idVendor, dev.idProduct),
+                'serial_number': dev.serial_number,
+                'product': dev.product,
+                'port': os.path.basename(dev.sysfs),
+                'ttys': [os.path.realpath(tty) for tty in dev.ttys],
+                'disks': dev.disks,
+            })
+        return res
+
+
+_registry = None
+
+
+def get_registry():
+    global _registry
+    if _registry is None:
+        _registry = BoardRegistry.load(root=os.environ.get('CPBOARD_SYSROOT', '/'))
+    return _registry
 
 
 class ExecFunc:
@@ -555,15 +1029,23 @@ class ExecFunc:
             self.error = error
 
         if self.error:
-            exc = CPboardRemoteError(self.error, session=self.repl.session)
+            self.raise_error()
 
-            if exc.exc and self.raise_remote:
-                exc.exc.__traceback__ = exc.create_traceback(func=self.func)
-                raise exc.exc from exc
-            else:
-                raise exc
+        return self.unpickle_output(self.output)
+
+    def raise_error(self):
+        __tracebackhide__ = True # Hide this from pytest traceback
 
-        output = self.output.decode('utf-8', errors='replace')
+        exc = CPboardRemoteError(self.error, session=self.repl.session)
+
+        if exc.exc and self.raise_remote:
+            exc.exc.__traceback__ = exc.create_traceback(func=self.func)
+            raise exc.exc from exc
+        else:
+            raise exc
+
+    def unpickle_output(self, output):
+        output = output.decode('utf-8', errors='replace')
         #print(output)
         if 'BEGINMARKER>' not in output or '<ENDMARKER' not in output:
             raise CPboardError('output is missing markers', output)
@@ -585,9 +1067,121 @@ class ExecFunc:
         return self.source
 
 
+class ExecGenerator(ExecFunc):
+    """Run a generator function on the board and iterate over the yielded values locally
+
+    Each value is printed between markers as soon as it is yielded. The board then blocks
+    reading stdin until the host asks for the next value, so nothing is buffered on the board.
+    close() tells the board to stop iterating and closes the generator on the board.
+
+    lock (the board lock) is held from exec() until the generator is exhausted or closed, so other threads
+    wait for the stream to finish. The generator has to be iterated and closed by the thread starting it.
+    """
+    CHAR_NEXT = 'n'
+    CHAR_STOP = 'q'
+
+    def __init__(self, *args, lock=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = lock
+        self.locked = False
+        self.started = False
+        self.done = False
+
+    def exec(self, *args, **kwargs):
+        if self.lock is not None:
+            self.lock.acquire()
+            self.locked = True
+        try:
+            super().exec(*args, **kwargs)
+        except BaseException:
+            self.finish()
+            raise
+
+    def finish(self):
+        self.done = True
+        if self.locked:
+            self.locked = False
+            self.lock.release()
+
+    def get_exec_source(self, *args, **kwargs):
+        source = self.source
+        all_args = self.create_args(*args, **kwargs)
+        source += "\n\n"
+        source += "gen = %s(%s)\n" % (self.name, all_args)
+        source += "for res in gen:\n"
+        source += "    print('BEGINMARKER>' + repr(res) + '<ENDMARKER')\n"
+        source += "    if __import__('sys').stdin.read(1) != %r:\n" % (self.CHAR_NEXT,)
+        source += "        break\n"
+        source += "gen.close()\n"
+        self.source = source
+
+        if self.debug:
+            print('------------------------------------------------------------------------')
+            print(source)
+            print('------------------------------------------------------------------------')
+
+    def __call__(self, *args, **kwargs):
+        self.exec(*args, **kwargs)
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        __tracebackhide__ = True # Hide this from pytest traceback
+
+        if self.done:
+            raise StopIteration
+
+        try:
+            if self.started:
+                self.repl.write(self.CHAR_NEXT)
+            self.started = True
+
+            # Only the current value is kept, output can be arbitrarily long
+            self.output = self.repl.read_until((b'<ENDMARKER', b'\x04'), timeout=self.timeout, out=self.out)
+            if self.output.endswith(b'\x04'):
+                self.output = self.output[:-1]
+                self.error = self.repl.read_until(b'\x04', timeout=self.timeout, out=self.out)[:-1]
+                self.finish()
+        except BaseException:
+            self.finish()
+            raise
+        if self.done:
+            if self.error:
+                self.raise_error()
+            raise StopIteration
+
+        return self.unpickle_output(self.output)
+
+    def close(self):
+        __tracebackhide__ = True # Hide this from pytest traceback
+
+        if self.done:
+            return
+
+        # The board reads this after yielding its next value (or already waits for it)
+        try:
+            self.repl.write(self.CHAR_STOP)
+            self.output, self.error = self.repl.result(timeout=self.timeout, out=self.out)
+        finally:
+            self.finish()
+        if self.error:
+            self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
 class CPboard:
     @classmethod
     def from_try_all(cls, name, **kwargs):
+        if name.startswith('sim:'):
+            return cls(simulate(name), **kwargs)
+
         try:
             return CPboard.from_build_name(name, **kwargs)
         except ValueError:
@@ -597,76 +1191,36 @@ class CPboard:
         if vendor and product:
             return CPboard.from_usb(idVendor=int(vendor, 16), idProduct=int(product, 16), **kwargs)
 
+        if get_registry().find(serial_number=name):
+            return CPboard.from_usb(serial_number=name, **kwargs)
+
         return CPboard(name, **kwargs)
 
     @classmethod
     def from_build_name(cls, name, **kwargs):
-        boards = {
-                    #'arduino_zero'
-                    'circuitplayground_express' : (0x239a, 0x8019),
-                    #'feather_m0_adalogger' : (0x239a, ),
-                    #'feather_m0_basic' : (0x239a, ),
-                    'feather_m0_express' : (0x239a, 0x8023),
-                    #'feather_m0_rfm69' : (0x239a, ),
-                    #'feather_m0_rfm9x' : (0x239a, ),
-                    #'feather_m0_supersized' : (0x239a, ),
-                    #'feather_m4_express' : (0x239a, ),
-                    #'gemma_m0' : (0x239a, ),
-                    #'itsybitsy_m0_express' : (0x239a, ),
-                    #'itsybitsy_m4_express' : (0x239a, ),
-                    'metro_m0_express' : (0x239a, 0x8014),
-                    'metro_m4_express' : (0x239a, 0x8021),
-                    #'metro_m4_express_revb' : (0x239a, ),
-                    #'pirkey_m0' : (0x239a, ),
-                    #'trinket_m0' : (0x239a, ),
-                    #'trinket_m0_haxpress' : (0x239a, ),
-                    #'ugame10'
-             }
-
-        try:
-            vendor, product = boards[name]
-        except KeyError:
-            raise ValueError("Unknown build name: " + name)
-
-        return CPboard.from_usb(idVendor=vendor, idProduct=product, **kwargs)
+        devs = get_registry().find_build_name(name)
+        if not devs:
+            raise RuntimeError("Can't find USB device: " + name)
+        return cls(devs[0], **kwargs)
 
     @classmethod
     def from_build_name_bootloader(cls, name, **kwargs):
-        boards = {
-                    #'arduino_zero'
-                    #'circuitplayground_express' : (0x239a, ),
-                    #'feather_m0_adalogger' : (0x239a, ),
-                    #'feather_m0_basic' : (0x239a, ),
-                    'feather_m0_express' : (0x239a, 0x001b),
-                    #'feather_m0_rfm69' : (0x239a, ),
-                    #'feather_m0_rfm9x' : (0x239a, ),
-                    #'feather_m0_supersized' : (0x239a, ),
-                    #'feather_m4_express' : (0x239a, ),
-                    #'gemma_m0' : (0x239a, ),
-                    #'itsybitsy_m0_express' : (0x239a, ),
-                    #'itsybitsy_m4_express' : (0x239a, ),
-                    #'metro_m0_express' : (0x239a, 0x8014),
-                    'metro_m4_express' : (0x239a, 0x0021),
-                    #'metro_m4_express_revb' : (0x239a, ),
-                    #'pirkey_m0' : (0x239a, ),
-                    #'trinket_m0' : (0x239a, ),
-                    #'trinket_m0_haxpress' : (0x239a, ),
-                    #'ugame10'
-             }
-
-        try:
-            vendor, product = boards[name]
-        except KeyError:
-            raise ValueError("Unknown build name: " + name)
-
-        board = CPboard.from_usb(idVendor=vendor, idProduct=product, **kwargs)
+        devs = get_registry().find_build_name(name, bootloader=True)
+        if not devs:
+            raise RuntimeError("Can't find USB device: " + name + " (bootloader)")
+        board = cls(devs[0], **kwargs)
         board.bootloader = True
         return board
 
     @classmethod
     def from_usb(cls, baudrate=115200, wait=0, timeout=10, **kwargs):
-        import usb.core
-        dev = usb.core.find(**kwargs)
+        if set(kwargs) <= {'idVendor', 'idProduct', 'serial_number', 'product'}:
+            devs = get_registry().find(**kwargs)
+            dev = devs[0] if devs else None
+        else:
+            # Match on something only pyusb knows about
+            import usb.core
+            dev = usb.core.find(**kwargs)
         if not dev:
             s = "Can't find USB device: "
             args = []
@@ -681,17 +1235,23 @@ class CPboard:
     def __init__(self, device, baudrate=115200, wait=0, timeout=10):
         self.device = device
         self.usb_dev = None
-        try:
-            # Is it a usb.core.Device?
-            portstr = ':' + '.'.join(map(str, device.port_numbers)) + ':'
-        except:
-            pass
-        else:
-            serials = [serial for serial in os.listdir("/dev/serial/by-path") if portstr in serial]
-            if len(serials) != 1:
+        if isinstance(device, UsbDevice):
+            if len(device.ttys) != 1:
                 raise OSError(errno.ENOENT, "Can't find excatly one matching usb serial device")
-            self.device = os.path.realpath("/dev/serial/by-path/" + serials[0])
+            self.device = os.path.realpath(device.ttys[0])
             self.usb_dev = device
+        else:
+            try:
+                # Is it a usb.core.Device?
+                portstr = ':' + '.'.join(map(str, device.port_numbers)) + ':'
+            except:
+                pass
+            else:
+                serials = [serial for serial in os.listdir("/dev/serial/by-path") if portstr in serial]
+                if len(serials) != 1:
+                    raise OSError(errno.ENOENT, "Can't find excatly one matching usb serial device")
+                self.device = os.path.realpath("/dev/serial/by-path/" + serials[0])
+                self.usb_dev = device
 
         self.baudrate = baudrate
         self.wait = wait
@@ -700,6 +1260,10 @@ class CPboard:
         self.serial = None
         self.bootloader = False
         self.repl = REPL(self)
+        # Serializes access to the REPL, an exec is several writes and reads that can't be interleaved
+        self.lock = threading.RLock()
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     def __enter__(self):
         self.open()
@@ -709,6 +1273,10 @@ class CPboard:
         self.close()
 
     def open(self, baudrate=None, wait=None):
+        with self.lock:
+            self._open(baudrate, wait)
+
+    def _open(self, baudrate, wait):
         if self.serial:
             return
         if baudrate is None:
@@ -716,36 +1284,100 @@ class CPboard:
         if wait is None:
             wait = self.wait
 
-        delayed = False
-        for attempt in range(wait + 1):
+        def try_open():
             try:
                 self.serial = serial.Serial(self.device, baudrate=self.baudrate, timeout=self.timeout, write_timeout=self.timeout, interCharTimeout=1)
-                break
             except OSError:
-                if wait == 0:
-                    continue
-                if attempt == 0:
-                    sys.stdout.write('Waiting {} seconds for board '.format(wait))
-                    delayed = True
-            time.sleep(1)
-            sys.stdout.write('.')
+                # The tty might have changed if the board has re-enumerated
+                self._refresh_device()
+                return False
+            return True
+
+        if try_open():
+            return
+        if wait:
+            sys.stdout.write('Waiting up to {} seconds for board...'.format(wait))
             sys.stdout.flush()
-        else:
-            if delayed:
+            try:
+                wait_for(try_open, wait, self.device)
+                return
+            except TimeoutError:
+                pass
+            finally:
                 print('')
-            raise CPboardError('failed to access ' + self.device)
-        if delayed:
-            print('')
+        raise CPboardError('failed to access ' + self.device)
+
+    def _refresh_device(self):
+        if not isinstance(self.usb_dev, UsbDevice):
+            return
+        registry = get_registry()
+        registry.refresh()
+        devs = registry.find(sysfs=self.usb_dev.sysfs)
+        if devs and len(devs[0].ttys) == 1:
+            self.usb_dev = devs[0]
+            self.device = os.path.realpath(devs[0].ttys[0])
+
+    def wait_ready(self, timeout=30):
+        """Wait for the board to show up and give a REPL prompt, return how long it took"""
+        start = time.monotonic()
+        deadline = start + timeout
+
+        def ready():
+            try:
+                if not self.serial:
+                    self.open()
+                self.repl.reset(timeout=min(1, max(deadline - time.monotonic(), 0.1)))
+            except TimeoutError:
+                return False
+            except (CPboardError, OSError):
+                self._close_serial()
+                return False
+            return True
+
+        with self.lock:
+            wait_for(ready, timeout, self.device)
+        return time.monotonic() - start
+
+    def wait_gone(self, timeout=5):
+        """Wait for the serial device to disappear, returns False if it didn't"""
+        try:
+            wait_for(lambda: not os.path.exists(self.device), timeout, self.device)
+        except TimeoutError:
+            return False
+        return True
+
+    def wait_bootloader(self, timeout=30):
+        """Wait for the bootloader drive to show up after reset_to_bootloader()"""
+        def bootloader_disk():
+            try:
+                return len(self.get_disks()) == 1
+            except (OSError, RuntimeError):
+                return False
+
+        self.wait_gone(min(timeout, 5))
+        wait_for(bootloader_disk, timeout, 'bootloader disk')
 
     def close(self):
-        if self.serial:
-            self.serial.close()
-            self.serial = None
+        """Close the serial port and stop the submit() worker once the queued calls are done"""
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Not waiting, close() might be one of the queued calls
+            executor.shutdown(wait=False)
+        with self.lock:
+            self._close_serial()
+
+    def _close_serial(self):
+        with self.lock:
+            if self.serial:
+                self.serial.close()
+                self.serial = None
 
     def exec(self, command, timeout=10, async=False, out=None, reset_repl=True, raise_remote=True):
-        if reset_repl:
-            self.repl.reset()
-        output, error = self.repl.execute(command, timeout=timeout, async=async, out=out)
+        with trace('exec', reset_repl=reset_repl), self.lock:
+            if reset_repl:
+                self.repl.reset()
+            output, error = self.repl.execute(command, timeout=timeout, async=async, out=out)
         if error:
             exc = CPboardRemoteError(error, session=self.repl.session)
             if exc.exc and raise_remote:
@@ -756,7 +1388,8 @@ class CPboard:
 
     def eval(self, expression, timeout=10, async=False, out=None, reset_repl=True, raise_remote=True, strict=True):
         command = 'print({}, end="")'.format(expression)
-        output = self.exec(command, timeout=timeout, async=async, out=out, reset_repl=reset_repl, raise_remote=raise_remote)
+        with trace('eval', expression=expression[:100]):
+            output = self.exec(command, timeout=timeout, async=async, out=out, reset_repl=reset_repl, raise_remote=raise_remote)
 
         try:
             res = eval(str(output, encoding='utf8'))
@@ -767,6 +1400,26 @@ class CPboard:
             res = unpickle(output)
         return res
 
+    def submit(self, fn, *args, **kwargs):
+        """Queue a call that needs exclusive access to the board
+
+        The calls are run one at a time in the order they were submitted on a worker thread
+        belonging to this board, holding the board lock.
+        Returns a concurrent.futures.Future.
+
+        Example:
+            future = board.submit(board.eval, '1 + 1')
+            2 == future.result()
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self._executor.submit(self._locked_call, fn, *args, **kwargs)
+
+    def _locked_call(self, fn, *args, **kwargs):
+        with self.lock:
+            return fn(*args, **kwargs)
+
     def _reset(self, mode='NORMAL'):
         self.exec("import microcontroller;microcontroller.on_next_reset(microcontroller.RunMode.%s)" % mode)
         try:
@@ -774,19 +1427,74 @@ class CPboard:
         except CPboardError:
             pass
 
-    def reset(self, safe_mode=False, delay=5, wait=10):
-        self._reset('SAFE_MODE' if safe_mode else 'NORMAL')
-        self.close()
-        time.sleep(delay)
-        self.open(wait)
-        time.sleep(delay)
+    def reset(self, safe_mode=False, timeout=30):
+        """Reset the board and wait until the REPL is usable again, return how long it took"""
+        start = time.monotonic()
+        with self.lock:
+            self._reset('SAFE_MODE' if safe_mode else 'NORMAL')
+            self.repl.reboots += 1
+            self.repl.safe_mode = safe_mode
+            self._close_serial()
+            # Don't reopen the tty before the board has dropped off USB
+            self.wait_gone(min(timeout, 5))
+            self.wait_ready(max(timeout - (time.monotonic() - start), 1))
+        return time.monotonic() - start
+
+    def responsive(self, timeout=2):
+        """Return True if the REPL gives a prompt and runs code"""
+        try:
+            self.repl.reset(timeout=timeout)
+            self.exec('pass', reset_repl=False, timeout=timeout)
+        except (CPboardError, OSError):
+            return False
+        return True
+
+    def recover(self, timeout=30):
+        """Get a usable REPL back after a hang or a lost connection, return the steps taken
+
+        The steps are tried until the board answers: interrupting the running code, reopening the port
+        followed by a soft reboot, and a hard reset if the soft reboot shows that the board is in safe mode.
+        Only the interrupt keeps the Python state, the others count as reboots (REPL.reboots).
+        Raises CPboardError if the board doesn't come back within timeout seconds.
+        """
+        start = time.monotonic()
+
+        def remaining():
+            return max(timeout - (time.monotonic() - start), 1)
+
+        with self.lock:
+            steps = ['interrupt']
+            if self.serial and self.responsive():
+                return steps
+
+            steps.append('reopen')
+            # What happened to the state is unknown, so a reboot it is
+            self.repl.reboots += 1
+            self._close_serial()
+            try:
+                self.wait_ready(remaining())
+            except TimeoutError as e:
+                raise CPboardError('board not responding after %s' % ', '.join(steps)) from e
+
+            steps.append('soft reboot')
+            try:
+                self.repl.soft_reboot(timeout=min(remaining(), 10))
+            except CPboardError:
+                if not self.repl.safe_mode:
+                    raise
+                steps.append('hard reset')
+                self.reset(timeout=remaining())
+                self.repl.soft_reboot(timeout=min(remaining(), 10))
+            except TimeoutError as e:
+                raise CPboardError('board not responding after %s' % ', '.join(steps)) from e
+        return steps
 
     def reset_to_bootloader(self, repl=False):
         if repl:
             self._reset('BOOTLOADER')
-            self.close()
+            self._close_serial()
         else:
-            self.close()
+            self._close_serial()
             s = serial.Serial(self.device, 1200, write_timeout=4, timeout=4)
             s.close()
 
@@ -808,6 +1516,12 @@ class CPboard:
         return p.serial_number if p else None
 
     def get_disks(self):
+        if isinstance(self.usb_dev, UsbDevice):
+            # The disks change when switching between bootloader and CircuitPython
+            registry = get_registry()
+            registry.refresh()
+            devs = registry.find(sysfs=self.usb_dev.sysfs)
+            return devs[0].disks if devs else []
         if self.usb_dev:
             portstr = ':' + '.'.join(map(str, self.usb_dev.port_numbers)) + ':'
             return ["/dev/disk/by-path/" + disk for disk in os.listdir("/dev/disk/by-path") if portstr in disk]
@@ -937,6 +1651,27 @@ def remote(func):
         board.open()
         8 == roundtrip_number(board, 5, add=3)
 
+    Generator functions return a lazy iterator. Each value is sent as soon as it is yielded,
+    and the board waits for the next value to be requested before it continues.
+    Call close() on the iterator (or use it as a context manager) to stop the board early.
+
+        @cpboard.remote
+        def capture(n):
+            for i in range(n):
+                yield i * i
+
+        with capture(board, 1000) as values:
+            for value in values:
+                if value > 100:
+                    break
+
+    The call can be queued on the board with submit() which returns a concurrent.futures.Future:
+
+        future = roundtrip_number.submit(board, 5, add=3)
+        8 == future.result()
+
+    A submitted generator function runs to the end on the worker thread, the result is the list of values.
+
     Special keyword arguments that are not passed on to the wrapped function:
     _timeout: Passed on to REPL.execute, how long it should wait in seconds.
     _out: Catch output from REPL.execute. Example: _out=sys.stdout
@@ -951,15 +1686,32 @@ def remote(func):
             out = kwargs.pop('_out', None)
             reset_repl = kwargs.pop('_reset_repl', True)
 
-            f = ExecFunc(board.repl, func, timeout=timeout, out=out, reset_repl=reset_repl,
-                         raise_remote=False, decorator_strip=r'@cpboard\.remote:')
-            return f(*args, **kwargs)
+            if inspect.isgeneratorfunction(func):
+                # The REPL stays locked until the generator is done or closed
+                # Values are produced after this wrapper has returned, so let the iterator raise locally
+                f = ExecGenerator(board.repl, func, timeout=timeout, out=out, reset_repl=reset_repl,
+                                  raise_remote=True, decorator_strip=r'@cpboard\.remote:', lock=board.lock)
+            else:
+                f = ExecFunc(board.repl, func, timeout=timeout, out=out, reset_repl=reset_repl,
+                             raise_remote=False, decorator_strip=r'@cpboard\.remote:')
+            with board.lock:
+                return f(*args, **kwargs)
         except CPboardRemoteError as e:
             if e.exc:
                 e.exc.__traceback__ = e.create_traceback(func=func)
                 raise e.exc from None
             raise
 
+    def submit(board, *args, **kwargs):
+        if inspect.isgeneratorfunction(func):
+            # The board lock is held by the thread starting the generator until it is done
+            def run():
+                with remote_func_wrapper(board, *args, **kwargs) as values:
+                    return list(values)
+            return board.submit(run)
+        return board.submit(remote_func_wrapper, board, *args, **kwargs)
+
+    remote_func_wrapper.submit = submit
     return remote_func_wrapper
 
 
@@ -1013,6 +1765,860 @@ class Server:
             pass
 
 
+DAEMON_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), 'cpboard.sock')
+
+
+def _send_json(sock, obj):
+    sock.sendall(json.dumps(obj).encode('utf-8') + b'\n')
+
+def _recv_json(sock, buf=b''):
+    while b'\n' not in buf:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError('connection closed')
+        buf += data
+    line, _, buf = buf.partition(b'\n')
+    return json.loads(line.decode('utf-8')), buf
+
+
+class SocketSerial:
+    """Just enough of serial.Serial for REPL to run on top of a BoardDaemon connection"""
+    def __init__(self, sock, buf=b''):
+        self.sock = sock
+        self.buf = buf
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _recv(self, timeout):
+        r, _, _ = select.select([self.sock], [], [], timeout)
+        if not r:
+            return False
+        data = self.sock.recv(4096)
+        if not data:
+            raise OSError(errno.EPIPE, 'board daemon closed the connection')
+        self.buf += data
+        return True
+
+    def inWaiting(self):
+        while self._recv(0):
+            pass
+        return len(self.buf)
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def read(self, size=1):
+        while len(self.buf) < size:
+            self._recv(None)
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class _ServedBoard:
+    def __init__(self, name):
+        self.name = name
+        self.board = CPboard.from_try_all(name)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.modules = {}
+
+    def forget(self):
+        self.files.clear()
+        self.modules.clear()
+
+    def open(self, timeout=10):
+        if not self.board.serial:
+            self.board.open(wait=timeout)
+        return self.board.serial
+
+
+class BoardDaemon:
+    """Keep boards open and share them between processes through a Unix socket
+
+    It also keeps state about the board in memory: the files uploaded and the modules imported.
+    The state is cleared if the board soft reboots or the serial port has to be reopened.
+
+    Each connection starts with a JSON request line which is answered with a JSON line:
+        {"op": "open", "board": name}   Answer: {"device": path}. The connection then becomes
+                                        a pipe to the board serial port until it's closed.
+                                        Only one connection at a time can open a board,
+                                        the others are answered with an error if it
+                                        stays busy.
+        {"op": "state", "board": name}  Answer: {"files": {path: hash}, "modules": {name: hash}}
+        {"op": "update", "board": name, "files": {...}, "modules": {...}, "clear": false}
+                                        Merge into the state, null values are removed.
+        {"op": "list"}                  Answer: {"boards": {name: device}}
+        {"op": "shutdown"}
+    Errors are answered with {"error": message}.
+
+    open_timeout: Seconds to wait for the serial device of a board to show up
+    busy_timeout: Seconds an open waits for the connection using the board to be closed
+    """
+    def __init__(self, path=None, out=None, open_timeout=10, busy_timeout=2):
+        self.path = path or DAEMON_SOCKET
+        self.out = out
+        self.open_timeout = open_timeout
+        self.busy_timeout = busy_timeout
+        self.boards = {}
+        self.lock = threading.Lock()
+        self.sock = None
+        self.running = False
+
+    def log(self, *args):
+        if self.out:
+            print(*args, file=self.out, flush=True)
+
+    def board(self, name):
+        with self.lock:
+            if name not in self.boards:
+                self.boards[name] = _ServedBoard(name)
+            return self.boards[name]
+
+    def start(self):
+        if os.path.exists(self.path):
+            try:
+                DaemonClient(self.path).request(op='list')
+            except OSError:
+                os.unlink(self.path)  # stale
+            else:
+                raise CPboardError('daemon is already running: ' + self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(5)
+        self.sock.settimeout(0.2)
+        self.running = True
+        self.log('Listening on', self.path)
+
+    def serve_forever(self):
+        if not self.sock:
+            self.start()
+        try:
+            while self.running:
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            for served in self.boards.values():
+                served.board.close()
+
+    def shutdown(self):
+        self.running = False
+
+    def handle(self, conn):
+        try:
+            req, buf = _recv_json(conn)
+            op = req.get('op')
+            if op == 'open':
+                self.pipe(conn, self.board(req['board']), buf)
+                return
+            elif op == 'state':
+                served = self.board(req['board'])
+                res = {'files': served.files, 'modules': served.modules}
+            elif op == 'update':
+                served = self.board(req['board'])
+                if req.get('clear'):
+                    served.forget()
+                for attr in ('files', 'modules'):
+                    state = getattr(served, attr)
+                    for k, v in req.get(attr, {}).items():
+                        if v is None:
+                            state.pop(k, None)
+                        else:
+                            state[k] = v
+                res = {}
+            elif op == 'list':
+                res = {'boards': {name: served.board.device for name, served in self.boards.items()}}
+            elif op == 'shutdown':
+                self.shutdown()
+                res = {}
+            else:
+                res = {'error': 'unknown op: %r' % (op,)}
+            _send_json(conn, res)
+        except (OSError, ValueError, KeyError, RuntimeError, CPboardError) as e:
+            self.log('Error:', repr(e))
+            try:
+                _send_json(conn, {'error': str(e)})
+            except OSError:
+                pass
+        finally:
+            conn.close()
+
+    def pipe(self, conn, served, buf):
+        # The previous connection might have just closed, give its pipe a moment to notice
+        if not served.lock.acquire(timeout=self.busy_timeout):
+            _send_json(conn, {'error': 'board is busy: %s' % (served.name,)})
+            return
+        try:
+            self._pipe(conn, served, buf)
+        finally:
+            served.lock.release()
+
+    def _pipe(self, conn, served, buf):
+        ser = served.open(self.open_timeout)
+        self.log('Open', served.name, served.board.device)
+        _send_json(conn, {'device': served.board.device})
+        if buf:
+            ser.write(buf)
+        tail = b''
+        while True:
+            r, _, _ = select.select([conn, ser], [], [])
+            if conn in r:
+                data = conn.recv(4096)
+                if not data:
+                    break
+            try:
+                if conn in r:
+                    ser.write(data)
+                if ser in r:
+                    data = ser.read(ser.in_waiting or 1)
+            except (OSError, serial.SerialException):
+                self.log('Lost', served.name)
+                served.board.close()
+                served.forget()
+                break
+            if ser in r:
+                # The modules are gone after a soft reboot, the files are still there
+                if b'soft reboot' in tail + data:
+                    served.modules.clear()
+                tail = data[-16:]
+                conn.sendall(data)
+        self.log('Close', served.name)
+
+
+class DaemonClient:
+    def __init__(self, path=None):
+        self.path = path or DAEMON_SOCKET
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, **kwargs):
+        sock = self.connect()
+        try:
+            _send_json(sock, kwargs)
+            res, _ = _recv_json(sock)
+        finally:
+            sock.close()
+        if 'error' in res:
+            raise CPboardError('daemon: ' + res['error'])
+        return res
+
+    def state(self, board):
+        return self.request(op='state', board=board)
+
+    def update(self, board, files=None, modules=None, clear=False):
+        return self.request(op='update', board=board, files=files or {}, modules=modules or {}, clear=clear)
+
+    def open_serial(self, board):
+        sock = self.connect()
+        _send_json(sock, {'op': 'open', 'board': board})
+        res, buf = _recv_json(sock)
+        if 'error' in res:
+            sock.close()
+            raise CPboardError('daemon: ' + res['error'])
+        return SocketSerial(sock, buf), res['device']
+
+
+class DaemonBoard(CPboard):
+    """CPboard that reaches the board through a BoardDaemon (cpboard serve)
+
+    The daemon keeps the serial port open between processes, and state about the board
+    can be kept there using the client attribute.
+    """
+    def __init__(self, name, path=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.name = name
+        self.client = DaemonClient(path)
+
+    def _open(self, baudrate, wait):
+        if self.serial:
+            return
+        try:
+            self.serial, self.device = self.client.open_serial(self.name)
+        except OSError as e:
+            raise CPboardError('failed to access board daemon: %s' % (self.client.path,)) from e
+
+
+# Simulated board
+
+SIM_BANNER = b'Adafruit CircuitPython 3.0.0 on 2018-07-09; Simulated Board with CPython'
+SIM_SAFE_MODE = b'You are running in safe mode which means something unanticipated happened.'
+
+# CPython modules the simulated board can import, the rest has to be on its filesystem.
+# io is shimmed like os so the files stay inside the board root.
+SIM_STDLIB = ('array', 'binascii', 'collections', 'errno', 'hashlib', 'json', 'math', 'random', 're',
+              'struct', 'time')
+
+# The board module pins, like a Feather M0 Express
+SIM_PINS = tuple('D%d' % i for i in range(14)) + tuple('A%d' % i for i in range(6)) + (
+    'LED', 'NEOPIXEL', 'SCL', 'SDA', 'SCK', 'MOSI', 'MISO', 'TX', 'RX')
+
+
+class SimReset(BaseException):
+    """microcontroller.reset() on the simulated board"""
+
+
+class _SimPin:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'board.' + self.name
+
+
+class _SimUname(collections.namedtuple('uname_result', 'sysname nodename release version machine')):
+    def __repr__(self):
+        return '(%s)' % ', '.join('%s=%r' % item for item in zip(self._fields, self))
+
+
+class _SimStdout:
+    def __init__(self, board):
+        self.board = board
+        self.buf = b''
+
+    def write(self, s):
+        data = s.encode('utf-8') if isinstance(s, str) else bytes(s)
+        self.buf += data.replace(b'\n', b'\r\n')
+        # Sent right away like USB CDC does, output without a newline shows up before a hang
+        self.flush()
+        return len(s)
+
+    def flush(self):
+        if self.buf:
+            self.board.send(self.buf)
+            self.buf = b''
+
+
+class _SimStdin:
+    def __init__(self, board, out):
+        self.board = board
+        self.out = out
+
+    def read(self, size=1):
+        self.out.flush()
+        return ''.join(self.board.getc().decode('latin-1') for _ in range(size))
+
+    def readline(self):
+        line = ''
+        while not line.endswith('\n'):
+            c = self.read(1)
+            line += '\n' if c == '\r' else c
+        return line
+
+
+class SimulatedBoard:
+    """CircuitPython board simulator behind a pseudo-terminal (cpboard sim, --board sim:)
+
+    It has the friendly REPL, the raw REPL with raw-paste mode, Ctrl-C, Ctrl-D and soft reboot.
+    The code runs in this process with its own namespace and modules, os, sys, gc and microcontroller
+    behave like on CircuitPython and the filesystem is the root directory.
+    link is a symlink to the pty, it goes away during microcontroller.reset() like the tty of a real board.
+
+    latency: Seconds added to each transfer in both directions
+    bandwidth: Bytes per second in both directions, None for no limit
+    heap_size: The gc.mem_free() + gc.mem_alloc() total, the allocation is estimated from the allocated
+               memory blocks of this process
+    pins: The names of the board module pins
+    """
+    RAW_PASTE_WINDOW = 128
+
+    def __init__(self, link, root, latency=0.0, bandwidth=None, heap_size=1024 * 1024, reset_delay=0.5,
+                 pins=SIM_PINS):
+        self.link = link
+        self.root = os.path.realpath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.heap_size = heap_size
+        self.pins = tuple(pins)
+        self.reset_delay = reset_delay
+        self.master = None
+        self.safe_mode = False
+        self.next_mode = 'NORMAL'
+        self.executing = False
+        self.interrupted = False
+        self.filenames = set()
+        self.builtins = dict(vars(builtins))
+        self.builtins.update(__import__=self.import_, open=self.open_file)
+        self.reset_state()
+
+    def open(self):
+        import pty
+        import queue
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.input = queue.Queue()
+        self.wakeup = os.pipe()
+        self.reader = threading.Thread(target=self.read_loop, args=(self.master, self.wakeup[0], self.input))
+        self.reader.daemon = True
+        self.reader.start()
+        tmp = '%s.%d' % (self.link, os.getpid())
+        os.symlink(os.ttyname(self.slave), tmp)
+        os.replace(tmp, self.link)
+
+    def close(self):
+        if self.master is None:
+            return
+        try:
+            os.unlink(self.link)
+        except FileNotFoundError:
+            pass
+        os.write(self.wakeup[1], b'x')
+        self.reader.join()
+        for fd in (self.master, self.slave) + self.wakeup:
+            os.close(fd)
+        self.master = None
+
+    def throttle(self, size):
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay:
+            time.sleep(delay)
+
+    def read_loop(self, master, wakeup, queue):
+        import signal
+        while True:
+            r, _, _ = select.select([master, wakeup], [], [])
+            if wakeup in r:
+                return
+            try:
+                data = os.read(master, 1024)
+            except OSError:
+                return
+            self.throttle(len(data))
+            for c in data:
+                if c == 3 and self.executing:
+                    self.interrupted = True
+                    os.kill(os.getpid(), signal.SIGINT)
+                else:
+                    queue.put(c)
+
+    def send(self, data):
+        self.throttle(len(data))
+        while data:
+            try:
+                data = data[os.write(self.master, data):]
+            except OSError:
+                return
+
+    def getc(self):
+        return bytes([self.input.get()])
+
+    # Filesystem rooted in self.root
+
+    def host_path(self, path):
+        if not isinstance(path, str):
+            raise TypeError("can't convert %s to str" % (type(path).__name__,))
+        path = posixpath.normpath(posixpath.join(self.cwd, path))
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def fs_call(self, func, *paths):
+        try:
+            return func(*[self.host_path(path) for path in paths])
+        except OSError as e:
+            # Don't show the host path
+            raise OSError(e.errno, os.strerror(e.errno)) from None
+
+    def open_file(self, file, mode='r', *args, **kwargs):
+        return self.fs_call(lambda path: open(path, mode, *args, **kwargs), file)
+
+    def chdir(self, path):
+        if not self.fs_call(os.path.isdir, path):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+        self.cwd = posixpath.normpath(posixpath.join(self.cwd, path))
+
+    # Modules
+
+    def make_module(self, name, **attrs):
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        return module
+
+    def builtin_module(self, name):
+        board = self
+        if name == 'os':
+            return self.make_module(
+                'os', sep='/',
+                listdir=lambda path='.': self.fs_call(os.listdir, path),
+                stat=lambda path: tuple(self.fs_call(os.stat, path))[:10],
+                mkdir=lambda path: self.fs_call(os.mkdir, path),
+                rmdir=lambda path: self.fs_call(os.rmdir, path),
+                remove=lambda path: self.fs_call(os.remove, path),
+                rename=lambda old, new: self.fs_call(os.rename, old, new),
+                chdir=self.chdir, getcwd=lambda: self.cwd, sync=lambda: None, urandom=os.urandom,
+                uname=lambda: _SimUname('sim', 'sim', '3.0.0', '3.0.0 on 2018-07-09', 'Simulated Board with CPython'))
+        if name == 'sys':
+            return self.make_module(
+                'sys', modules=self.modules, path=['', '/', '/lib'], argv=[], platform='sim',
+                implementation=sys.implementation, version='3.4.0', version_info=(3, 4, 0), byteorder=sys.byteorder,
+                maxsize=sys.maxsize, exit=sys.exit, stdout=sys.stdout, stdin=sys.stdin, stderr=sys.stdout,
+                print_exception=lambda e, file=None: (file or sys.stdout).write(self.format_exception(e).decode()))
+        if name == 'gc':
+            def mem_alloc():
+                return min(max(sys.getallocatedblocks() - board.heap_blocks, 0) * 16, board.heap_size)
+            return self.make_module('gc', collect=gc.collect, enable=gc.enable, disable=gc.disable,
+                                    isenabled=gc.isenabled, mem_alloc=mem_alloc,
+                                    mem_free=lambda: board.heap_size - mem_alloc())
+        if name == 'microcontroller':
+            def on_next_reset(run_mode):
+                board.next_mode = run_mode
+
+            def reset():
+                raise SimReset()
+
+            run_mode = self.make_module('RunMode', NORMAL='NORMAL', SAFE_MODE='SAFE_MODE', BOOTLOADER='BOOTLOADER')
+            cpu = self.make_module('Processor', frequency=48000000, temperature=25.0, voltage=3.3, uid=bytearray(16))
+            return self.make_module('microcontroller', RunMode=run_mode, cpu=cpu, on_next_reset=on_next_reset,
+                                    reset=reset)
+        if name == 'micropython':
+            return self.make_module('micropython', const=lambda value: value)
+        if name == 'board':
+            return self.make_module('board', **{pin: _SimPin(pin) for pin in self.pins})
+        if name == 'io':
+            import io
+            return self.make_module('io', BytesIO=io.BytesIO, StringIO=io.StringIO, open=self.open_file)
+        if name == 'rtc':
+            rtc = self.make_module('RTC', datetime=time.localtime())
+            return self.make_module('rtc', RTC=lambda: rtc, set_time_source=lambda source: None)
+        if name.split('.')[0] in SIM_STDLIB:
+            import importlib
+            return importlib.import_module(name)
+        return None
+
+    def find_module(self, name, path):
+        basename = name.rpartition('.')[2]
+        for directory in path:
+            base = posixpath.join(directory, basename)
+            for filename, package in ((posixpath.join(base, '__init__.py'), True), (base + '.py', False)):
+                if self.fs_call(os.path.isfile, filename):
+                    return filename, package
+        return None, False
+
+    def load_module(self, name, parent):
+        module = self.builtin_module(name)
+        if module is not None:
+            self.modules[name] = module
+            return module
+
+        path = parent.__path__ if parent is not None else self.modules['sys'].path
+        filename, package = self.find_module(name, path)
+        if filename is None:
+            raise ImportError("no module named '%s'" % (name,))
+        with self.open_file(filename) as f:
+            source = f.read()
+        module = self.make_module(name, __file__=filename, __builtins__=self.builtins)
+        if package:
+            module.__path__ = [posixpath.dirname(filename)]
+        self.modules[name] = module
+        self.filenames.add(filename)
+        try:
+            exec(compile(source, filename, 'exec', dont_inherit=True), module.__dict__)
+        except BaseException:
+            self.modules.pop(name, None)
+            raise
+        if parent is not None:
+            setattr(parent, name.rpartition('.')[2], module)
+        return module
+
+    def import_(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level:
+            raise ImportError('relative import not supported')
+        parts = name.split('.')
+        module = None
+        for i in range(len(parts)):
+            fullname = '.'.join(parts[:i + 1])
+            module = self.modules.get(fullname) or self.load_module(fullname, module)
+        if not fromlist:
+            return self.modules[parts[0]]
+        if hasattr(module, '__path__'):
+            for item in fromlist:
+                if not hasattr(module, item):
+                    try:
+                        self.load_module('%s.%s' % (name, item), module)
+                    except ImportError:
+                        pass
+        return module
+
+    # Running code
+
+    def reset_state(self):
+        self.cwd = '/'
+        self.modules = {}
+        self.modules['sys'] = self.builtin_module('sys')
+        self.globals = {'__name__': '__main__', '__builtins__': self.builtins}
+        gc.collect()
+        self.heap_blocks = sys.getallocatedblocks()
+
+    def format_exception(self, e):
+        import traceback
+        lines = ['Traceback (most recent call last):']
+        for filename, lineno, name, _ in traceback.extract_tb(e.__traceback__):
+            if filename in self.filenames:
+                lines.append('  File "%s", line %d, in %s' % (filename, lineno, name))
+        if isinstance(e, SyntaxError):
+            lines.append('  File "%s", line %s' % (e.filename, e.lineno))
+            message = e.msg
+        else:
+            message = str(e)
+        # MicroPython adds the colon also without a message
+        lines.append('%s: %s' % (type(e).__name__, message))
+        return '\r\n'.join(lines).encode('utf-8') + b'\r\n'
+
+    def execute(self, source, filename='<stdin>', mode='exec'):
+        """Run source streaming the output, return the traceback if it raised"""
+        out = _SimStdout(self)
+        saved = sys.stdout, sys.stdin
+        sys.stdout = self.modules['sys'].stdout = self.modules['sys'].stderr = out
+        sys.stdin = self.modules['sys'].stdin = _SimStdin(self, out)
+        error = b''
+        self.filenames.add(filename)
+        self.executing = True
+        try:
+            code = compile(source, filename, mode, dont_inherit=True) if isinstance(source, (str, bytes)) else source
+            exec(code, self.globals)
+        except SimReset:
+            raise
+        except BaseException as e:
+            error = self.format_exception(e)
+        finally:
+            self.executing = False
+            sys.stdout, sys.stdin = saved
+            out.flush()
+        return error
+
+    def boot(self):
+        """Run code.py (or one of the other names) and wait for a key"""
+        self.send(b'\r\nAuto-reload is off.\r\n')
+        if self.safe_mode:
+            self.send(b'Running in safe mode! Not running saved code.\r\n')
+        else:
+            for name in ('code.txt', 'code.py', 'main.py', 'main.txt'):
+                path = os.path.join(self.root, name)
+                if os.path.isfile(path):
+                    self.send(name.encode() + b' output:\r\n')
+                    with open(path, 'rb') as f:
+                        self.send(self.execute(f.read(), name))
+                    break
+        self.send(MSG_NEWLINE * 2)
+        if self.safe_mode:
+            self.send(MSG_NEWLINE + SIM_SAFE_MODE + MSG_NEWLINE)
+        self.send(MSG_NEWLINE + MSG_WAIT_BEFORE_REPL + MSG_NEWLINE)
+        return 'wait'
+
+    def soft_reboot(self):
+        self.reset_state()
+        self.send(b'soft reboot\r\n')
+        return self.boot()
+
+    def hard_reset(self):
+        mode, self.next_mode = self.next_mode, 'NORMAL'
+        self.close()
+        time.sleep(self.reset_delay)
+        # The bootloader isn't simulated, it comes back up running CircuitPython
+        self.safe_mode = mode == 'SAFE_MODE'
+        self.reset_state()
+        self.open()
+        return self.boot()
+
+    def mode_wait(self):
+        self.getc()
+        self.send(MSG_NEWLINE + SIM_BANNER + b'\r\n>>> ')
+        return 'friendly'
+
+    def mode_friendly(self):
+        import codeop
+        line = b''
+        lines = []
+        while True:
+            c = self.getc()
+            if c == REPL.CHAR_CTRL_A:
+                self.send(b'\r\nraw REPL; CTRL-B to exit\r\n>')
+                return 'raw'
+            elif c == REPL.CHAR_CTRL_B:
+                self.send(MSG_NEWLINE + SIM_BANNER + b'\r\n>>> ')
+                line, lines = b'', []
+            elif c == REPL.CHAR_CTRL_C:
+                self.send(b'\r\n>>> ')
+                line, lines = b'', []
+            elif c == REPL.CHAR_CTRL_D:
+                if not line and not lines:
+                    self.send(MSG_NEWLINE)
+                    return self.soft_reboot()
+            elif c in (b'\x08', b'\x7f'):
+                if line:
+                    line = line[:-1]
+                    self.send(b'\x08 \x08')
+            elif c == b'\r':
+                self.send(MSG_NEWLINE)
+                lines.append(line.decode('utf-8', errors='replace'))
+                line = b''
+                source = '\n'.join(lines)
+                if len(lines) > 1 and lines[-1].strip():
+                    code = None
+                else:
+                    try:
+                        code = codeop.compile_command(source, '<stdin>', 'single')
+                    except (SyntaxError, ValueError, OverflowError) as e:
+                        self.send(self.format_exception(e))
+                        self.send(b'>>> ')
+                        lines = []
+                        continue
+                if code is None and source.strip():
+                    self.send(b'... ')
+                    continue
+                lines = []
+                if code is not None:
+                    self.send(self.execute(code))
+                self.send(b'>>> ')
+            elif c >= b' ':
+                line += c
+                self.send(c)
+
+    def mode_raw(self):
+        buf = b''
+        while True:
+            c = self.getc()
+            if c == REPL.CHAR_CTRL_A:
+                self.send(b'raw REPL; CTRL-B to exit\r\n>')
+                buf = b''
+            elif c == REPL.CHAR_CTRL_B:
+                self.send(MSG_NEWLINE + SIM_BANNER + b'\r\n>>> ')
+                return 'friendly'
+            elif c == REPL.CHAR_CTRL_C:
+                buf = b''
+            elif c == b'\x05' and not buf:
+                request = self.getc() + self.getc()
+                if request == b'A\x01':
+                    self.raw_paste()
+                else:
+                    buf = c + request
+            elif c == REPL.CHAR_CTRL_D:
+                if not buf:
+                    self.reset_state()
+                    self.send(b'OK\r\nsoft reboot\r\nraw REPL; CTRL-B to exit\r\n>')
+                    continue
+                self.send(b'OK')
+                error = self.execute(buf)
+                self.send(b'\x04' + error + b'\x04>')
+                buf = b''
+            else:
+                buf += c
+
+    def raw_paste(self):
+        window = self.RAW_PASTE_WINDOW
+        self.send(b'R\x01' + struct.pack('<H', window))
+        buf = b''
+        remaining = window
+        while True:
+            c = self.getc()
+            if c == REPL.CHAR_CTRL_D:
+                break
+            buf += c
+            remaining -= 1
+            if not remaining:
+                self.send(b'\x01')
+                remaining = window
+        self.send(b'\x04')
+        error = self.execute(buf)
+        self.send(b'\x04' + error + b'\x04>')
+
+    def serve_forever(self):
+        mode = self.boot()
+        while True:
+            try:
+                mode = getattr(self, 'mode_' + mode)()
+            except SimReset:
+                mode = self.hard_reset()
+            except KeyboardInterrupt:
+                # Ctrl-C that came in just as the code finished
+                if not self.interrupted:
+                    raise
+            self.interrupted = False
+
+
+def parse_sim(name):
+    """Return the options of a simulated board name: sim:[label][:latency=S][:bandwidth=B][:root=DIR][:pins=P,...]"""
+    options = {}
+    for part in name.split(':')[1:]:
+        key, sep, value = part.partition('=')
+        if not sep:
+            continue
+        if key in ('latency', 'bandwidth'):
+            options[key] = float(value)
+        elif key == 'root':
+            options[key] = value
+        elif key == 'pins':
+            options[key] = tuple(pin for pin in value.split(',') if pin)
+        else:
+            raise ValueError('unknown simulated board option: %s' % (key,))
+    return options
+
+
+_simulators = {}
+
+
+def simulate(name, timeout=10):
+    """Start a simulated board for name (see parse_sim()) in a subprocess, return the path of its tty
+
+    The board is shared by all the CPboard's with the same name in this process.
+    """
+    sim = _simulators.get(name)
+    if sim and sim['proc'].poll() is None:
+        return sim['link']
+
+    import atexit
+    import subprocess
+    options = parse_sim(name)
+    tmpdir = tempfile.mkdtemp(prefix='cpboard-sim-')
+    link = os.path.join(tmpdir, 'tty')
+    root = options.get('root') or os.path.join(tmpdir, 'root')
+    os.makedirs(os.path.join(root, 'lib'), exist_ok=True)
+    args = [sys.executable, os.path.abspath(__file__), 'sim', '--link', link, '--root', root]
+    for key in ('latency', 'bandwidth'):
+        if key in options:
+            args.extend(['--' + key, str(options[key])])
+    if 'pins' in options:
+        args.extend(['--pins', ','.join(options['pins'])])
+    # Its own session so a Ctrl-C in the terminal doesn't reach it
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, start_new_session=True)
+    sim = _simulators[name] = {'proc': proc, 'link': link}
+
+    def stop():
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    atexit.register(stop)
+    wait_for(lambda: os.path.exists(link) or proc.poll() is not None, timeout, name)
+    if proc.poll() is not None:
+        raise CPboardError('simulated board %s exited with %s' % (name, proc.returncode))
+    return link
+
+
 @remote
 def os_uname():
     import os
@@ -1022,6 +2628,13 @@ def print_verbose(cargs, *args, **kwargs):
     if cargs.verbose:
         print(*args, flush=True, **kwargs)
 
+def _find_board(name):
+    get_registry().refresh()
+    try:
+        return CPboard.from_try_all(name)
+    except (RuntimeError, OSError):
+        return None
+
 def upload(args):
     try:
         board = CPboard.from_build_name_bootloader(args.board)
@@ -1031,32 +2644,285 @@ def upload(args):
 
     print_verbose(args, "Serial number :", board.serial_number)
 
-    if not (args.quiet or board.bootloader):
-        board.open()
-        print('Current version:', os_uname(board).version, flush=True)
+    uf2 = UF2File(args.firmware)
 
     if not board.bootloader:
+        board.open()
+        uname = os_uname(board)
+        if not args.quiet:
+            print('Current version:', uname.version, flush=True)
+        if not args.force and uf2.is_current(uname):
+            if not args.quiet:
+                print('Firmware is already current, use --force to flash anyway')
+            return
+
         print_verbose(args, 'Reset to bootloader...', end='')
         board.reset_to_bootloader(repl=True) # Feather M0 Express doesn't respond to 1200 baud
-        time.sleep(5)
+        board.wait_bootloader()
         print_verbose(args, 'done')
 
-    print_verbose(args, 'Bootloader:', board.firmware.info)
-
     print_verbose(args, 'Upload firmware...', end='')
-    board.firmware.upload(args.firmware)
+    info = board.firmware.flash(args.firmware, board_id=uf2.board_id)
     print_verbose(args, 'done')
+    print_verbose(args, 'Bootloader:', info)
 
     print_verbose(args, 'Wait for board...', end='')
-    time.sleep(5)
+    if board.bootloader:
+        board.wait_gone()
+        board = wait_for(lambda: _find_board(args.board), 30, args.board)
+    board.wait_ready()
     print_verbose(args, 'done')
 
     if not args.quiet:
-        if board.bootloader:
-            board = CPboard.from_try_all(args.board)
-        board.open(wait=10)
         print('New version:', os_uname(board).version, flush=True)
 
+def find_boards(names):
+    """Return a CPboard for each attached board matching a build name, serial number or tty"""
+    registry = get_registry()
+    boards = []
+    for name in names:
+        if name in registry.boards:
+            devs = [dev for dev in registry.devices if registry.lookup(dev)[0] == name]
+        else:
+            devs = registry.find(serial_number=name)
+        if not devs:
+            boards.append(CPboard.from_try_all(name))
+        for dev in devs:
+            board = CPboard(dev)
+            board.bootloader = registry.lookup(dev)[1]
+            boards.append(board)
+    return boards
+
+def _in_bootloader(board):
+    registry = get_registry()
+    registry.refresh()
+    devs = registry.find(sysfs=board.usb_dev.sysfs)
+    return bool(devs) and registry.lookup(devs[0])[1]
+
+def flash_board(board, uf2, force=False, timeout=60):
+    """Flash a board with a UF2File unless it's already running it
+
+    Returns a dict with the result and the time each step took.
+    """
+    times = collections.OrderedDict()
+    result = {'device': board.device, 'status': None, 'old': None, 'new': None, 'times': times, 'error': None}
+    start = lap = time.monotonic()
+
+    def timed(step):
+        nonlocal lap
+        now = time.monotonic()
+        times[step] = now - lap
+        times['total'] = now - start
+        lap = now
+
+    try:
+        if not board.bootloader:
+            board.open(wait=10)
+            uname = os_uname(board)
+            result['old'] = uname.version
+            timed('check')
+            if not force and uf2.is_current(uname):
+                result['status'] = 'current'
+                return result
+
+            board.reset_to_bootloader(repl=True)
+            board.wait_bootloader(timeout)
+            timed('bootloader')
+
+        board.firmware.flash(uf2.path, board_id=uf2.board_id)
+        timed('copy')
+
+        if isinstance(board.usb_dev, UsbDevice):
+            wait_for(lambda: not _in_bootloader(board), timeout, 'firmware')
+        else:
+            board.wait_gone()
+        board.bootloader = False
+        board.wait_ready(timeout)
+        result['new'] = os_uname(board).version
+        timed('ready')
+        result['status'] = 'flashed'
+    except (Exception, CPboardError) as e:
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    finally:
+        board.close()
+    return result
+
+def flash_fleet(boards, fw, force=False, timeout=60, jobs=None):
+    """Flash many boards in parallel, return a list of flash_board() results"""
+    uf2 = UF2File(fw)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(boards) or 1) as executor:
+        futures = [executor.submit(flash_board, board, uf2, force, timeout) for board in boards]
+        return [future.result() for future in futures]
+
+def flash(argv):
+    import argparse
+    cmd_parser = argparse.ArgumentParser(prog='cpboard flash', description='Flash UF2 firmware to many boards in parallel')
+    cmd_parser.add_argument('firmware', help='UF2 firmware file')
+    cmd_parser.add_argument('board', nargs='+', help='build_name (all attached), serial number or /dev/tty')
+    cmd_parser.add_argument('--force', action='store_true', help='flash even if the firmware is already running')
+    cmd_parser.add_argument('-j', '--jobs', type=int, help='boards to flash at the same time (default: all)')
+    cmd_parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for each step')
+    cmd_parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = cmd_parser.parse_args(argv)
+
+    start = time.monotonic()
+    results = flash_fleet(find_boards(args.board), args.firmware, force=args.force, timeout=args.timeout, jobs=args.jobs)
+    elapsed = time.monotonic() - start
+
+    if args.json:
+        print(json.dumps({'elapsed': elapsed, 'boards': results}, indent=2))
+    else:
+        steps = ['check', 'bootloader', 'copy', 'ready', 'total']
+        print('%-20s %-8s' % ('device', 'status') + ''.join('%11s' % step for step in steps))
+        for res in results:
+            times = ''.join(('%10.2fs' % res['times'][step]) if step in res['times'] else '%11s' % '-' for step in steps)
+            print('%-20s %-8s' % (res['device'], res['status']) + times)
+            if res['error']:
+                print('  ' + res['error'])
+            elif res['new']:
+                print('  %s -> %s' % (res['old'] or '(bootloader)', res['new']))
+        print('%d boards in %.2fs' % (len(results), elapsed))
+
+    if any(res['status'] == 'failed' for res in results):
+        sys.exit(1)
+
+def percentiles(times):
+    """Summarize a list of durations"""
+    times = sorted(times)
+
+    def rank(p):
+        # Nearest-rank method
+        return times[max(int(math.ceil(p / 100.0 * len(times))) - 1, 0)]
+
+    return collections.OrderedDict([
+        ('n', len(times)),
+        ('min', times[0]),
+        ('p50', rank(50)),
+        ('p90', rank(90)),
+        ('p99', rank(99)),
+        ('max', times[-1]),
+        ('mean', sum(times) / len(times)),
+    ])
+
+@remote
+def _bench_remote():
+    return None
+
+def bench(board, repeat=20, copy_repeat=3, copy_sizes=(1, 16, 64), path='/bench.bin', out=None):
+    """Measure REPL round trips, eval decoding, file copy and remote call overhead
+
+    Returns an OrderedDict of percentiles() results keyed on the benchmark name.
+    Errors are recorded in place of the results.
+    """
+    results = collections.OrderedDict()
+
+    def measure(name, func, repeat=repeat, nbytes=None):
+        if out:
+            print('%-16s' % name, end='', file=out, flush=True)
+        times = []
+        try:
+            for _ in range(repeat):
+                start = time.monotonic()
+                func()
+                times.append(time.monotonic() - start)
+        except (Exception, CPboardError) as e:
+            results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+        else:
+            results[name] = percentiles(times)
+            if nbytes:
+                results[name]['bytes'] = nbytes
+                results[name]['bytes_per_s'] = nbytes / results[name]['p50']
+        if out:
+            print(' done', file=out, flush=True)
+
+    board.repl.reset()
+
+    measure('exec_empty', lambda: board.exec('', reset_repl=False))
+
+    for size in (16, 256, 1024, 4096):
+        expression = "repr('a' * %d)" % size
+        measure('eval_str_%d' % size, lambda: board.eval(expression, reset_repl=False), nbytes=size)
+    for size in (16, 256):
+        expression = 'list(range(%d))' % size
+        measure('eval_list_%d' % size, lambda: board.eval(expression, reset_repl=False))
+
+    disk = ReplDisk(board)
+    with tempfile.NamedTemporaryFile() as f:
+        for size in copy_sizes:
+            f.seek(0)
+            f.truncate()
+            f.write(os.urandom(size * 1024))
+            f.flush()
+            measure('copy_%dk' % size, lambda: disk.copy(f.name, path, force=True), repeat=copy_repeat,
+                    nbytes=size * 1024)
+    try:
+        board.exec('__import__("os").remove(%r)' % path, reset_repl=False)
+    except (Exception, CPboardError):
+        pass
+
+    measure('remote_call', lambda: _bench_remote(board, _reset_repl=False))
+
+    def soft_reset():
+        board.repl.run()
+        board.repl.reset()
+
+    measure('soft_reset', soft_reset, repeat=copy_repeat)
+
+    return results
+
+def print_bench(results, file=None):
+    """Print the percentiles() results of bench() as a table"""
+    print('%-20s %6s' % ('benchmark', 'n') + ''.join('%10s' % k for k in ('min', 'p50', 'p90', 'p99', 'max')) + '  throughput',
+          file=file)
+    for name, res in results.items():
+        if 'error' in res:
+            print('%-20s %s' % (name, res['error']), file=file)
+            continue
+        line = '%-20s %6d' % (name, res['n'])
+        line += ''.join('%8.1fms' % (res[k] * 1000) for k in ('min', 'p50', 'p90', 'p99', 'max'))
+        if 'bytes_per_s' in res:
+            line += '  %.1f kB/s' % (res['bytes_per_s'] / 1024)
+        print(line, file=file)
+
+def bench_command(argv):
+    import argparse
+    import platform
+    cmd_parser = argparse.ArgumentParser(prog='cpboard bench', description='Measure link and execution performance')
+    cmd_parser.add_argument('board', help='build_name, vid:pid or /dev/tty')
+    cmd_parser.add_argument('-n', '--repeat', type=int, default=20, help='round trip repetitions (default: %(default)s)')
+    cmd_parser.add_argument('--copy-repeat', type=int, default=3,
+                            help='file copy and soft reset repetitions (default: %(default)s)')
+    cmd_parser.add_argument('--path', default='/bench.bin', help='file used for the copy benchmark (default: %(default)s)')
+    cmd_parser.add_argument('--json', metavar='FILE', help="write the results as JSON ('-' for stdout)")
+    args = cmd_parser.parse_args(argv)
+
+    out = None if args.json == '-' else sys.stdout
+    with CPboard.from_try_all(args.board) as board:
+        uname = os_uname(board)
+        results = bench(board, repeat=args.repeat, copy_repeat=args.copy_repeat, path=args.path, out=out)
+
+    report = collections.OrderedDict([
+        ('board', args.board),
+        ('firmware', uname.version),
+        ('machine', uname.machine),
+        ('host', platform.node()),
+        ('python', platform.python_version()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('results', results),
+    ])
+
+    if out:
+        print()
+        print('%s: %s' % (uname.machine, uname.version))
+        print_bench(results)
+
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
 def print_error_exit(args, e):
     if args.debug:
         return False
@@ -1064,16 +2930,91 @@ def print_error_exit(args, e):
         print(e, file=sys.stderr)
     sys.exit(1)
 
+def list_boards(argv):
+    import argparse
+    cmd_parser = argparse.ArgumentParser(prog='cpboard list', description='List attached USB serial and disk devices')
+    cmd_parser.add_argument('--json', action='store_true', help='print as JSON')
+    args = cmd_parser.parse_args(argv)
+
+    boards = get_registry().as_list()
+    if args.json:
+        print(json.dumps(boards, indent=2, sort_keys=True))
+        return
+
+    for board in boards:
+        name = board['build_name'] or '-'
+        if board['bootloader']:
+            name += ' (bootloader)'
+        print('%-40s %s %-10s %-24s %s' % (name, board['usb'], board['port'], board['serial_number'] or '-',
+                                           ' '.join(board['ttys'])))
+
+def serve(argv):
+    import argparse
+    cmd_parser = argparse.ArgumentParser(prog='cpboard serve', description='Keep boards open and share them through a Unix socket')
+    cmd_parser.add_argument('board', nargs='*', help='build_name, vid:pid or /dev/tty to open on startup')
+    cmd_parser.add_argument('--socket', default=DAEMON_SOCKET, help='Unix socket path (default: %(default)s)')
+    cmd_parser.add_argument('--open-timeout', type=float, default=10,
+                            help='seconds to wait for a board device to show up (default: %(default)s)')
+    cmd_parser.add_argument('--verbose', '-v', action='count', default=0, help='be verbose')
+    args = cmd_parser.parse_args(argv)
+
+    daemon = BoardDaemon(args.socket, out=sys.stdout if args.verbose else None, open_timeout=args.open_timeout)
+    for name in args.board:
+        daemon.board(name).open(args.open_timeout)
+    daemon.start()
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def sim_command(argv):
+    import argparse
+    cmd_parser = argparse.ArgumentParser(prog='cpboard sim', description='Run a simulated CircuitPython board behind a pty')
+    cmd_parser.add_argument('--link', help='symlink to the pty (default: in a temporary directory), it is printed on startup')
+    cmd_parser.add_argument('--root', help='filesystem root directory (default: temporary directory)')
+    cmd_parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each transfer (default: %(default)s)')
+    cmd_parser.add_argument('--bandwidth', type=float, help='bytes per second (default: no limit)')
+    cmd_parser.add_argument('--pins', help='comma separated board module pins (default: %s)' % ','.join(SIM_PINS))
+    args = cmd_parser.parse_args(argv)
+
+    link = args.link or os.path.join(tempfile.mkdtemp(prefix='cpboard-sim-'), 'tty')
+    root = args.root or tempfile.mkdtemp(prefix='cpboard-sim-root-')
+    pins = [pin for pin in args.pins.split(',') if pin] if args.pins is not None else SIM_PINS
+    board = SimulatedBoard(link, root, latency=args.latency, bandwidth=args.bandwidth, pins=pins)
+    board.open()
+    print(link, flush=True)
+    try:
+        board.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        board.close()
+
 def main():
+    commands = {
+        'bench': bench_command,
+        'flash': flash,
+        'list': list_boards,
+        'serve': serve,
+        'sim': sim_command,
+    }
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+
     import argparse
-    cmd_parser = argparse.ArgumentParser(description='Circuit Python Board Tool')
+    cmd_parser = argparse.ArgumentParser(description='Circuit Python Board Tool',
+                                         epilog='commands: %s (see cpboard <command> -h)' % ', '.join(sorted(commands)))
     cmd_parser.add_argument('board', help='build_name, vid:pid or /dev/tty')
     cmd_parser.add_argument('-f', '--firmware', help='upload UF2 firmware file')
+    cmd_parser.add_argument('--force', action='store_true', help='upload firmware even if it is already running')
     cmd_parser.add_argument('-c', '--command', help='program passed in as string')
     cmd_parser.add_argument('--tty', action='store_true', help='print tty')
     cmd_parser.add_argument('--verbose', '-v', action='count', default=0, help='be verbose')
     cmd_parser.add_argument('-q', '--quiet', action='store_true', help='be quiet')
     cmd_parser.add_argument('--debug', action='store_true', help='raise exceptions')
+    cmd_parser.add_argument('--daemon', nargs='?', const=DAEMON_SOCKET, metavar='SOCKET',
+                            help='access the board through cpboard serve')
     args = cmd_parser.parse_args()
 
     if args.quiet:
@@ -1089,7 +3030,10 @@ def main():
         sys.exit(0)
 
     try:
-        board = CPboard.from_try_all(args.board)
+        if args.daemon:
+            board = DaemonBoard(args.board, path=args.daemon)
+        else:
+            board = CPboard.from_try_all(args.board)
     except BaseException as e:
         if not print_error_exit(args, e):
             raise
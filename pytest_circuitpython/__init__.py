@@ -3,21 +3,119 @@
 import inspect
 import os
 import pytest
-import re
 import sys
 import unittest.mock as mock
 
 import cpboard
 
-from .utils import get_board
+from .utils import get_board, file_hash, board_pool, board_labels, board_exec, delete_variables, flush_cleanup
+from .matrix import run_matrix
+from .batch import make_batches
+from .prepare import prepare_files
+from .collect import static_module
+from .order import order_items
+from .remote import FrameFilter, frame_value, remote_source, value_command
+from .memory import add_measurement, end_heap_phase, heap_command, heap_summary, probe
+from .durations import add_board_time, durations_summary, end_timing_phase, timed_command
+from .tracing import TracePlugin
+from .benchmark import BenchmarkResults
+from .recovery import RecoveryResults, recovery_status
 from .fixtures import *  # noqa: F403,F401
 
 
 def pytest_addoption(parser):
     group = parser.getgroup('circuitpython')
-    group.addoption('--board', dest='boarddev', help='build_name, vid:pid or /dev/tty')
+    group.addoption('--board', dest='boarddev',
+                    help='build_name, vid:pid, serial number, /dev/tty or sim: for a simulated board. '
+                         'With pytest-xdist a comma separated list or glob pattern gives each worker its own board')
     group.addoption('--file-overwrite', action='store_true', default=False, dest='file_overwrite',
                     help="Force file upload, don't check")
+    group.addoption('--board-daemon', nargs='?', const=cpboard.DAEMON_SOCKET, dest='board_daemon', metavar='SOCKET',
+                    help='Access the board through a running cpboard serve daemon')
+    group.addoption('--board-matrix', action='store_true', default=False, dest='board_matrix',
+                    help='Run each board test on every board in --board (default: all attached boards)')
+    group.addoption('--board-batch', nargs='?', const='module', choices=('module', 'session'), dest='board_batch',
+                    help='Run the board tests of each module (default) or the whole session with one request')
+    group.addoption('--board-collect', choices=('import', 'static'), default='import', dest='board_collect',
+                    help='Collect the test_board_ modules by importing them (default) '
+                         'or from their source without running any of it on the host')
+    group.addoption('--board-order', choices=('collection', 'cost'), default='collection', dest='board_order',
+                    help='Run the board tests in collection order (default) or in the order needing the fewest '
+                         'module changes and fixture setups on the board')
+    group.addoption('--board-timeout', type=float, default=10, dest='board_timeout', metavar='SECONDS',
+                    help='Time out a board test, fixture or import that is silent this long (default: 10)')
+    group.addoption('--board-recover-timeout', type=float, default=30, dest='board_recover_timeout',
+                    metavar='SECONDS', help='Time allowed to get the board back after a timeout or lost connection '
+                                            '(default: 30, 0 to stop the recovery)')
+    group.addoption('--board-memory', action='store_true', default=False, dest='board_memory',
+                    help='Measure the board heap around each board test and fixture, report the retained memory')
+    group.addoption('--board-durations', type=int, default=None, dest='board_durations', metavar='N',
+                    help='Show N slowest board test phases split in board, link and host time (N=0 for all)')
+    group.addoption('--board-benchmark-json', dest='board_benchmark_json', metavar='PATH',
+                    help='Save the board_benchmark results as JSON')
+    group.addoption('--board-benchmark-compare', dest='board_benchmark_compare', metavar='PATH',
+                    help='Compare the board_benchmark results to a file saved with --board-benchmark-json')
+    group.addoption('--board-trace', dest='board_trace', metavar='PATH',
+                    help='Write a Chrome trace event file of the board communication and test phases')
+
+
+def is_xdist_master(config):
+    return getattr(config.option, 'dist', 'no') != 'no' and not hasattr(config, 'workerinput')
+
+
+# Set up the board pool, each xdist worker leases one board
+def pytest_configure(config):
+    if config.option.board_trace and not is_xdist_master(config):
+        config.pluginmanager.register(TracePlugin(config, config.option.board_trace), 'board_trace')
+    # The results come in with the reports, also from the xdist workers and --board-matrix processes
+    if not hasattr(config, 'workerinput'):
+        config.pluginmanager.register(BenchmarkResults(config), 'board_benchmark_results')
+        config.pluginmanager.register(RecoveryResults(config), 'board_recovery_results')
+    if config.option.board_matrix and not config.option.boarddev:
+        config.option.boarddev = '*'
+    if not config.option.boarddev:
+        return
+
+    workerinput = getattr(config, 'workerinput', None)
+    if workerinput is not None:
+        config.option.boarddev = workerinput.get('board') or config.option.boarddev
+        return
+
+    pool = board_pool(config.option.boarddev)
+    config.board_pool = pool
+    if config.option.board_matrix:
+        if is_xdist_master(config):
+            raise pytest.UsageError('--board-matrix can not be combined with pytest-xdist')
+        config.board_matrix = board_labels(pool)
+        config.option.boarddev = pool[0]
+        return
+    if not is_xdist_master(config):
+        config.option.boarddev = pool[0]
+        return
+
+    # Board tests can only run on a worker holding a board, so don't start more workers than boards
+    tx = getattr(config.option, 'tx', None)
+    if tx and len(tx) > len(pool):
+        config.option.tx = tx[:len(pool)]
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_configure_node(node):
+    pool = getattr(node.config, 'board_pool', None)
+    if not pool:
+        return
+    # The specs compare equal on their string, so look up by identity
+    index = [spec is node.gateway.spec for spec in node.nodemanager.specs].index(True)
+    node.workerinput['board'] = pool[index % len(pool)]
+
+
+def pytest_report_header(config):
+    labels = getattr(config, 'board_matrix', None)
+    if labels:
+        return 'board matrix: %s' % ', '.join('%s (%s)' % (label, name) for label, name in labels.items())
+    pool = getattr(config, 'board_pool', None)
+    if pool and is_xdist_master(config):
+        return 'board pool: %s (%d workers)' % (', '.join(pool), len(config.option.tx or []))
 
 
 # Import machinery
@@ -44,6 +142,14 @@ def pytest_pycollect_makemodule(path, parent):
 
     if 'test_board_' in str(path):
         debug = config.option.verbose > 1
+        if config.option.board_collect == 'static':
+            module = static_module(parent.session, path)
+            if module is not None:
+                if debug:
+                    print('Static module:', module.__name__)
+                collector = pytest.Module(path, parent)
+                collector._obj = module
+                return collector
         with mock.patch('builtins.__import__', try_import):
             mod = path.pyimport(ensuresyspath='prepend')
             if debug:
@@ -56,29 +162,39 @@ def remote_path(session, f):
     return rpath
 
 
-# Mark tests, rewrite assert statements and upload files to the board
-@pytest.hookimpl(tryfirst=True)
-def pytest_runtestloop(session):
-    config = session.config
-    if not config.option.boarddev:
-        return
+def is_board_test(path, name, cls):
+    return os.path.basename(str(path)).startswith('test_board_') or name.startswith('test_board_') or \
+        (cls is not None and cls.__name__.startswith('TestBoard'))
 
-    if config.option.collectonly:
+
+# Group the board tests by module and higher scope fixtures
+@pytest.hookimpl(trylast=True)
+def pytest_collection_modifyitems(session, config, items):
+    if not config.option.boarddev or config.option.board_order != 'cost':
         return
+    config.board_order_setups = order_items(
+        items, lambda item: is_board_test(item.fspath, item.name, getattr(item, 'cls', None)))
 
-    verbose = config.option.verbose
 
-    # print("Session", session, session.fspath)
-    # print(dir(session))
+def pytest_report_collectionfinish(config, startdir, items):
+    setups = getattr(config, 'board_order_setups', None)
+    if setups:
+        return 'board order: %d module changes and fixture setups, %d in collection order' % (setups[1], setups[0])
 
-    for item in session.items:
-        # print('item', item, item.parent)
-        # print('  fixturenames', item.fixturenames)
-        # print(dir(item), '\n')
-        if os.path.basename(item.name).startswith('test_board_') or \
-           os.path.basename(item.parent.name).startswith('test_board_') or \
-           (item.cls and item.cls.__name__.startswith('TestBoard')):
-            item.add_marker('board')
+
+# Run the board tests on each board in the matrix
+def pytest_generate_tests(metafunc):
+    labels = getattr(metafunc.config, 'board_matrix', None)
+    if not labels or not is_board_test(metafunc.module.__file__, metafunc.function.__name__, metafunc.cls):
+        return
+    if 'board_name' not in metafunc.fixturenames:
+        metafunc.fixturenames.append('board_name')
+    metafunc.parametrize('board_name', list(labels))
+
+
+def board_files(session):
+    """Return the (src, dst) files to upload, src is the prepared file (see prepare_files())"""
+    config = session.config
 
     files = []
     for item in session.items:
@@ -108,9 +224,25 @@ def pytest_runtestloop(session):
                     files.append(path)
 
     if not files:
-        return
+        return []
+
+    boardlib = os.path.join(os.path.dirname(__file__), 'boardlib')
+    res = [(os.path.join(boardlib, 'pytest.py'), '/lib/pytest.py')]
+    if config.option.board_batch:
+        res.append((os.path.join(boardlib, 'pytest_runner.py'), '/lib/pytest_runner.py'))
+    for f, src in zip(files, prepare_files(session, [str(f) for f in files])):
+        res.append((src, remote_path(session, f)))
+
+    return res
+
+
+def upload_files(session, files):
+    config = session.config
+    verbose = config.option.verbose
 
     board = get_board(session)
+    # Checked again after a reboot, see recovery.py
+    session.board_uploads = list(files)
 
     print('\nCopy files to board: ', end='')
     if verbose:
@@ -119,30 +251,67 @@ def pytest_runtestloop(session):
     disk = cpboard.ReplDisk(board)
 
     overwrite = config.option.file_overwrite
+    daemon = isinstance(board, cpboard.DaemonBoard)
+    uploaded = {}
 
-    def copyfile(src, dst):
+    for src, dst in files:
         if verbose:
             print('  ', dst, end='')
         else:
             print('.', end='', flush=True)
-        disk.makedirs(os.path.dirname(dst), exist_ok=True)
-        copied = disk.copy(src, dst, force=overwrite)
+        digest = file_hash(src)
+        known = session.board_files.get(dst)
+        if known == digest and not overwrite:
+            copied = False
+        else:
+            disk.makedirs(os.path.dirname(dst), exist_ok=True)
+            # Only the size can be checked on the board, so copy if the content is known to differ
+            copied = disk.copy(src, dst, force=overwrite or known is not None)
+            session.board_files[dst] = uploaded[dst] = digest
         if verbose:
             print('' if copied else ' (unchanged)')
 
-    copyfile(str(os.path.join(os.path.dirname(__file__), 'boardlib', 'pytest.py')), '/lib/pytest.py')
+    if not verbose:
+        print()
 
-    for f in files:
-        src = str(f)
-        dst = remote_path(session, f)
+    if daemon and uploaded:
+        board.client.update(board.name, files=uploaded)
 
-        if config.getvalue("assertmode") == "rewrite":
-            src = assert_rewrite_module(session, src)
 
-        copyfile(src, dst)
+# Mark tests, rewrite assert statements and upload files to the board
+@pytest.hookimpl(tryfirst=True)
+def pytest_runtestloop(session):
+    config = session.config
+    if not config.option.boarddev:
+        return
 
-    if not verbose:
-        print()
+    if config.option.collectonly:
+        return
+
+    # The workers run the tests
+    if is_xdist_master(config):
+        return
+
+    # print("Session", session, session.fspath)
+    # print(dir(session))
+
+    for item in session.items:
+        # print('item', item, item.parent)
+        # print('  fixturenames', item.fixturenames)
+        # print(dir(item), '\n')
+        if is_board_test(item.fspath, item.name, getattr(item, 'cls', None)):
+            item.add_marker('board')
+
+    files = board_files(session)
+
+    if config.option.board_batch:
+        make_batches(session)
+
+    if getattr(config, 'board_matrix', None):
+        return run_matrix(session, files)
+
+    if files:
+        upload_files(session, files)
 
 
 def create_traceback(e, path):
@@ -168,14 +337,16 @@ def remote_import(session, path):
     fname = os.path.basename(path)
     modname = os.path.splitext(fname)[0]
 
-    command = '%r in globals()' % modname
-    imported = board.eval(command, reset_repl=False, raise_remote=False)
-    if debug:
-        print('imported', imported)
-    if imported:
+    # The host knows which version of the file is imported, so no need to ask the board
+    daemon = isinstance(board, cpboard.DaemonBoard)
+    digest = session.board_files.get(path)
+    imported = session.board_modules.get(modname)
+    if imported is not None and imported == digest:
         return
 
-    command = 'import os\n'
+    # Not imported in this session or changed since, make sure it's a fresh import
+    command = 'import sys; sys.modules.pop(%r, None); globals().pop(%r, None)\n' % (modname, modname)
+    command += 'import os\n'
     command += 'os.chdir(%r)\n' % os.path.dirname(path)
     command += 'import gc; gc.collect()\n'
     if debug:
@@ -185,15 +356,23 @@ def remote_import(session, path):
         command += 'print(globals())\n'
         print('command:\n', command)
     try:
-        board.exec(command, reset_repl=False, raise_remote=False, out=sys.stdout)
+        board_exec(session, command, reset_repl=False, raise_remote=False, out=sys.stdout)
     except cpboard.CPboardRemoteError as e:
         if debug:
             print('remote_import: e=', e)
+        session.board_modules.pop(modname, None)
+        if daemon:
+            board.client.update(board.name, modules={modname: None})
         msg = "Failed to import '%s'" % (modname,)
         if e.exc_name:
             msg += '(%s: %s)' % (e.exc_name, e.exc_val)
         raise ImportError(msg) from e
 
+    if digest:
+        session.board_modules[modname] = digest
+        if daemon:
+            board.client.update(board.name, modules={modname: digest})
+
 
 # Import test files on the board
 def pytest_runtest_setup(item):
@@ -208,9 +387,78 @@ def pytest_runtest_setup(item):
     if marker is None:
         return
 
+    batch = getattr(item, 'board_batch', None)
+    if batch:
+        __tracebackhide__ = True
+        batch.replay(item, 'setup')
+        return
+
     remote_import(item.session, item.rpath)
 
 
+# Use the duration measured on the board for batched tests
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_makereport(item, call):
+    if item.config.option.board_memory:
+        heap_phase(item, call.when)
+    outcome = yield
+    report = outcome.get_result()
+    batch = getattr(item, 'board_batch', None)
+    duration = batch.duration(item, call.when) if batch else None
+    if duration is not None:
+        report.duration = duration
+        add_board_time(item.session, duration)
+    if item.config.option.board_durations is not None:
+        end_timing_phase(item, call, report)
+    if call.when == 'call' and getattr(item, 'board_benchmark', None):
+        # xdist can only send the builtin types
+        report.board_benchmark = dict(item.board_benchmark)
+    recovery = getattr(item.session, 'board_recovery', None)
+    if recovery:
+        report.board_recovery = list(recovery)
+        del recovery[:]
+
+
+# The board needed a recovery, it's not the test that failed
+@pytest.hookimpl(tryfirst=True)
+def pytest_report_teststatus(report):
+    return recovery_status(report)
+
+
+def instrument(config, command):
+    """Wrap command in the enabled board measurements"""
+    if config.option.board_durations is not None:
+        command = timed_command(command)
+    if config.option.board_memory:
+        command = heap_command(command)
+    return command
+
+
+def record_measurements(session, out, wider=False):
+    """Record the measurements in the frames of out (FrameFilter)"""
+    add_measurement(session.config, out.frames.get('M'), wider=wider)
+    add_board_time(session, out.frames.get('T'))
+
+
+def heap_phase(item, when):
+    """Attribute the heap measurements to the phase before its report is made"""
+    batch = getattr(item, 'board_batch', None)
+    if batch:
+        add_measurement(item.config, batch.memory(item, when))
+    elif when == 'teardown' and getattr(item.session, 'board', None) and \
+            (item.get_marker('board') or getattr(item, 'board_memory', None)):
+        # The retained memory is measured after the queued cleanup
+        probe(item.session)
+    end_heap_phase(item, when)
+
+
+def pytest_terminal_summary(terminalreporter):
+    if terminalreporter.config.option.board_memory:
+        heap_summary(terminalreporter)
+    if terminalreporter.config.option.board_durations is not None:
+        durations_summary(terminalreporter)
+
+
 # Wrap fixture functions and execute them on the board
 def pytest_fixture_setup(fixturedef, request):
     if not request.session.config.option.boarddev:
@@ -224,7 +472,10 @@ def pytest_fixture_setup(fixturedef, request):
         # print(dir(request))
         # print('fixture_board_wrapper: .func', fixture_board_wrapper.func)
         # print('fixture_board_wrapper:', request, dir(request))
-        board = request.session.board
+        if getattr(request._pyfuncitem, 'board_batch', None):
+            # Set up on the board by run_batch()
+            fixturedef.board_batched = True
+            return None
 
         remote_import(request.session, fixturedef.rpath)
 
@@ -239,20 +490,26 @@ def pytest_fixture_setup(fixturedef, request):
         command = 'res = %s.%s(%s)\n' % (modname, func.__name__, ', '.join(args))
         command += 'fixture_%s = res\n' % (argname,)
         command += 'fixture_%s_val = res\n' % (argname,)
+        # Only plain values are sent back, the rest stays on the board behind a RemoteObject
+        command += value_command('res')
 
         if debug:
             command += 'print(globals())\n'
             print('command:\n', command)
+        command = instrument(request.config, command)
 
+        out = FrameFilter(sys.stdout)
         try:
-            board.exec(command, reset_repl=False, raise_remote=False, out=sys.stdout)
-            res = board.eval('res', reset_repl=False, raise_remote=False, strict=False)
+            board_exec(request.session, command, reset_repl=False, raise_remote=False, out=out)
+            res = frame_value(request.session, out.frames.get('V'), 'fixture_%s_val' % (argname,))
         except cpboard.CPboardRemoteError as e:
             if debug:
                 print('fixture_board_wrapper: e=', e)
             if e.exc and create_traceback(e, fixturedef.rpath):
                 raise e.exc from None
             raise
+        finally:
+            record_measurements(request.session, out, wider=fixturedef.scope != 'function')
 
         if debug:
             print('res: %r' % (res,))
@@ -261,8 +518,13 @@ def pytest_fixture_setup(fixturedef, request):
 
     def fixture_board_wrapper_yield(request, **kwargs):
         __tracebackhide__ = True
-        print('fixture_board_wrapper_yield:', request.function)
-        board = request.session.board
+        if getattr(request._pyfuncitem, 'board_batch', None):
+            fixturedef.board_batched = True
+            yield None
+            return
+
+        if debug:
+            print('fixture_board_wrapper_yield:', request)
 
         remote_import(request.session, fixturedef.rpath)
 
@@ -277,24 +539,42 @@ def pytest_fixture_setup(fixturedef, request):
         command = 'fixture_%s = %s.%s(%r)\n' % (argname, modname, func.__name__, ', '.join(args))
         command += 'res = next(fixture_%s)\n' % (argname,)
         command += 'fixture_%s_val = res\n' % (argname,)
+        # Only plain values are sent back, the rest stays on the board behind a RemoteObject
+        command += value_command('res')
 
         if debug:
             command += 'print(globals())\n'
             print('command:\n', command)
+        command = instrument(request.config, command)
 
+        out = FrameFilter(sys.stdout)
         try:
-            board.exec(command, reset_repl=False, raise_remote=False, out=sys.stdout)
-            res = board.eval('res', reset_repl=False, raise_remote=False, strict=False)
+            board_exec(request.session, command, reset_repl=False, raise_remote=False, out=out)
+            res = frame_value(request.session, out.frames.get('V'), 'fixture_%s_val' % (argname,))
         except cpboard.CPboardRemoteError as e:
             if debug:
                 print('fixture_board_wrapper_yield: e=', e)
             if e.exc and create_traceback(e, fixturedef.rpath):
                 raise e.exc from None
             raise
+        finally:
+            record_measurements(request.session, out, wider=fixturedef.scope != 'function')
 
+        reboots = request.session.board.repl.reboots
         yield res
 
-        board.exec('next(fixture_%s)' % func.__name__, out=sys.stdout, reset_repl=False, raise_remote=True)
+        # The generator is gone if the board rebooted in the meantime (see recovery.py)
+        if request.session.board.repl.reboots != reboots:
+            return
+
+        # The fixture is done after the yield, StopIteration is the normal outcome
+        command = 'try:\n    next(fixture_%s)\nexcept StopIteration:\n    pass\n' % (argname,)
+        command = instrument(request.config, command)
+        out = FrameFilter(sys.stdout)
+        try:
+            board_exec(request.session, command, out=out, reset_repl=False, raise_remote=True)
+        finally:
+            record_measurements(request.session, out, wider=fixturedef.scope != 'function')
 
     if not getattr(request.session, 'board', None) or not getattr(fixturedef, 'rpath', ''):
         return
@@ -316,19 +596,6 @@ def pytest_fixture_setup(fixturedef, request):
     fixturedef.func.__wrapped_fixture__ = func
 
 
-def delete_variables(board, variables, debug):
-    command = ''
-    for var in variables:
-        command += 'try: del %s\nexcept (NameError, KeyError): pass\n' % (var,)
-    command += '__import__("gc").collect()\n'
-
-    if debug:
-        command += 'print(globals())\n'
-        print('command:\n', command)
-
-    board.exec(command, out=sys.stdout, reset_repl=False, raise_remote=True)
-
-
 # Clean out fixture variables from the namespace
 def pytest_fixture_post_finalizer(fixturedef, request):
     session = request.session
@@ -344,9 +611,13 @@ def pytest_fixture_post_finalizer(fixturedef, request):
     if not func:
         return
 
+    if getattr(fixturedef, 'board_batched', False):
+        fixturedef.board_batched = False
+        return
+
     argname = fixturedef.argname
     variables = ['fixture_%s' % (argname,), 'fixture_%s_val' % (argname,), 'res']
-    delete_variables(session.board, variables, debug)
+    delete_variables(session, variables)
 
 
 # Run test functions marked with 'board' on the board
@@ -365,6 +636,11 @@ def pytest_pyfunc_call(pyfuncitem):
         return
 
     __tracebackhide__ = True
+    batch = getattr(pyfuncitem, 'board_batch', None)
+    if batch:
+        batch.replay(pyfuncitem, 'call')
+        return True
+
     testfunction = pyfuncitem.obj
     if pyfuncitem._isyieldedfunction():
         # testfunction(*pyfuncitem._args)
@@ -383,8 +659,6 @@ def pytest_pyfunc_call(pyfuncitem):
         # print('pytest_pyfunc_call: pyfuncitem.param =', getattr(pyfuncitem, 'param', "object has no attribute 'param'"))
         # print('pytest_pyfunc_call: board =', pyfuncitem.session.board)
 
-        board = pyfuncitem.session.board
-
         command = ''
 
         testargs = []
@@ -392,7 +666,8 @@ def pytest_pyfunc_call(pyfuncitem):
             fixturevar = 'fixture_%s_val' % (arg,)
             argvar = 'funcarg_%s_val' % (arg,)
             # If this is not a remote fixture argument, use the passed in argument value
-            command += 'try: %s = %s\nexcept (NameError, KeyError): %s = %r\n' % (argvar, fixturevar, argvar, funcargs[arg])
+            value = remote_source(funcargs[arg])
+            command += 'try: %s = %s\nexcept (NameError, KeyError): %s = %s\n' % (argvar, fixturevar, argvar, value)
             testargs.append('%s=%s' % (arg, argvar))
             # testargs.append('%s=%r' % (arg, funcargs[arg]))
 
@@ -416,8 +691,11 @@ def pytest_pyfunc_call(pyfuncitem):
             command += 'print(globals())\n'
             print('command:\n', command)
 
+        command = instrument(config, command)
+
+        out = FrameFilter(sys.stdout)
         try:
-            board.exec(command, reset_repl=False, raise_remote=False, out=sys.stdout)
+            board_exec(pyfuncitem.session, command, reset_repl=False, raise_remote=False, out=out)
         except cpboard.CPboardRemoteError as e:
             if debug:
                 print('pytest_pyfunc_call: e=', e)
@@ -430,6 +708,8 @@ def pytest_pyfunc_call(pyfuncitem):
                         e.exc.__traceback__ = e.create_traceback(tb=tb)
                         raise e.exc from None
             raise
+        finally:
+            record_measurements(pyfuncitem.session, out)
 
     return True
 
@@ -448,164 +728,22 @@ def pytest_runtest_teardown(item, nextitem):
     if marker is None:
         return
 
+    batch = getattr(item, 'board_batch', None)
+    if batch:
+        __tracebackhide__ = True
+        batch.replay(item, 'teardown')
+        return
+
     try:
         argnames = item._fixtureinfo.argnames
     except Exception:
         return
 
+    # Deleted by the next command, see board_exec()
     variables = ['funcarg_%s_val' % (arg,) for arg in argnames]
-    delete_variables(item.session.board, variables, debug)
-
-
-def assert_rewrite_module(session, fname):
-    debug = session.config.option.verbose > 2
-    with open(fname) as f:
-        source = f.read()
-
-    s = []
-    changed = False
-    for line in source.splitlines():
-        if re.match(r'\s+assert\s+', line):
-            org = line
-            line = assert_rewrite(line, debug)
-            if line != org:
-                changed = True
-        s.append(line)
-
-    if not changed:
-        return fname
-
-    rewrite = '\n'.join(s)
-    if debug:
-        print('\nassert_rewrite_module(%r)' % fname)
-        print('--------------------------------------------------------------------------------')
-        print(rewrite)
-        print('--------------------------------------------------------------------------------')
-
-    cache_dir = os.path.join(str(session.fspath), ".pytest_board_cache")
-    rel = os.path.relpath(fname, str(session.fspath))
-    dst = os.path.join(cache_dir, rel)
-    if debug:
-        print('dst', dst)
+    delete_variables(item.session, variables)
 
-    try:
-        os.makedirs(os.path.dirname(dst), exist_ok=True)
-    except OSError:
-        return fname
-
-    with open(dst, 'w') as f:
-        f.write(rewrite)
-
-    return dst
-
-
-import token, symbol, parser
-
-
-def assert_rewrite(line, debug):
-    org_line = line
-    map = dict(token.tok_name)
-    map.update(symbol.sym_name)
-
-    # https://stackoverflow.com/a/5454348
-    def shallow(ast):
-        if not isinstance(ast, list):
-            return ast
-        if len(ast) == 2:
-            return shallow(ast[1])
-        return [map[ast[0]]] + [shallow(a) for a in ast[1:]]
-
-    try:
-        ast = shallow(parser.st2list(parser.suite(line.strip())))
-    except SyntaxError as e:
-        if debug:
-            print('assert_rewrite: Parsing error', e)
-        return org_line
-
-    if debug:
-        print('XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX', line)
-        import pprint
-        pprint.pprint(ast)
-
-    try:
-        if ast[0] != 'file_input' or ast[1][0] != 'simple_stmt' or ast[1][1][0] != 'assert_stmt':
-            return org_line
-        simple_stmt = ast[1]
-        comment = simple_stmt[2]
-        assert_stmt = ast[1][1]
-        expression = assert_stmt[2]
-    except IndexError:
-        return org_line
-
-    if len(assert_stmt) > 3:  # Already has a message
-        return org_line
-
-    if debug:
-        print('comment', comment)
-    if comment:
-        line = line[:line.index(comment)].rstrip()
-        if debug:
-            print('new line: %r' % line)
-
-    if debug:
-        print('assert_stmt', len(assert_stmt), assert_stmt)
-        print('expression', expression)
-
-    ws, assrt, rest = line.partition('assert')
-
-    if not isinstance(expression, list):
-        rewrite = ws + '____l = ' + expression + '; assert ____l, "%r" % ____l'
-        return rewrite
-
-    # TODO: expression ['not_test', 'not', 'False']
-    #       expression ['not_test', 'not', ['comparison', '1', '==', '2']]
-    if len(expression) < 4 or expression[0] != 'comparison':
-        return org_line
-
-    # TODO: expression ['comparison', '1', '<=', '1', '<=', '1']
-    if len(expression) > 4:
-        return org_line
-
-    op = expression[2]
-    if debug:
-        print('left', expression[1])
-        print('op', op)
-        print('right', expression[3])
-
-    # TODO: op ['comp_op', 'is', 'not']
-    if isinstance(op, list):
-        return org_line
-
-    # In case of mutiple op's in the line, find the correct one to split on
-
-    def flatten(lst):
-        for e in lst:
-            if isinstance(e, list):
-                yield from flatten(e)
-            else:
-                yield e
-
-    num_ops = list(flatten([expression[1]])).count(op)
-    if debug:
-        print('num_ops', num_ops)
-        print('rest', rest)
-
-    index = -1
-    for num in range(num_ops + 1):
-        index = rest.find(op, index + 1)
-        if debug:
-            print('index', index)
-        if index == -1:
-            return org_line
-
-    left = rest[:index].strip()
-    right = rest[index + len(op):].strip()
-    if debug:
-        print('left: %r' % left)
-        print('right: %r' % right)
-
-    rewrite = ws + '____l = ' + left + '; ____r = ' + right + '; assert ____l ' + op + ' ____r, "%r ' + op + ' %r" % (____l, ____r)'
-    if debug:
-        print('rewrite', rewrite)
 
-    return rewrite
+def pytest_sessionfinish(session):
+    if session.config.option.boarddev:
+        flush_cleanup(session)
@@ -0,0 +1,282 @@
+"""Run the board tests of a module or the whole session with one request (--board-batch)
+
+The tests and their remote fixture graph are handed to the pytest_runner module in boardlib which sets up
+the fixtures, runs the tests and streams back a record for each phase.
+The records are replayed when pytest runs the items so reporting works as usual.
+"""
+
+import ast
+import builtins
+import inspect
+import os
+import time
+
+import cpboard
+
+from _pytest.fixtures import get_direct_param_fixture_func
+
+from .matrix import item_board
+from .recovery import check_board, is_link_error, recover
+from .utils import get_board, board_command
+
+
+def module_name(rpath):
+    return os.path.splitext(os.path.basename(rpath))[0]
+
+
+def remote_fixtures(item):
+    """Return the remote fixture graph needed by item or None if it depends on host fixtures"""
+    params = getattr(item, 'callspec', None)
+    params = params.params if params else {}
+    graph = {}
+    for name in item._fixtureinfo.names_closure:
+        if name == 'request' or name in params:
+            continue
+        fixturedefs = item._fixtureinfo.name2fixturedefs.get(name)
+        if not fixturedefs:
+            return None
+        fixturedef = fixturedefs[-1]
+        if fixturedef.func is get_direct_param_fixture_func:
+            continue
+        if not getattr(fixturedef, 'rpath', ''):
+            return None
+        func = getattr(fixturedef.func, '__wrapped_fixture__', fixturedef.func)
+        path = os.path.join(str(item.session.fspath), fixturedef.baseid)
+        graph[name] = (fixturedef.rpath, path, func.__name__, tuple(fixturedef.argnames), fixturedef.scope,
+                       inspect.isgeneratorfunction(func))
+    return graph
+
+
+def make_batches(session):
+    """Group the board items per module or session (and board in a matrix) and attach a BoardBatch"""
+    per_module = session.config.option.board_batch == 'module'
+    batches = []
+    groups = {}
+    for item in session.items:
+        if item.get_marker('board') is None:
+            continue
+        key = (str(item.fspath) if per_module else None, item_board(item))
+        if key not in groups:
+            groups[key] = BoardBatch(session)
+            batches.append(groups[key])
+        groups[key].items.append(item)
+
+    # Batches using host fixtures on the board are run the normal way
+    batches = [batch for batch in batches if batch.prepare()]
+    last = {}
+    for batch in batches:
+        last[item_board(batch.items[0])] = batch
+        for item in batch.items:
+            item.board_batch = batch
+    for batch in last.values():
+        batch.last = True
+    return batches
+
+
+class BatchReader:
+    """Parse the frames from pytest_runner as they arrive"""
+    def __init__(self):
+        self.records = {}
+        self.memory = {}
+        self.frame = None
+        self.output = []
+        self.tb = None
+
+    def write(self, data):
+        while data:
+            if self.frame is None:
+                text, sep, data = data.partition('\x1e')
+                if text:
+                    self.output.append(text.replace('\r\n', '\n'))
+                if sep:
+                    self.frame = ''
+            else:
+                text, sep, data = data.partition('\x1f')
+                self.frame += text
+                if sep:
+                    self.handle(self.frame[:1], self.frame[1:])
+                    self.frame = None
+
+    def handle(self, kind, payload):
+        if kind == 'S':
+            self.output = []
+        elif kind == 'E':
+            self.tb = payload.replace('\r\n', '\n')
+        elif kind == 'R':
+            index, when, outcome, duration, exc, where = ast.literal_eval(payload)
+            self.records[(index, when)] = (outcome, duration / 1e9, ''.join(self.output), exc, where, self.tb)
+            self.output = []
+            self.tb = None
+        elif kind == 'M':
+            values = ast.literal_eval(payload)
+            self.memory[tuple(values[:2])] = values[2:]
+
+
+class BoardBatch:
+    def __init__(self, session):
+        self.session = session
+        self.items = []
+        self.last = False
+        self.ran = False
+        self.reader = None
+        self.error = None
+        self.recovery = None
+        # The request time and the phase that made the request (--board-durations)
+        self.elapsed = 0.0
+        self.trigger = None
+
+    def prepare(self):
+        self.fixtures = {}
+        self.modules = []
+        self.paths = {}
+        for item in self.items:
+            graph = remote_fixtures(item)
+            if graph is None:
+                return False
+            self.fixtures.update(graph)
+            self.add_module(item.rpath, str(item.fspath))
+        for rpath, path, _, _, _, _ in self.fixtures.values():
+            self.add_module(rpath, path)
+        return True
+
+    def add_module(self, rpath, path):
+        modname = module_name(rpath)
+        if modname not in self.paths:
+            self.modules.append((modname, os.path.dirname(rpath)))
+            self.paths[modname + '.py'] = path
+
+    def command(self):
+        fixtures = []
+        for name, (rpath, _, funcname, argnames, scope, gen) in sorted(self.fixtures.items()):
+            fixtures.append('%r: %r' % (name, (module_name(rpath), funcname, argnames, scope, gen)))
+
+        tests = []
+        for item in self.items:
+            params = getattr(item, 'callspec', None)
+            params = params.params if params else {}
+            fixturenames = [name for name in item._fixtureinfo.names_closure if name in self.fixtures]
+            # The parameter values are inserted as source
+            values = ', '.join('%r: %r' % (key, val) for key, val in sorted(params.items()))
+            tests.append('(%r, %r, %r, %r, %r, {%s})' % (
+                module_name(item.rpath), item.cls.__name__ if item.cls else None, item.obj.__name__,
+                tuple(item._fixtureinfo.argnames), tuple(fixturenames), values))
+
+        return 'import pytest_runner\npytest_runner.run(%r, {%s}, [%s], %r, %r)\n' % (
+            self.modules, ', '.join(fixtures), ',\n'.join(tests), self.last,
+            bool(self.session.config.option.board_memory))
+
+    def run(self, board):
+        self.ran = True
+        self.reader = BatchReader()
+        cleanup = list(self.session.board_cleanup)
+        command = board_command(self.session, self.command())
+        if self.session.config.option.verbose > 1:
+            print('command:\n', command)
+        start = time.monotonic()
+        try:
+            check_board(self.session)
+        except cpboard.CPboardError as e:
+            self.error = e
+            return
+        try:
+            board.exec(command, reset_repl=False, raise_remote=False, out=self.reader,
+                       timeout=self.session.config.option.board_timeout)
+        except cpboard.CPboardRemoteError as e:
+            self.error = e
+        except (cpboard.CPboardError, OSError) as e:
+            self.error = e
+            if self.session.config.option.board_recover_timeout and is_link_error(e):
+                if recover(self.session, e, cleanup):
+                    self.resume()
+                # It goes with the phase that didn't finish, see replay()
+                self.recovery = self.session.board_recovery.pop()
+        finally:
+            self.elapsed = time.monotonic() - start
+
+    def resume(self):
+        """Run the tests after the one that didn't finish in a new batch on the recovered board"""
+        unfinished = [index for index in range(len(self.items)) if (index, 'teardown') not in self.reader.records]
+        rest = self.items[unfinished[0] + 1:] if unfinished else []
+        if not rest:
+            return
+        batch = BoardBatch(self.session)
+        batch.items = rest
+        batch.last = self.last
+        if batch.prepare():
+            for item in rest:
+                item.board_batch = batch
+
+    def record(self, item, when):
+        index = self.items.index(item)
+        if not self.ran:
+            self.trigger = (index, when)
+            self.run(get_board(self.session))
+        return self.reader.records.get((index, when))
+
+    def replay(self, item, when):
+        """Print the output of a phase and raise its exception"""
+        __tracebackhide__ = True
+        record = self.record(item, when)
+        if record is None:
+            # The phase before finished but not this one
+            previous = {'call': 'setup', 'teardown': 'call'}.get(when)
+            if previous is None or self.error is not None and self.record(item, previous) is not None:
+                if isinstance(self.error, cpboard.CPboardRemoteError):
+                    self.raise_remote(self.error)
+                if self.recovery is not None:
+                    self.session.board_recovery.append(self.recovery)
+                    self.recovery = None
+                raise cpboard.CPboardError('No result from board: %s' % (self.error or 'the runner stopped',))
+            return None
+        outcome, duration, output, exc, where, tb = record
+        if output:
+            print(output, end='')
+        if outcome == 'failed':
+            self.raise_failure(exc, where, tb)
+        return record
+
+    def raise_failure(self, exc, where, tb):
+        __tracebackhide__ = True
+        exc_type = getattr(builtins, exc[0], None)
+        if not (isinstance(exc_type, type) and issubclass(exc_type, BaseException)):
+            self.raise_remote(cpboard.CPboardRemoteError(tb or '%s: %s' % exc))
+        e = exc_type(exc[1]) if exc[1] else exc_type()
+        if where and where[0] in self.paths:
+            traceback = cpboard.CPboardRemoteError('').create_traceback(tb=[(self.paths[where[0]],) + tuple(where[1:])])
+            raise e.with_traceback(traceback) from None
+        raise e from cpboard.CPboardRemoteError(tb or '')
+
+    def raise_remote(self, e):
+        __tracebackhide__ = True
+        if e.exc:
+            for fname, lineno, name in e.tb:
+                path = self.paths.get(os.path.basename(fname))
+                if path:
+                    e.exc.__traceback__ = e.create_traceback(tb=[(path, lineno, name)])
+                    raise e.exc from None
+            raise e.exc from e
+        raise e
+
+    def memory(self, item, when):
+        """Return the heap measurement of a phase: (free, alloc, free, alloc, wider)"""
+        return self.reader.memory.get((self.items.index(item), when)) if self.reader else None
+
+    def duration(self, item, when):
+        record = self.reader.records.get((self.items.index(item), when)) if self.reader else None
+        return record[1] if record else None
+
+    def request_share(self, item, when):
+        """Split the request time over the phases of the batch
+
+        Each phase gets its board duration and an equal part of the rest (transfer and runner overhead).
+        Returns the share of the phase, its round trips and the request time spent during the phase.
+        """
+        index = self.items.index(item)
+        trigger = self.trigger == (index, when)
+        records = self.reader.records if self.reader else {}
+        record = records.get((index, when))
+        share = 0.0
+        if record is not None:
+            overhead = max(self.elapsed - sum(rec[1] for rec in records.values()), 0.0)
+            share = record[1] + overhead / len(records)
+        return share, int(trigger), self.elapsed if trigger else 0.0
@@ -0,0 +1,211 @@
+"""Microbenchmarks on the board (board_benchmark fixture)
+
+The callable is run in a tight loop on the board and timed there with time.monotonic_ns(), so the
+serial link is not part of the measurement. The number of iterations per round is doubled until a round
+takes ROUND_TIME. Each round also times the same loop calling an empty function with the same
+arguments, this baseline (loop and call overhead) is subtracted from the round.
+
+    def test_crc(board_benchmark):
+        stats = board_benchmark('crc.crc16', b'123456789', setup='import crc')
+        assert stats['median'] < 0.001
+
+--board-benchmark-json=PATH saves the results, --board-benchmark-compare=PATH shows the change of the
+median compared to a saved file.
+"""
+
+import ast
+import collections
+import json
+import platform
+import statistics
+import sys
+import time
+
+from .remote import FrameFilter, RemoteObject, remote_source
+from .utils import board_exec, delete_variables
+
+ROUNDS = 5
+ROUND_TIME = 0.1
+MAX_ITERATIONS = 10000000
+STATS = ('min', 'max', 'mean', 'median', 'stddev', 'rounds', 'iterations', 'baseline')
+
+VARIABLES = ['____now', '____loop', '____empty', '____f', '____a', '____k', '____n', '____t']
+
+HELPERS = ('import time\n'
+           '____now = getattr(time, "monotonic_ns", None) or (lambda: int(time.monotonic() * 1000000000))\n'
+           'def ____loop(f, a, k, n):\n'
+           '    r = range(n)\n'
+           '    t = ____now()\n'
+           '    for _ in r:\n'
+           '        f(*a, **k)\n'
+           '    return ____now() - t\n'
+           'def ____empty(*a, **k):\n'
+           '    pass\n')
+
+
+def calibrate_command(target_ns, iterations):
+    """Double the iterations until a loop takes target_ns, unless iterations is given"""
+    command = '____n = %d\n' % (iterations or 1,)
+    command += '____t = ____loop(____f, ____a, ____k, ____n)\n'
+    if not iterations:
+        command += ('while ____t < %d and ____n < %d:\n'
+                    '    ____n *= 2\n'
+                    '    ____t = ____loop(____f, ____a, ____k, ____n)\n' % (target_ns, MAX_ITERATIONS))
+    command += 'print("\\x1eB%r\\x1f" % ((____n, ____t),), end="")\n'
+    return command
+
+
+def rounds_command(rounds):
+    return ('print("\\x1eB%%r\\x1f" %% ([(____loop(____f, ____a, ____k, ____n), '
+            '____loop(____empty, ____a, ____k, ____n)) for _ in range(%d)],), end="")\n' % (rounds,))
+
+
+def board_expression(func):
+    if isinstance(func, str):
+        return func
+    if isinstance(func, RemoteObject):
+        return remote_source(func)
+    raise TypeError('board_benchmark needs a board expression or a RemoteObject, got %r' % (func,))
+
+
+def summarize(iterations, rounds):
+    """Return the stats in seconds per iteration of the (loop ns, baseline ns) rounds"""
+    times = [max(t - baseline, 0) / iterations / 1e9 for t, baseline in rounds]
+    return collections.OrderedDict([
+        ('min', min(times)),
+        ('max', max(times)),
+        ('mean', statistics.mean(times)),
+        ('median', statistics.median(times)),
+        ('stddev', statistics.stdev(times) if len(times) > 1 else 0.0),
+        ('rounds', len(times)),
+        ('iterations', iterations),
+        ('baseline', statistics.median(baseline for _, baseline in rounds) / iterations / 1e9),
+    ])
+
+
+class BoardBenchmark:
+    """Run a board callable in a calibrated loop, see the module docstring"""
+    def __init__(self, item):
+        self.item = item
+        self.stats = None
+
+    def __call__(self, func, *args, **kwargs):
+        return self.pedantic(func, args=args, kwargs=kwargs)
+
+    def pedantic(self, func, args=(), kwargs=None, setup=None, rounds=ROUNDS, iterations=None,
+                 round_time=ROUND_TIME, timeout=10):
+        """Benchmark func with more control
+
+        func: Board expression (like 'module.func') or a RemoteObject
+        setup: Code run on the board first (like imports)
+        iterations: Calls per round, calibrated to take round_time if not given
+        timeout: Timeout for the calibration, the rounds get a timeout based on it
+        """
+        if self.stats is not None:
+            raise RuntimeError('board_benchmark can only be used once per test')
+        if rounds < 1:
+            raise ValueError('rounds has to be at least 1')
+
+        session = self.item.session
+        command = HELPERS
+        if setup:
+            command += setup.rstrip() + '\n'
+        command += '____f = %s\n' % (board_expression(func),)
+        command += '____a = (%s)\n' % (''.join('%s, ' % (remote_source(arg),) for arg in args),)
+        command += '____k = {%s}\n' % (', '.join('%r: %s' % (key, remote_source(val))
+                                                 for key, val in sorted((kwargs or {}).items())),)
+        command += calibrate_command(int(round_time * 1e9), iterations)
+
+        try:
+            out = FrameFilter(sys.stdout)
+            board_exec(session, command, reset_repl=False, raise_remote=True, timeout=timeout, out=out)
+            iterations, elapsed = ast.literal_eval(out.frames['B'])
+
+            # Function and baseline loop per round with a good margin
+            timeout = max(timeout, 4 * rounds * elapsed / 1e9 + 5)
+            out = FrameFilter(sys.stdout)
+            board_exec(session, rounds_command(rounds), reset_repl=False, raise_remote=True, timeout=timeout, out=out)
+            measured = ast.literal_eval(out.frames['B'])
+        finally:
+            delete_variables(session, VARIABLES)
+
+        self.stats = summarize(iterations, measured)
+        self.item.board_benchmark = self.stats
+        return self.stats
+
+
+def format_time(seconds):
+    return '%.3f' % (seconds * 1e6,)
+
+
+def load_results(path):
+    """Return the stats by test name of a saved --board-benchmark-json file"""
+    with open(path) as f:
+        data = json.load(f)
+    return dict((bench['name'], bench['stats']) for bench in data.get('benchmarks', []))
+
+
+def ordered_stats(stats):
+    """The stats in the order of summarize(), they are sent as a dict with the reports"""
+    return collections.OrderedDict((key, stats[key]) for key in STATS if key in stats)
+
+
+def save_results(config, path, results):
+    data = collections.OrderedDict([
+        ('board', config.option.boarddev),
+        ('host', platform.node()),
+        ('python', platform.python_version()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('benchmarks', [collections.OrderedDict([('name', name), ('stats', ordered_stats(stats))])
+                        for name, stats in sorted(results.items())]),
+    ])
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+class BenchmarkResults:
+    """Collect the board_benchmark results from the reports, save and show them"""
+    def __init__(self, config):
+        self.config = config
+        self.results = {}
+
+    def pytest_runtest_logreport(self, report):
+        stats = getattr(report, 'board_benchmark', None)
+        if stats:
+            self.results[report.nodeid] = stats
+
+    def pytest_sessionfinish(self, session):
+        path = self.config.option.board_benchmark_json
+        if path and self.results:
+            save_results(self.config, path, self.results)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if self.results:
+            benchmark_summary(terminalreporter, self.results)
+
+
+def benchmark_summary(terminalreporter, results):
+    config = terminalreporter.config
+    tr = terminalreporter
+    compare = {}
+    if config.option.board_benchmark_compare:
+        try:
+            compare = load_results(config.option.board_benchmark_compare)
+        except (OSError, ValueError) as e:
+            tr.write_line('board benchmark: failed to load %s: %s' % (config.option.board_benchmark_compare, e))
+
+    tr.write_sep('=', 'board benchmark (times in us)')
+    tr.write_line('%10s %10s %10s %10s %6s %10s %8s  %s' % (
+        'min', 'median', 'max', 'stddev', 'rounds', 'iterations', 'change', 'name'))
+    for name, stats in sorted(results.items()):
+        change = ''
+        old = compare.get(name)
+        if old and old.get('median'):
+            change = '%+.1f%%' % ((stats['median'] / old['median'] - 1) * 100,)
+        elif old:
+            change = 'n/a'
+        tr.write_line('%10s %10s %10s %10s %6d %10d %8s  %s' % (
+            format_time(stats['min']), format_time(stats['median']), format_time(stats['max']),
+            format_time(stats['stddev']), stats['rounds'], stats['iterations'], change, name))
+    if config.option.board_benchmark_json:
+        tr.write_line('results saved to %s' % (config.option.board_benchmark_json,))
@@ -0,0 +1,240 @@
+"""
+pytest_runner: Test runner used by the pytest-circuitpython plugin (--board-batch)
+
+It's kept apart from the pytest module so only batch runs pay for it in memory.
+
+The results are sent as frames, \x1e <kind> <payload> \x1f, anything outside a frame is test output:
+    S<index>                                    Test started
+    E<traceback>                                The phase failed
+    R(index, when, outcome, ns, exc, where)     Phase result, exc is (name, message) and
+                                                where is (file, line, function) of the failure
+    M(index, when, free, alloc, free, alloc, wider)
+                                                Heap before and after the phase (memory=True), wider is
+                                                what the fixtures with a wider scope than function took
+"""
+
+import gc
+import os
+import sys
+import time
+
+from pytest import OutcomeException
+
+try:
+    _now = time.monotonic_ns
+except AttributeError:
+    def _now():
+        return int(time.monotonic() * 1000000000)
+
+try:
+    from io import StringIO
+except ImportError:
+    StringIO = None
+
+# Session scoped fixtures live on between runs
+_session = {}
+_session_stack = []
+
+
+def _frame(kind, payload):
+    print('\x1e%s%s\x1f' % (kind, payload), end='')
+
+
+def _mem():
+    gc.collect()
+    try:
+        return gc.mem_free(), gc.mem_alloc()
+    except AttributeError:  # CPython
+        return None
+
+
+def _where(tb, files):
+    where = None
+    for line in tb.split('\n'):
+        line = line.strip()
+        if not line.startswith('File "'):
+            continue
+        fname, rest = line[6:].split('"', 1)
+        fname = fname.split('/')[-1]
+        parts = rest.split(', ')
+        if fname in files and len(parts) > 1:
+            where = (fname, int(parts[1][5:]), parts[2][3:] if len(parts) > 2 else None)
+    return where
+
+
+def _print_exception(e, f=sys.stdout):
+    try:
+        sys.print_exception(e, f)
+    except AttributeError:  # CPython
+        import traceback
+        traceback.print_exception(type(e), e, e.__traceback__, file=f)
+
+
+def _exception(e, files):
+    """Print the traceback and return the exception and where it happened"""
+    if StringIO is None:
+        tb = ''
+        print('\x1eE', end='')
+        _print_exception(e)
+        print('\x1f', end='')
+    else:
+        buf = StringIO()
+        _print_exception(e, buf)
+        tb = buf.getvalue()
+        _frame('E', tb)
+    return (type(e).__name__, str(e)), _where(tb, files)
+
+
+class _Runner:
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.values = {}
+        self.stack = []
+        self.wider = 0
+
+    def fixture(self, name, params):
+        if name in params:
+            return params[name]
+        if name == 'request':
+            return 'request'  # dummy value
+        if name in self.values:
+            return self.values[name]
+        if name in _session:
+            return _session[name]
+        modname, funcname, argnames, scope, gen = self.fixtures[name]
+        kwargs = {}
+        for arg in argnames:
+            kwargs[arg] = self.fixture(arg, params)
+        alloc = _alloc() if scope != 'function' else None
+        res = getattr(sys.modules[modname], funcname)(**kwargs)
+        it = None
+        if gen:
+            it = res
+            res = next(it)
+        if alloc is not None:
+            self.wider += _alloc() - alloc
+        if scope == 'session':
+            _session[name] = res
+            _session_stack.append((name, it))
+        else:
+            self.values[name] = res
+            self.stack.append((name, scope, it))
+        return res
+
+    def finish(self, scopes):
+        """Tear down the fixtures in scopes, return the last exception"""
+        error = None
+        while self.stack and self.stack[-1][1] in scopes:
+            name, scope, it = self.stack.pop()
+            del self.values[name]
+            error = _close(it) or error
+        return error
+
+
+def _close(it):
+    if it is not None:
+        try:
+            next(it)
+        except StopIteration:
+            pass
+        except (Exception, OutcomeException) as e:
+            return e
+    return None
+
+
+def teardown_session():
+    error = None
+    while _session_stack:
+        name, it = _session_stack.pop()
+        del _session[name]
+        error = _close(it) or error
+    return error
+
+
+def _alloc():
+    try:
+        return gc.mem_alloc()
+    except AttributeError:
+        return None
+
+
+def _measure(runner, index, when, before):
+    if before is not None:
+        after = _mem()
+        _frame('M', repr((index, when) + before + after + (runner.wider,)))
+        runner.wider = 0
+
+
+def _result(index, when, start, error, files):
+    exc = where = None
+    if error is not None:
+        exc, where = _exception(error, files)
+    _frame('R', repr((index, when, 'failed' if error else 'passed', _now() - start, exc, where)))
+
+
+def run(modules, fixtures, tests, last=False, memory=False):
+    """Run tests: (module, class, function, argnames, fixturenames, params)
+
+    The modules (name, directory) are imported first. fixtures maps a fixture name to
+    (module, function, argnames, scope, generator).
+    The class, module and session scopes end when the next test doesn't share them.
+    memory: Measure the heap around each phase
+    """
+    files = []
+    for modname, path in modules:
+        files.append(modname + '.py')
+        sys.modules.pop(modname, None)
+        gc.collect()
+        os.chdir(path)
+        __import__(modname)
+
+    runner = _Runner(fixtures)
+    instances = {}
+    for index, (modname, clsname, funcname, argnames, fixturenames, params) in enumerate(tests):
+        _frame('S', index)
+
+        before = _mem() if memory else None
+        start = _now()
+        error = None
+        try:
+            for name in fixturenames:
+                runner.fixture(name, params)
+        except (Exception, OutcomeException) as e:
+            error = e
+        _measure(runner, index, 'setup', before)
+        _result(index, 'setup', start, error, files)
+
+        if error is None:
+            before = _mem() if memory else None
+            start = _now()
+            try:
+                obj = sys.modules[modname]
+                if clsname:
+                    key = (modname, clsname)
+                    if key not in instances:
+                        instances[key] = getattr(obj, clsname)()
+                    obj = instances[key]
+                kwargs = {}
+                for arg in argnames:
+                    kwargs[arg] = runner.fixture(arg, params)
+                getattr(obj, funcname)(**kwargs)
+            except (Exception, OutcomeException) as e:
+                error = e
+            _measure(runner, index, 'call', before)
+            _result(index, 'call', start, error, files)
+
+        before = _mem() if memory else None
+        start = _now()
+        nxt = tests[index + 1] if index + 1 < len(tests) else None
+        scopes = ['function']
+        if nxt is None or nxt[:2] != (modname, clsname):
+            scopes.append('class')
+        if nxt is None or nxt[0] != modname:
+            scopes.append('module')
+        error = runner.finish(scopes)
+        if nxt is None and last:
+            error = teardown_session() or error
+        _measure(runner, index, 'teardown', before)
+        _result(index, 'teardown', start, error, files)
+        del error
+        gc.collect()
@@ -0,0 +1,164 @@
+"""Collect the test_board_ modules without importing them on the host (--board-collect=static)
+
+The module is reduced to what collection needs: the pytest imports, functions and classes with their
+decorators and signatures but with empty bodies, and the assignments that only use names already kept
+(parametrize data). A function body is gone in the stub, so an assignment calling a function of the
+module is left out, and a module with decorators calling one is imported. The result is compiled with
+the file name and line numbers of the original and cached in .pytest_board_cache/collect by the hash
+of the source.
+A module that needs more than that on the host (like a decorator using another import) is imported
+the usual way.
+"""
+
+import ast
+import builtins
+import hashlib
+import marshal
+import os
+import sys
+import types
+
+BUILTINS = set(dir(builtins))
+
+
+def none_node():
+    return ast.parse('None').body[0].value
+
+
+def is_generator(node):
+    nodes = list(node.body)
+    while nodes:
+        child = nodes.pop()
+        if isinstance(child, (ast.Yield, ast.YieldFrom)):
+            return True
+        if not isinstance(child, (ast.FunctionDef, ast.Lambda, ast.ClassDef)):
+            nodes.extend(ast.iter_child_nodes(child))
+    return False
+
+
+def names_used(node):
+    return set(child.id for child in ast.walk(node) if isinstance(child, ast.Name))
+
+
+def calls_stub(node, stubbed):
+    """Return True if node calls one of the stubbed functions"""
+    return any(isinstance(child, ast.Call) and isinstance(child.func, ast.Name) and child.func.id in stubbed
+               for child in ast.walk(node))
+
+
+def check_decorators(node, stubbed):
+    for decorator in node.decorator_list:
+        if (isinstance(decorator, ast.Name) and decorator.id in stubbed) or calls_stub(decorator, stubbed):
+            raise ValueError('decorator of %s calls a function of the module' % (node.name,))
+
+
+def stub_function(node):
+    body = ast.Expr(value=ast.Yield(value=None)) if is_generator(node) else ast.Pass()
+    node.body = [ast.copy_location(body, node)]
+    node.returns = None
+    args = node.args
+    # Only the presence of a default matters to pytest
+    args.defaults = [ast.copy_location(none_node(), default) for default in args.defaults]
+    args.kw_defaults = [default and ast.copy_location(none_node(), default) for default in args.kw_defaults]
+    for arg in getattr(args, 'posonlyargs', []) + args.args + args.kwonlyargs + [args.vararg, args.kwarg]:
+        if arg is not None:
+            arg.annotation = None
+    return node
+
+
+def stub_body(body, defined, stubbed=None):
+    """Return the stub of body, raise ValueError if the module has to be imported"""
+    stubbed = set() if stubbed is None else stubbed
+    stubs = []
+    for node in body:
+        if isinstance(node, ast.Import):
+            node.names = [alias for alias in node.names if alias.name.split('.')[0] == 'pytest']
+            if not node.names:
+                continue
+            defined.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            if node.level or not node.module or node.module.split('.')[0] != 'pytest':
+                continue
+            defined.update(alias.asname or alias.name for alias in node.names)
+        elif isinstance(node, ast.FunctionDef):
+            check_decorators(node, stubbed)
+            node = stub_function(node)
+            defined.add(node.name)
+            stubbed.add(node.name)
+        elif isinstance(node, ast.ClassDef):
+            check_decorators(node, stubbed)
+            node.body = stub_body(node.body, set(defined), set(stubbed)) or [ast.copy_location(ast.Pass(), node)]
+            defined.add(node.name)
+        elif isinstance(node, ast.Assign):
+            if not names_used(node.value) <= defined | BUILTINS or calls_stub(node.value, stubbed):
+                continue
+            targets = [target for target in node.targets if isinstance(target, ast.Name)]
+            if len(targets) != len(node.targets):
+                continue
+            defined.update(target.id for target in targets)
+        else:
+            continue
+        stubs.append(node)
+    return stubs
+
+
+def stub_code(source, path):
+    """Return the code object of the stub module"""
+    tree = ast.parse(source, path)
+    tree.body = stub_body(tree.body, set())
+    return compile(ast.fix_missing_locations(tree), path, 'exec', dont_inherit=True)
+
+
+def implementation_hash():
+    with open(__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def cached_stub_code(session, path):
+    """Return the code object of the stub module of path, None if it can't be parsed"""
+    with open(path, 'rb') as f:
+        source = f.read()
+    key = hashlib.sha1(source)
+    key.update(path.encode())
+    key.update(implementation_hash().encode())
+    cache = os.path.join(str(session.fspath), '.pytest_board_cache', 'collect',
+                         '%s.%s' % (key.hexdigest(), sys.implementation.cache_tag))
+
+    try:
+        with open(cache, 'rb') as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    try:
+        code = stub_code(source, path)
+    except (SyntaxError, ValueError):
+        return None
+
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = '%s.%d' % (cache, os.getpid())
+        with open(tmp, 'wb') as f:
+            marshal.dump(code, f)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    return code
+
+
+def static_module(session, path):
+    """Return a module object for path made from its stub, None if it has to be imported"""
+    path = str(path)
+    code = cached_stub_code(session, path)
+    if code is None:
+        return None
+
+    module = types.ModuleType(os.path.splitext(os.path.basename(path))[0])
+    module.__file__ = path
+    try:
+        exec(code, module.__dict__)
+    except Exception:
+        return None
+    # Like an import, inspect needs it to find the source of the classes
+    sys.modules[module.__name__] = module
+    return module
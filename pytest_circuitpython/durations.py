@@ -0,0 +1,106 @@
+"""On-board durations (--board-durations=N)
+
+The board fixture and test commands are timed on the board with time.monotonic_ns() and the time comes
+back in a T frame in the same round trip. The batch runner times each phase the same way.
+The host times each request to the board (see board_exec()). A batch request is split over the phases
+of the batch, each gets its board duration and an equal part of the rest (see BoardBatch.request_share()).
+
+Each phase report gets board_timing = (total, board, link, round trips) with the times in seconds:
+    total   Host wall time of the phase
+    board   Time spent running the code on the board
+    link    Time of the requests to the board minus the board time (serial transfer, REPL handling)
+The rest (total - board - link) is host overhead.
+"""
+
+import ast
+
+
+def timed_command(command):
+    """Time command on the board"""
+    body = ''.join('    %s\n' % (line,) for line in command.splitlines() if line.strip()) or '    pass\n'
+    return ('import time\n'
+            '____now = getattr(time, "monotonic_ns", None) or (lambda: int(time.monotonic() * 1000000000))\n'
+            '____t = ____now()\n'
+            'try:\n%s'
+            'finally:\n'
+            '    print("\\x1eT%%d\\x1f" %% (____now() - ____t,), end="")\n'
+            '    del ____now, ____t\n' % (body,))
+
+
+class Timing:
+    """The board time and round trips since the last phase"""
+    def __init__(self):
+        self.board = 0.0
+        self.link = 0.0
+        self.round_trips = 0
+
+    def round_trip(self, seconds, count=1):
+        self.link += seconds
+        self.round_trips += count
+
+    def add_board(self, seconds):
+        self.board += seconds
+
+    def end_phase(self):
+        res = (self.board, max(self.link - self.board, 0.0), self.round_trips)
+        self.__init__()
+        return res
+
+
+def add_board_time(session, payload):
+    """Add the T frame payload (ns) or a number of seconds to the board time"""
+    timing = getattr(session, 'board_timing', None)
+    if timing is None or payload is None:
+        return
+    try:
+        seconds = ast.literal_eval(payload) / 1e9 if isinstance(payload, str) else payload
+    except (ValueError, SyntaxError):
+        return
+    timing.add_board(seconds)
+
+
+def end_timing_phase(item, call, report):
+    """Attach the board time and round trips of the phase to its report"""
+    timing = getattr(item.session, 'board_timing', None)
+    if timing is None:
+        return
+    total = call.stop - call.start
+    batch = getattr(item, 'board_batch', None)
+    if batch:
+        # The phase gets its share of the batch request instead of the request it happened to make
+        share, round_trips, elapsed = batch.request_share(item, call.when)
+        timing.round_trip(share, round_trips)
+        total += share - elapsed
+    board, link, round_trips = timing.end_phase()
+    if round_trips or board:
+        report.board_timing = (total, board, link, round_trips)
+
+
+def durations_summary(terminalreporter):
+    durations = terminalreporter.config.option.board_durations
+    verbose = terminalreporter.config.getvalue('verbose')
+    tr = terminalreporter
+    dlist = []
+    for replist in tr.stats.values():
+        for rep in replist:
+            if hasattr(rep, 'board_timing'):
+                dlist.append(rep)
+    if not dlist:
+        return
+    dlist.sort(key=lambda rep: rep.board_timing[0], reverse=True)
+    if not durations:
+        tr.write_sep('=', 'slowest board durations')
+    else:
+        tr.write_sep('=', 'slowest %s board durations' % durations)
+        dlist = dlist[:durations]
+
+    tr.write_line('%8s %8s %8s %8s %6s' % ('total', 'board', 'link', 'host', 'trips'))
+    for rep in dlist:
+        total, board, link, round_trips = rep.board_timing
+        if verbose < 2 and total < 0.005:
+            tr.write_line('')
+            tr.write_line('(0.00 durations hidden.  Use -vv to show these durations.)')
+            break
+        nodeid = rep.nodeid.replace('::()::', '::')
+        tr.write_line('%7.3fs %7.3fs %7.3fs %7.3fs %6d %-8s %s' % (
+            total, board, link, max(total - board - link, 0.0), round_trips, rep.when, nodeid))
@@ -1,5 +1,6 @@
 import pytest
 from .utils import get_board
+from .benchmark import BoardBenchmark
 
 
 @pytest.fixture(scope='session')
@@ -8,3 +9,20 @@ def board(request):
     Return a cpboard.CPboard instance (session scope)
     """
     return get_board(request.session)
+
+
+@pytest.fixture(scope='session')
+def board_name(request):
+    """
+    Return the board label, parametrized per board with --board-matrix (session scope)
+    """
+    return request.config.option.boarddev
+
+
+@pytest.fixture
+def board_benchmark(request):
+    """
+    Return a callable benchmarking a board function in a loop timed on the board (see benchmark.py)
+    """
+    get_board(request.session)
+    return BoardBenchmark(request.node)
@@ -0,0 +1,284 @@
+"""Host overhead benchmarks (python -m pytest_circuitpython.hostbench)
+
+Measures the time spent on the host side of running board tests, without any hardware:
+    read_until    REPL.read_until() throughput reading from a pty loopback
+    eval          Decoding large eval and unpickle results
+    rewrite       Assert rewriting of large test modules
+    copy          ReplDisk.copy() to the board
+    session       End-to-end per test overhead of a pytest session with trivial board tests
+
+copy and session run on the simulated board (--board sim:) unless another board is given.
+The results are printed as a table or written as JSON (--json) to track them over time:
+
+    $ python3 -m pytest_circuitpython.hostbench --json hostbench.json
+"""
+
+import collections
+import json
+import os
+import pty
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tty
+import xml.etree.ElementTree as ET
+
+import serial
+
+import cpboard
+
+from .rewrite import rewrite_asserts
+
+GROUPS = ('read_until', 'eval', 'rewrite', 'copy', 'session')
+
+TEST_MODULE = 'test_board_hostbench.py'
+
+
+class Loopback:
+    """A pty standing in for the board serial port, the REPL reads back what is fed to it"""
+    def __init__(self):
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.serial = serial.Serial(os.ttyname(slave), timeout=1)
+        os.close(slave)
+        self.thread = None
+
+    def feed(self, data):
+        """Write data in the background, the pty buffer is smaller than the data"""
+        def write():
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.master, view):]
+
+        self.thread = threading.Thread(target=write, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        if self.thread:
+            self.thread.join()
+        self.serial.close()
+        os.close(self.master)
+
+
+def measure(results, name, func, repeat, nbytes=None, out=None):
+    """Time func repeat times and add the percentiles to results, errors are recorded in their place"""
+    if out:
+        print('%-20s' % name, end='', file=out, flush=True)
+    times = []
+    try:
+        for _ in range(repeat):
+            start = time.monotonic()
+            func()
+            times.append(time.monotonic() - start)
+    except (Exception, cpboard.CPboardError) as e:
+        results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+    else:
+        results[name] = cpboard.percentiles(times)
+        if nbytes:
+            results[name]['bytes'] = nbytes
+            results[name]['bytes_per_s'] = nbytes / results[name]['p50']
+    if out:
+        print(' done', file=out, flush=True)
+
+
+def bench_read_until(results, repeat, sizes=(1, 16, 64), out=None):
+    loopback = Loopback()
+    repl = cpboard.REPL(loopback)
+    try:
+        for size in sizes:
+            data = b'x' * (size * 1024 - 4) + b'>>> '
+
+            def read():
+                repl.session = b''
+                loopback.feed(data)
+                repl.read_until(b'>>> ')
+
+            measure(results, 'read_until_%dk' % size, read, repeat, nbytes=len(data), out=out)
+    finally:
+        loopback.close()
+
+
+def bench_eval(results, repeat, out=None):
+    values = collections.OrderedDict([
+        ('list_10000', list(range(10000))),
+        ('str_64k', 'a' * 65536),
+        ('bytes_64k', bytes(range(256)) * 256),
+        ('dict_1000', dict(('key%d' % i, [i, str(i)]) for i in range(1000))),
+    ])
+    for name, value in values.items():
+        output = repr(value).encode('utf8')
+        # Like CPboard.eval() and the RemoteCall results
+        measure(results, 'eval_%s' % name, lambda: eval(str(output, encoding='utf8')), repeat,
+                nbytes=len(output), out=out)
+        measure(results, 'unpickle_%s' % name, lambda: cpboard.unpickle(output.decode('utf8')), repeat,
+                nbytes=len(output), out=out)
+
+    # The namedtuple fallback
+    output = 'struct_time(%s)' % ', '.join('tm_%d=%d' % (i, i) for i in range(100))
+    measure(results, 'unpickle_namedtuple', lambda: cpboard.unpickle(output), repeat, out=out)
+
+
+def test_module_source(tests):
+    """Source of a board test module with trivial tests"""
+    return ''.join('def test_%d():\n    pass\n\n\n' % (i,) for i in range(tests))
+
+
+def assert_module_source(functions):
+    """Source of a large test module with a mix of asserts"""
+    source = 'import pytest\n\n\n'
+    for i in range(functions):
+        source += ('def test_%d(value=%d):\n'
+                   '    items = [value, value + 1, {"key": value}]\n'
+                   '    assert value == %d\n'
+                   '    assert items[2]["key"] in (value, None) and len(items) > 1\n'
+                   '    assert not (value < 0\n'
+                   '                or value > %d)\n'
+                   '    assert isinstance(items, list), "no rewrite with a message"\n'
+                   '    assert sorted(items[:2], reverse=True) != [value]\n\n\n' % (i, i, i, functions))
+    return source
+
+
+def bench_rewrite(results, repeat, sizes=(100, 1000), out=None):
+    for functions in sizes:
+        source = assert_module_source(functions)
+        measure(results, 'rewrite_%d' % functions, lambda: rewrite_asserts(source), repeat,
+                nbytes=len(source), out=out)
+
+
+def bench_copy(results, board, repeat, sizes=(1, 4), path='/hostbench.bin', out=None):
+    with cpboard.CPboard.from_try_all(board) as b:
+        b.repl.reset()
+        disk = cpboard.ReplDisk(b)
+        with tempfile.NamedTemporaryFile() as f:
+            for size in sizes:
+                f.seek(0)
+                f.truncate()
+                f.write(os.urandom(size * 1024))
+                f.flush()
+                measure(results, 'copy_%dk' % size, lambda: disk.copy(f.name, path, force=True), repeat,
+                        nbytes=size * 1024, out=out)
+        try:
+            b.exec('__import__("os").remove(%r)' % path, reset_repl=False)
+        except (Exception, cpboard.CPboardError):
+            pass
+
+
+def run_session(board, path, args=()):
+    """Run pytest in path, return the wall time and the junit test times"""
+    xml = os.path.join(path, 'junit.xml')
+    command = [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', '--board', board,
+               '--junitxml', xml] + list(args) + [TEST_MODULE]
+    start = time.monotonic()
+    proc = subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    elapsed = time.monotonic() - start
+    if proc.returncode:
+        lines = output.decode('utf8', errors='replace').strip().splitlines()
+        raise RuntimeError('pytest exited with %d: %s' % (proc.returncode, lines[-1] if lines else ''))
+    times = [float(case.get('time')) for case in ET.parse(xml).getroot().iter('testcase')]
+    return elapsed, times
+
+
+def bench_session(results, board, tests=1000, out=None):
+    """Run a session with trivial board tests
+
+    The files are uploaded by a first run of one test, a simulated board gets a root that outlives its
+    process for this. The per test overhead is the difference between running all the tests and one
+    of them, so the startup, collection and upload aren't part of it.
+    """
+    if tests < 2:
+        raise ValueError('tests has to be at least 2')
+    with tempfile.TemporaryDirectory(prefix='hostbench-') as tmpdir:
+        path = os.path.join(tmpdir, 'session')
+        os.mkdir(path)
+        with open(os.path.join(path, 'pytest.ini'), 'w') as f:
+            f.write('[pytest]\n')
+        with open(os.path.join(path, TEST_MODULE), 'w') as f:
+            f.write(test_module_source(tests))
+        if board.startswith('sim:'):
+            board += ':root=%s' % (os.path.join(tmpdir, 'root'),)
+
+        for name, args in (('session', ()), ('session_batch', ('--board-batch=module',))):
+            name = '%s_%d' % (name, tests)
+            if out:
+                print('%-20s' % name, end='', file=out, flush=True)
+            try:
+                run_session(board, path, args + ('-k', 'test_0'))
+                startup, _ = run_session(board, path, args + ('-k', 'test_0'))
+                elapsed, times = run_session(board, path, args)
+            except (Exception, cpboard.CPboardError) as e:
+                results[name] = {'error': '%s: %s' % (type(e).__name__, e)}
+            else:
+                results[name] = cpboard.percentiles(times)
+                results[name]['wall'] = elapsed
+                results[name]['startup'] = startup
+                results[name]['per_test'] = (elapsed - startup) / (tests - 1)
+            if out:
+                print(' done', file=out, flush=True)
+
+
+def hostbench(groups=GROUPS, board='sim:hostbench', repeat=5, tests=1000, copy_sizes=(1, 4), out=None):
+    """Run the benchmark groups, return an OrderedDict of percentiles() results keyed on the benchmark name"""
+    results = collections.OrderedDict()
+    if 'read_until' in groups:
+        bench_read_until(results, repeat, out=out)
+    if 'eval' in groups:
+        bench_eval(results, repeat, out=out)
+    if 'rewrite' in groups:
+        bench_rewrite(results, repeat, out=out)
+    if 'copy' in groups:
+        bench_copy(results, board, max(repeat // 2, 1), sizes=copy_sizes, out=out)
+    if 'session' in groups:
+        bench_session(results, board, tests, out=out)
+    return results
+
+
+def main(argv=None):
+    import argparse
+    import platform
+    cmd_parser = argparse.ArgumentParser(prog='python -m pytest_circuitpython.hostbench',
+                                         description='Measure the host overhead of cpboard and the plugin')
+    cmd_parser.add_argument('group', nargs='*', help='benchmarks to run: %s (default: all)' % ', '.join(GROUPS))
+    cmd_parser.add_argument('--board', default='sim:hostbench',
+                            help='board for copy and session (default: %(default)s)')
+    cmd_parser.add_argument('-n', '--repeat', type=int, default=5, help='repetitions (default: %(default)s)')
+    cmd_parser.add_argument('--tests', type=int, default=1000,
+                            help='board tests in the session benchmark (default: %(default)s)')
+    cmd_parser.add_argument('--copy-sizes', default='1,4', help='file sizes in kB to copy (default: %(default)s)')
+    cmd_parser.add_argument('--json', metavar='FILE', help="write the results as JSON ('-' for stdout)")
+    args = cmd_parser.parse_args(argv)
+    unknown = set(args.group) - set(GROUPS)
+    if unknown:
+        cmd_parser.error('unknown benchmark: %s' % ', '.join(sorted(unknown)))
+
+    out = None if args.json == '-' else sys.stdout
+    copy_sizes = tuple(int(size) for size in args.copy_sizes.split(','))
+    results = hostbench(args.group or GROUPS, board=args.board, repeat=args.repeat, tests=args.tests,
+                        copy_sizes=copy_sizes, out=out)
+
+    report = collections.OrderedDict([
+        ('board', args.board),
+        ('host', platform.node()),
+        ('python', platform.python_version()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('results', results),
+    ])
+
+    if out:
+        print()
+        cpboard.print_bench(results)
+        for name, res in results.items():
+            if 'per_test' in res:
+                print('%s: %.1fms per test (%.2fs startup)' % (name, res['per_test'] * 1000, res['startup']))
+
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
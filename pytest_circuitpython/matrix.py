@@ -0,0 +1,227 @@
+"""Run the board tests on every board at once (--board-matrix)
+
+The pytest runtest protocol isn't thread safe (setup state, fixture caches, output capture),
+so each board link gets a forked process running the items parametrized for that board.
+Collection and assert rewriting is done once before forking.
+The reports are sent back over a pipe, read by one thread per board, and replayed grouped by board.
+"""
+
+import os
+import pickle
+import sys
+import threading
+import time
+import traceback
+
+import cpboard
+
+try:
+    from _pytest.reports import TestReport
+except ImportError:
+    from _pytest.runner import TestReport
+
+
+def item_board(item):
+    callspec = getattr(item, 'callspec', None)
+    return callspec.params.get('board_name') if callspec else None
+
+
+def serialize_report(report):
+    d = dict(report.__dict__)
+    d['keywords'] = dict.fromkeys(report.keywords, 1)
+    if hasattr(report.longrepr, 'toterminal'):
+        d['longrepr'] = str(report.longrepr)
+    return d
+
+
+class ReportSender:
+    """Plugin forwarding the report hooks to the parent process"""
+    def __init__(self, f):
+        self.f = f
+
+    def send(self, *record):
+        pickle.dump(record, self.f)
+        self.f.flush()
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        self.send('logstart', nodeid, location)
+
+    def pytest_runtest_logreport(self, report):
+        self.send('logreport', serialize_report(report))
+
+    def pytest_runtest_logfinish(self, nodeid, location):
+        self.send('logfinish', nodeid, location)
+
+
+class BoardProcess:
+    def __init__(self, label, name, items):
+        self.label = label
+        self.name = name
+        self.items = items
+        self.records = []
+        self.pid = None
+        self.status = None
+        self.duration = 0
+
+    def fork(self, session, files):
+        rfd, wfd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            status = 1
+            try:
+                with os.fdopen(wfd, 'wb') as f:
+                    run_items(session, self, files, ReportSender(f))
+                status = 0
+            finally:
+                os._exit(status)
+
+        os.close(wfd)
+        self.pid = pid
+        self.rfile = os.fdopen(rfd, 'rb')
+
+    def start(self):
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        with self.rfile as f:
+            while True:
+                try:
+                    self.records.append(pickle.load(f))
+                except EOFError:
+                    break
+        self.duration = time.time() - self.start_time
+
+    def wait(self):
+        self.thread.join()
+        _, self.status = os.waitpid(self.pid, 0)
+
+
+def run_items(session, proc, files, sender):
+    """Run in the forked process"""
+    from . import upload_files, flush_cleanup
+
+    config = session.config
+    # Get new capture files, the parent's are shared
+    capman = config.pluginmanager.getplugin('capturemanager')
+    if capman:
+        capman.stop_global_capturing()
+        capman.start_global_capturing()
+    reporter = config.pluginmanager.getplugin('terminalreporter')
+    if reporter:
+        config.pluginmanager.unregister(reporter)
+    config.pluginmanager.register(sender, 'board_matrix_sender')
+
+    # The parent's trace events are saved by the parent
+    trace = config.pluginmanager.getplugin('board_trace')
+    if trace:
+        del trace.tracer.events[:]
+
+    # The parent might have opened the first board for the host tests
+    session.__dict__.pop('board', None)
+    config.option.boarddev = proc.name
+
+    try:
+        upload_files(session, files)
+        for i, item in enumerate(proc.items):
+            nextitem = proc.items[i + 1] if i + 1 < len(proc.items) else None
+            item.config.hook.pytest_runtest_protocol(item=item, nextitem=nextitem)
+            if session.shouldfail or session.shouldstop:
+                break
+        flush_cleanup(session)
+    except (Exception, KeyboardInterrupt, cpboard.CPboardError) as e:
+        msg = ''.join(traceback.format_exception_only(type(e), e)).strip()
+        if e.__cause__ is not None:
+            msg += '\n' + ''.join(traceback.format_exception_only(type(e.__cause__), e.__cause__)).strip()
+        sender.send('error', msg)
+    finally:
+        if trace:
+            trace.save(proc.label)
+
+
+def replay(session, proc):
+    hook = session.config.hook
+    error = None
+    done = set()
+    for record in proc.records:
+        kind = record[0]
+        if kind == 'logstart':
+            hook.pytest_runtest_logstart(nodeid=record[1], location=record[2])
+        elif kind == 'logreport':
+            report = TestReport(**record[1])
+            done.add(report.nodeid)
+            hook.pytest_runtest_logreport(report=report)
+        elif kind == 'logfinish':
+            hook.pytest_runtest_logfinish(nodeid=record[1], location=record[2])
+        elif kind == 'error':
+            error = record[1]
+
+    if error is None and proc.status:
+        error = 'Board process exited with status %d' % (proc.status,)
+
+    # Report the items that didn't run
+    for item in proc.items:
+        if item.nodeid in done:
+            continue
+        hook.pytest_runtest_logstart(nodeid=item.nodeid, location=item.location)
+        report = TestReport(item.nodeid, item.location, dict.fromkeys(item.keywords, 1), 'failed',
+                            error or 'Not run', 'setup')
+        hook.pytest_runtest_logreport(report=report)
+        hook.pytest_runtest_logfinish(nodeid=item.nodeid, location=item.location)
+
+
+def run_matrix(session, files):
+    config = session.config
+    if session.testsfailed and not config.option.continue_on_collection_errors:
+        raise session.Interrupted("%d errors during collection" % session.testsfailed)
+
+    labels = config.board_matrix
+    groups = dict((label, []) for label in labels)
+    host_items = []
+    for item in session.items:
+        label = item_board(item) if item.get_marker('board') else None
+        if label in groups:
+            groups[label].append(item)
+        else:
+            host_items.append(item)
+
+    for i, item in enumerate(host_items):
+        nextitem = host_items[i + 1] if i + 1 < len(host_items) else None
+        item.config.hook.pytest_runtest_protocol(item=item, nextitem=nextitem)
+        if session.shouldfail:
+            raise session.Failed(session.shouldfail)
+        if session.shouldstop:
+            raise session.Interrupted(session.shouldstop)
+
+    board = session.__dict__.pop('board', None)
+    if board:
+        board.close()
+
+    procs = [BoardProcess(label, name, groups[label]) for label, name in labels.items() if groups[label]]
+    if not procs:
+        return True
+
+    # Fork them all before starting any threads
+    for proc in procs:
+        proc.fork(session, files)
+    for proc in procs:
+        proc.start()
+
+    reporter = config.pluginmanager.getplugin('terminalreporter')
+    for proc in procs:
+        proc.wait()
+        if reporter:
+            reporter.ensure_newline()
+            reporter.write_sep('-', 'board %s (%s): %d tests in %.2f seconds' %
+                               (proc.label, proc.name, len(proc.items), proc.duration))
+        replay(session, proc)
+
+    if reporter:
+        reporter.ensure_newline()
+
+    return True
@@ -0,0 +1,141 @@
+"""Board heap instrumentation (--board-memory)
+
+The board fixture and test commands are wrapped to measure gc.mem_free()/gc.mem_alloc() before and after
+running, the numbers come back in an M frame in the same round trip, also when the command fails.
+The batch runner measures each phase the same way.
+
+The measurements are attributed to the test phase they happened in when its report is made:
+    board_mem_setup, board_mem_call, board_mem_teardown    Allocated bytes during the phase
+    board_mem_retained    Still allocated after teardown, not counting the fixtures with a wider scope
+    board_mem_free        Lowest free heap seen during the test
+These are added to the report and JUnit XML as properties.
+
+The retained memory of the last runs is kept in the pytest cache, a test retaining more memory on each
+of the last LEAK_RUNS runs is reported as a possible leak. A steady one-off allocation (like a cached
+import) retains the same amount each run and isn't reported.
+"""
+
+import ast
+import sys
+
+from .remote import FrameFilter
+from .utils import board_exec
+
+LEAK_RUNS = 3
+CACHE_KEY = 'circuitpython/board_mem_retained'
+
+PROBE = ('import gc\ngc.collect()\n____mem = (gc.mem_free(), gc.mem_alloc())\n'
+         'print("\\x1eM%r\\x1f" % (____mem + ____mem,), end="")\ndel ____mem\n')
+
+
+def heap_command(command):
+    """Measure the heap around command"""
+    body = ''.join('    %s\n' % (line,) for line in command.splitlines() if line.strip()) or '    pass\n'
+    return ('import gc\ngc.collect()\n____mem = (gc.mem_free(), gc.mem_alloc())\n'
+            'try:\n%s'
+            'finally:\n'
+            '    gc.collect()\n'
+            '    print("\\x1eM%%r\\x1f" %% (____mem + (gc.mem_free(), gc.mem_alloc()),), end="")\n'
+            '    del ____mem\n' % (body,))
+
+
+def probe(session):
+    """Measure the heap after running the queued cleanup"""
+    out = FrameFilter(sys.stdout)
+    board_exec(session, PROBE, reset_repl=False, raise_remote=True, out=out)
+    add_measurement(session.config, out.frames.get('M'))
+
+
+def add_measurement(config, payload, wider=False):
+    """Record the M frame payload or values: (free, alloc, free, alloc[, wider bytes])
+
+    wider: The allocation belongs to a fixture with a wider scope than function
+    """
+    if not payload:
+        return
+    try:
+        values = tuple(ast.literal_eval(payload) if isinstance(payload, str) else payload)
+        free0, alloc0, free1, alloc1 = values[:4]
+    except (ValueError, SyntaxError, TypeError):
+        return
+    wider = alloc1 - alloc0 if wider else (values[4] if len(values) > 4 else 0)
+    heap = config_heap(config)
+    heap.pending.append((free0, alloc0, free1, alloc1, wider))
+    heap.peak = max(heap.peak, alloc0, alloc1)
+    heap.lowest = min(free for free in (heap.lowest, free0, free1) if free is not None)
+
+
+def config_heap(config):
+    heap = getattr(config, 'board_heap', None)
+    if heap is None:
+        heap = config.board_heap = Heap()
+    return heap
+
+
+class Heap:
+    def __init__(self):
+        self.pending = []
+        self.peak = 0
+        self.lowest = None
+        self.retained = {}
+
+
+def end_heap_phase(item, when):
+    """Attribute the pending measurements to the phase of item"""
+    heap = config_heap(item.config)
+    pending, heap.pending = heap.pending, []
+    stats = getattr(item, 'board_memory', None)
+    if stats is None:
+        if not pending:
+            return
+        stats = item.board_memory = {'baseline': pending[0][1], 'wider': 0, 'free': None}
+
+    stats[when] = stats.get(when, 0) + sum(alloc1 - alloc0 for _, alloc0, _, alloc1, _ in pending)
+    stats['wider'] += sum(m[4] for m in pending)
+    frees = [free for m in pending for free in (m[0], m[2])]
+    if frees:
+        stats['free'] = min(frees + ([stats['free']] if stats['free'] is not None else []))
+    if pending:
+        stats['last'] = pending[-1][3]
+
+    if when != 'teardown':
+        return
+
+    retained = stats['last'] - stats['baseline'] - stats['wider']
+    heap.retained[item.nodeid] = retained
+    for name in ('setup', 'call', 'teardown'):
+        item.user_properties.append(('board_mem_%s' % (name,), stats.get(name, 0)))
+    item.user_properties.append(('board_mem_retained', retained))
+    item.user_properties.append(('board_mem_free', stats['free']))
+
+
+def possible_leaks(config, retained):
+    """Update the retained history in the cache, return the nodeids retaining more memory on every recent run"""
+    cache = getattr(config, 'cache', None)
+    if cache is None:
+        return []
+    history = cache.get(CACHE_KEY, {})
+    for nodeid, value in retained.items():
+        history[nodeid] = (history.get(nodeid, []) + [value])[-LEAK_RUNS:]
+    cache.set(CACHE_KEY, history)
+    return [nodeid for nodeid in retained
+            if len(history[nodeid]) == LEAK_RUNS and history[nodeid][0] > 0 and
+            all(a < b for a, b in zip(history[nodeid], history[nodeid][1:]))]
+
+
+def heap_summary(terminalreporter):
+    config = terminalreporter.config
+    heap = getattr(config, 'board_heap', None)
+    if heap is None or heap.lowest is None:
+        return
+    tr = terminalreporter
+    tr.write_sep('=', 'board memory')
+    tr.write_line('peak allocated: %d bytes, lowest free: %d bytes' % (heap.peak, heap.lowest))
+    for nodeid, retained in sorted(heap.retained.items(), key=lambda x: -x[1])[:5]:
+        if retained > 0:
+            tr.write_line('%8d bytes retained  %s' % (retained, nodeid))
+    leaks = possible_leaks(config, heap.retained)
+    if leaks:
+        tr.write_line('possible leaks (retaining more memory in each of the last %d runs):' % (LEAK_RUNS,))
+        for nodeid in leaks:
+            tr.write_line('  %s' % (nodeid,))
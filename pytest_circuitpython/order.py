@@ -0,0 +1,158 @@
+"""Order the board tests to set up as little as possible on the board (--board-order=cost)
+
+pytest sets up a module or class scoped fixture again each time the tests come back to its module or class,
+and a parametrized fixture of a higher scope each time the param changes. The board items are put in the
+order needing the fewest of these setups and module changes: the next item is one needing no setup, else
+the one saving the most compared to running it first, the first in collection order among equals.
+The collection order is kept if the estimate isn't lowered.
+
+Only the board items move, and only to the places taken by board items, so the host tests stay where they
+are. Items with an ordering marker (pytest-ordering, pytest-order, pytest-dependency) stay in place too,
+the items before and after them are ordered on their own.
+"""
+
+import collections
+
+ORDER_MARKERS = ('order', 'run', 'first', 'second', 'third', 'second_to_last', 'last', 'dependency')
+
+# The package scope is treated as session, it is experimental in pytest
+SCOPES = {'session': 'session', 'package': 'session', 'module': 'module', 'class': 'class'}
+
+Context = collections.namedtuple('Context', 'module cls params')
+
+
+def is_pinned(item):
+    return any(item.get_marker(name) is not None for name in ORDER_MARKERS)
+
+
+def higher_fixtures(item):
+    """Yield (scope, name, param index) for the fixtures of item with a scope wider than function"""
+    callspec = getattr(item, 'callspec', None)
+    indices = callspec.indices if callspec else {}
+    for name in sorted(item._fixtureinfo.names_closure):
+        fixturedefs = item._fixtureinfo.name2fixturedefs.get(name)
+        if not fixturedefs:
+            continue
+        scope = SCOPES.get(fixturedefs[-1].scope)
+        if scope:
+            yield scope, name, indices.get(name)
+
+
+def item_context(item):
+    """The state item needs: its module, class (if it has class fixtures) and the higher scope params"""
+    fixtures = list(higher_fixtures(item))
+    cls = getattr(item, 'cls', None) if any(scope == 'class' for scope, _, _ in fixtures) else None
+    params = tuple(fixture for fixture in fixtures if fixture[2] is not None)
+    return Context(str(item.fspath), cls, params)
+
+
+class SetupCounter:
+    """Count the module changes and higher scope fixture setups running the items in order
+
+    weights: The number of fixtures without params set up when entering a module or class node
+    """
+    def __init__(self, weights):
+        self.weights = weights
+        self.count = 0
+        self.module = self.cls = None
+        self.cached = dict((scope, {}) for scope in set(SCOPES.values()))
+
+    def cost(self, context):
+        cost = 0
+        module = context.module != self.module
+        if module:
+            cost += 1 + self.weights.get(context.module, 0)
+        cls = module or context.cls != self.cls
+        if cls and context.cls is not None:
+            cost += self.weights.get((context.module, context.cls), 0)
+        for scope, name, index in context.params:
+            torn_down = (scope == 'module' and module) or (scope == 'class' and cls)
+            if torn_down or self.cached[scope].get(name) != index:
+                cost += 1
+        return cost
+
+    def run(self, context):
+        self.count += self.cost(context)
+        if context.module != self.module:
+            self.cached['module'] = {}
+        if context.module != self.module or context.cls != self.cls:
+            self.cached['class'] = {}
+        self.module, self.cls = context.module, context.cls
+        for scope, name, index in context.params:
+            self.cached[scope][name] = index
+
+
+def node_weights(items, contexts):
+    """Count the fixtures without params per module and class"""
+    names = collections.defaultdict(set)
+    for item, context in zip(items, contexts):
+        for scope, name, index in higher_fixtures(item):
+            if index is not None:
+                continue
+            if scope == 'module':
+                names[context.module].add(name)
+            elif scope == 'class' and context.cls is not None:
+                names[(context.module, context.cls)].add(name)
+    return dict((node, len(fixtures)) for node, fixtures in names.items())
+
+
+def count_setups(contexts, weights):
+    counter = SetupCounter(weights)
+    for context in contexts:
+        counter.run(context)
+    return counter.count
+
+
+def order_segment(contexts, counter):
+    """Return the indices of contexts in the order picked, running them on counter"""
+    pending = collections.OrderedDict()
+    for index, context in enumerate(contexts):
+        pending.setdefault(context, collections.deque()).append(index)
+
+    # What each context costs when nothing is set up, the entry cost is paid once anyway
+    fresh = dict((context, SetupCounter(counter.weights).cost(context)) for context in pending)
+
+    order = []
+    while pending:
+        costs = dict((context, counter.cost(context)) for context in pending)
+        if 0 in costs.values():
+            best = 0
+            saved = dict((context, -cost) for context, cost in costs.items())
+        else:
+            saved = dict((context, fresh[context] - cost) for context, cost in costs.items())
+            best = max(saved.values())
+        # The first item in collection order among the best
+        context = min((context for context in pending if saved[context] == best), key=lambda c: pending[c][0])
+        counter.run(context)
+        order.append(pending[context].popleft())
+        if not pending[context]:
+            del pending[context]
+    return order
+
+
+def order_items(items, is_board_item):
+    """Reorder the board items of items in place, return the estimated setups before and after"""
+    positions = [index for index, item in enumerate(items) if is_board_item(item)]
+    board = [items[index] for index in positions]
+    contexts = [item_context(item) for item in board]
+    weights = node_weights(board, contexts)
+
+    counter = SetupCounter(weights)
+    order = []
+    start = 0
+    for index, item in enumerate(board + [None]):
+        if item is not None and not is_pinned(item):
+            continue
+        segment = order_segment(contexts[start:index], counter)
+        order.extend(start + i for i in segment)
+        if item is not None:
+            counter.run(contexts[index])
+            order.append(index)
+        start = index + 1
+
+    before = count_setups(contexts, weights)
+    after = counter.count
+    if after < before:
+        for position, index in zip(positions, order):
+            items[position] = board[index]
+    return before, min(before, after)
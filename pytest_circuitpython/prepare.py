@@ -0,0 +1,132 @@
+"""Prepare the board files before upload
+
+The files go through the transforms (assert rewriting) and the results are stored in
+.pytest_board_cache/<key>/<file name> where key is the hash of the source, its path, the transforms and
+their implementation. A file that hasn't changed since the last run only costs a hash and a lookup.
+When a file is prepared again the entries of its previous versions are removed.
+From POOL_MIN_FILES files on they are prepared in a process pool, starting one costs more than a few files.
+
+The firmware version is not part of the key: assert rewriting is a source to source transform using only
+plain statements and conditional expressions that every CircuitPython version runs. A transform producing
+firmware specific output (like .mpy files) would have to add the version to the key.
+"""
+
+import concurrent.futures
+import hashlib
+import os
+import shutil
+
+from . import rewrite
+
+TRANSFORMS = {
+    'assert_rewrite': (rewrite.rewrite_asserts, rewrite.__file__),
+}
+
+POOL_MIN_FILES = 8
+
+
+def transform(path, transforms):
+    """Return the source of path after the transforms"""
+    with open(path) as f:
+        source = f.read()
+    for name in transforms:
+        func = TRANSFORMS[name][0]
+        result = func(source)
+        if result is not None:
+            source = result
+    return source
+
+
+def implementation_hash(transforms):
+    h = hashlib.sha1()
+    for name in transforms:
+        with open(TRANSFORMS[name][1], 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cache_key(source, transforms, implementation, name=''):
+    h = hashlib.sha1(source)
+    h.update(repr(tuple(transforms)).encode())
+    h.update(implementation.encode())
+    h.update(name.encode())
+    return h.hexdigest()
+
+
+def prune_cache(cache_dir, keys):
+    """Remove the entries of the sources in keys ({name: key}) that have another key"""
+    for entry in os.listdir(cache_dir):
+        try:
+            with open(os.path.join(cache_dir, entry, 'source')) as f:
+                name = f.read()
+        except OSError:
+            # Not an entry (collect/) or still being written
+            continue
+        if name in keys and keys[name] != entry:
+            shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+
+def session_transforms(session):
+    transforms = []
+    if session.config.getvalue("assertmode") == "rewrite":
+        transforms.append('assert_rewrite')
+    return transforms
+
+
+def prepare_files(session, paths):
+    """Return the prepared file for each of paths"""
+    transforms = session_transforms(session)
+    if not transforms:
+        return list(paths)
+
+    debug = session.config.option.verbose > 2
+    cache_dir = os.path.join(str(session.fspath), '.pytest_board_cache')
+    implementation = implementation_hash(transforms)
+
+    prepared = []
+    missing = []
+    for path in paths:
+        # The path is part of the key so an entry belongs to one source and can be pruned
+        name = os.path.relpath(path, str(session.fspath))
+        with open(path, 'rb') as f:
+            key = cache_key(f.read(), transforms, implementation, name)
+        dst = os.path.join(cache_dir, key, os.path.basename(path))
+        prepared.append(dst)
+        if not os.path.exists(dst):
+            missing.append((path, dst, name))
+
+    if not missing:
+        return prepared
+
+    workers = min(len(missing), os.cpu_count() or 1)
+    if workers > 1 and len(missing) >= POOL_MIN_FILES:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            futures = [executor.submit(transform, path, transforms) for path, _, _ in missing]
+            results = [future.result() for future in futures]
+    else:
+        results = [transform(path, transforms) for path, _, _ in missing]
+
+    written = {}
+    for (path, dst, name), result in zip(missing, results):
+        if debug:
+            print('\nprepare_files(%r) -> %r' % (path, dst))
+            print('--------------------------------------------------------------------------------')
+            print(result)
+            print('--------------------------------------------------------------------------------')
+        try:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            # Other xdist workers might be preparing the same file
+            tmp = '%s.%d' % (dst, os.getpid())
+            with open(tmp, 'w') as f:
+                f.write(result)
+            os.replace(tmp, dst)
+            with open(tmp, 'w') as f:
+                f.write(name)
+            os.replace(tmp, os.path.join(os.path.dirname(dst), 'source'))
+            written[name] = os.path.basename(os.path.dirname(dst))
+        except OSError:
+            prepared[prepared.index(dst)] = path
+
+    if written:
+        prune_cache(cache_dir, written)
+    return prepared
@@ -0,0 +1,115 @@
+"""Get the board back after a hang, crash or safe mode and carry on with the session
+
+A board command that times out or loses the connection leaves the board in an unknown state.
+recover() gets the REPL back with CPboard.recover() before the error is raised, so only the test phase
+that ran into it fails. If the board rebooted on the way, what the session had set up is restored:
+the uploaded files are checked, the modules are imported again on demand (ModuleRegistry) and the board
+fixtures of a wider scope are set up again when next requested.
+
+Each recovery is attached to the report of the phase that ran into it (report.board_recovery), the phase
+is reported as an error and the recoveries are listed at the end of the session.
+If the board can't be recovered, the remaining board commands fail right away (see check_board()).
+"""
+
+import os
+import time
+
+import cpboard
+
+
+def is_link_error(e):
+    """Return True for the errors leaving the board in an unknown state: timeouts and transport errors"""
+    return isinstance(e, (cpboard.CPboardError, OSError)) and not isinstance(e, cpboard.CPboardRemoteError)
+
+
+def check_board(session):
+    """Raise CPboardError if the board was lost earlier in the session"""
+    lost = getattr(session, 'board_lost', None)
+    if lost is not None:
+        raise cpboard.CPboardError('board lost: %s' % (lost,))
+
+
+def recover(session, error, cleanup=()):
+    """Recover the session board after error, return False if it is lost
+
+    cleanup: The queued variable deletions sent in front of the failed command (see board_command())
+    """
+    board = session.board
+    start = time.monotonic()
+    reboots = board.repl.reboots
+    # 'read error' and the like are more telling with their cause
+    cause = error.__cause__ if isinstance(error, cpboard.CPboardError) and error.__cause__ else error
+    recovery = {'error': '%s: %s' % (type(cause).__name__, cause)}
+    try:
+        recovery['steps'] = board.recover(timeout=session.config.option.board_recover_timeout)
+        if board.repl.reboots != reboots:
+            restore(session)
+        else:
+            # The command might have stopped before the cleanup ran, the variables are still there
+            pending = session.board_cleanup
+            pending.extend(var for var in cleanup if var not in pending)
+    except (cpboard.CPboardError, OSError) as e:
+        session.board_lost = recovery['lost'] = '%s: %s' % (type(e).__name__, e)
+    recovery['seconds'] = time.monotonic() - start
+
+    # Picked up by the report of the current phase, see pytest_runtest_makereport()
+    if not hasattr(session, 'board_recovery'):
+        session.board_recovery = []
+    session.board_recovery.append(recovery)
+    return 'lost' not in recovery
+
+
+def restore(session):
+    """Put back what the session had set up on the board before it rebooted"""
+    board = session.board
+
+    # The modules are forgotten by ModuleRegistry, so are the fixture variables,
+    # have the board fixtures set up again when next requested
+    for fixturedefs in session._fixturemanager._arg2fixturedefs.values():
+        for fixturedef in fixturedefs:
+            if getattr(fixturedef, 'rpath', '') and getattr(fixturedef, 'cached_result', None) is not None:
+                fixturedef.cached_result = None
+    del session.board_cleanup[:]
+
+    # The files should still be there, but a crash can corrupt the filesystem. Only the size is checked.
+    disk = cpboard.ReplDisk(board)
+    dirs = set()
+    for src, dst in getattr(session, 'board_uploads', ()):
+        if os.path.dirname(dst) not in dirs:
+            disk.makedirs(os.path.dirname(dst), exist_ok=True)
+            dirs.add(os.path.dirname(dst))
+        disk.copy(src, dst)
+
+    # The daemon forgets the files if it lost the serial port and the modules on a soft reboot
+    if isinstance(board, cpboard.DaemonBoard):
+        board.client.update(board.name, files=dict(session.board_files), clear=True)
+
+
+def recovery_status(report):
+    """Report a phase that needed a recovery as an error, the board failed and not the test"""
+    if report.failed and getattr(report, 'board_recovery', None):
+        return 'error', 'E', 'ERROR'
+
+
+class RecoveryResults:
+    """Collect the recoveries from the reports and list them in the terminal summary"""
+    def __init__(self, config):
+        self.config = config
+        self.recoveries = []
+
+    def pytest_runtest_logreport(self, report):
+        for recovery in getattr(report, 'board_recovery', None) or ():
+            self.recoveries.append((report.nodeid, report.when, recovery))
+
+    def pytest_terminal_summary(self, terminalreporter):
+        if not self.recoveries:
+            return
+        tr = terminalreporter
+        tr.write_sep('=', 'board recovery')
+        for nodeid, when, recovery in self.recoveries:
+            if 'lost' in recovery:
+                outcome = 'failed: %s' % (recovery['lost'],)
+            else:
+                outcome = ', '.join(recovery['steps'])
+            tr.write_line('%6.2fs %-8s %s' % (recovery['seconds'], when, nodeid))
+            tr.write_line('        %s -> %s' % (recovery['error'], outcome))
@@ -0,0 +1,164 @@
+"""Handles for objects living on the board
+
+The value of a remote fixture is only sent to the host if it's a plain value (number, string, bytes, None).
+Anything else (busio.I2C, DigitalInOut, large buffers) is returned as a RemoteObject referring to the
+board variable holding it. Attribute and item access build on the expression without talking to the
+board, calls run on the board and the value is fetched when the host needs it (comparison, str(), len(),
+iteration...).
+
+    i2c.scan()          # runs i2c.scan() on the board
+    led.value = True    # sets the attribute on the board
+    led.value == True   # fetches led.value
+"""
+
+import ast
+import itertools
+import sys
+import weakref
+
+import cpboard
+
+from .utils import board_exec, delete_variables
+
+# The types that are sent to the host by value
+TRANSFER_TYPES = '(int, float, bool, str, bytes, type(None))'
+
+_handles = itertools.count()
+
+
+def value_command(variable):
+    """Return a command printing the value of variable in a V frame if it's transferred, empty otherwise"""
+    return 'print("\\x1eV%%s\\x1f" %% (repr(%s) if type(%s) in %s else "",), end="")\n' % (
+        variable, variable, TRANSFER_TYPES)
+
+
+def frame_value(session, payload, variable, cleanup=False):
+    """Return the value in the V frame payload or a RemoteObject for variable"""
+    if payload:
+        try:
+            if cleanup:
+                delete_variables(session, [variable])
+            return ast.literal_eval(payload)
+        except (ValueError, SyntaxError):
+            pass
+    return RemoteObject(session, variable, cleanup=cleanup)
+
+
+def remote_source(value):
+    """Return the source of value for a command"""
+    if isinstance(value, RemoteObject):
+        return object.__getattribute__(value, '_expression')
+    return repr(value)
+
+
+class FrameFilter:
+    """Pass output through to out, keeping the frames (\x1e <kind> <payload> \x1f) in frames[kind]"""
+    def __init__(self, out):
+        self.out = out
+        self.frames = {}
+        self.frame = None
+
+    def write(self, data):
+        for c in data:
+            if c == '\x1e':
+                self.frame = ''
+            elif self.frame is None:
+                self.out.write(c)
+            elif c == '\x1f':
+                self.frames[self.frame[:1]] = self.frame[1:]
+                self.frame = None
+            else:
+                self.frame += c
+
+    def flush(self):
+        self.out.flush()
+
+
+class RemoteObject:
+    """Proxy for an object on the board, refered to by an expression
+
+    cleanup: Delete the board variable when the handle is garbage collected
+    """
+    def __init__(self, session, expression, cleanup=False):
+        object.__setattr__(self, '_session', session)
+        object.__setattr__(self, '_expression', expression)
+        if cleanup:
+            weakref.finalize(self, delete_variables, session, [expression])
+
+    def _exec(self, command, **kwargs):
+        return board_exec(self._session, command, reset_repl=False, raise_remote=True, **kwargs)
+
+    def _fetch(self):
+        """Return the value of the object"""
+        output = self._exec('print(repr(%s), end="")\n' % (self._expression,))
+        return cpboard.unpickle(output.decode('utf-8', errors='replace'))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return RemoteObject(self._session, '%s.%s' % (self._expression, name))
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        self._exec('%s.%s = %s\n' % (self._expression, name, remote_source(value)))
+
+    def __getitem__(self, key):
+        return RemoteObject(self._session, '%s[%s]' % (self._expression, remote_source(key)))
+
+    def __setitem__(self, key, value):
+        self._exec('%s[%s] = %s\n' % (self._expression, remote_source(key), remote_source(value)))
+
+    def __call__(self, *args, **kwargs):
+        args = [remote_source(arg) for arg in args]
+        args.extend('%s=%s' % (key, remote_source(val)) for key, val in sorted(kwargs.items()))
+        variable = '____handle%d' % (next(_handles),)
+        command = '%s = %s(%s)\n' % (variable, self._expression, ', '.join(args))
+        command += value_command(variable)
+        out = FrameFilter(sys.stdout)
+        self._exec(command, out=out)
+        return frame_value(self._session, out.frames.get('V'), variable, cleanup=True)
+
+    def __repr__(self):
+        return '<RemoteObject %s>' % (self._expression,)
+
+    def __str__(self):
+        return str(self._fetch())
+
+    def __eq__(self, other):
+        return self._fetch() == other
+
+    def __ne__(self, other):
+        return self._fetch() != other
+
+    def __lt__(self, other):
+        return self._fetch() < other
+
+    def __le__(self, other):
+        return self._fetch() <= other
+
+    def __gt__(self, other):
+        return self._fetch() > other
+
+    def __ge__(self, other):
+        return self._fetch() >= other
+
+    __hash__ = object.__hash__
+
+    def __bool__(self):
+        return bool(self._fetch())
+
+    def __len__(self):
+        return len(self._fetch())
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+    def __contains__(self, item):
+        return item in self._fetch()
+
+    def __int__(self):
+        return int(self._fetch())
+
+    def __float__(self):
+        return float(self._fetch())
@@ -0,0 +1,223 @@
+"""Assert rewriting for the board test modules
+
+The module is parsed once with ast to find the asserts without a message and the tokens are used to cut
+out the source of the operands. Each assert is replaced in the source by one line that stores the
+intermediate values in temporaries and asserts on them with a message showing their values:
+
+    assert a == b            ->  ____0 = (a); ____1 = (b); assert ____0 == ____1, '%r == %r' % (____0, ____1)
+
+Only plain statements and conditional expressions are emitted so CircuitPython can run the result.
+A multiline assert is joined onto its first line and the lines it took are added as empty lines after
+the statement, so all line numbers stay the same.
+"""
+
+import ast
+import io
+import tokenize
+
+COMPARE_OPS = {
+    ast.Eq: '==',
+    ast.NotEq: '!=',
+    ast.Lt: '<',
+    ast.LtE: '<=',
+    ast.Gt: '>',
+    ast.GtE: '>=',
+    ast.Is: 'is',
+    ast.IsNot: 'is not',
+    ast.In: 'in',
+    ast.NotIn: 'not in',
+}
+
+OPEN = ('(', '[', '{')
+CLOSE = (')', ']', '}')
+
+SKIP = (tokenize.COMMENT, tokenize.NL)
+
+
+class Rewriter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+        self.values = []
+
+    def temp(self, tokens):
+        name = '____%d' % (self.count,)
+        self.count += 1
+        self.statements.append('%s = (%s)' % (name, join(tokens)))
+        self.values.append(name)
+        return name
+
+    def expression(self, node, tokens):
+        """Return the test expression and message format for node, its source is tokens"""
+        tokens = strip_parens(tokens)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not) and tokens[0][1] == 'not':
+            test, fmt = self.expression(node.operand, tokens[1:])
+            return 'not (%s)' % (test,), 'not (%s)' % (fmt,)
+        if isinstance(node, ast.Compare):
+            return self.compare(node, tokens)
+        return self.temp(tokens), '%r'
+
+    def compare(self, node, tokens):
+        operands = split_compare(tokens)
+        if len(operands) != len(node.ops) + 1:
+            return self.temp(tokens), '%r'
+
+        if len(node.ops) == 1:
+            left = self.temp(operands[0])
+            op = COMPARE_OPS[type(node.ops[0])]
+            right = self.temp(operands[1])
+            return '%s %s %s' % (left, op, right), '%%r %s %%r' % (op,)
+
+        # Chained comparison: stop evaluating the operands at the first false result like Python does,
+        # the message is built as it goes and ends with that comparison
+        left, ok, msg = ['____%d' % (self.count + i,) for i in range(3)]
+        self.count += 3
+        self.statements.append('%s = (%s)' % (left, join(operands[0])))
+        for i, op in enumerate(node.ops):
+            op = COMPARE_OPS[type(op)]
+            name = '____%d' % (self.count,)
+            self.count += 1
+            if i == 0:
+                self.statements.append('%s = (%s)' % (name, join(operands[1])))
+                self.statements.append("%s = '%%r %s %%r' %% (%s, %s)" % (msg, op, left, name))
+                self.statements.append('%s = %s %s %s' % (ok, left, op, name))
+            else:
+                self.statements.append('%s = (%s) if %s else None' % (name, join(operands[i + 1]), ok))
+                self.statements.append("%s = %s + ' %s %%r' %% (%s,) if %s else %s" % (msg, msg, op, name, ok, msg))
+                self.statements.append('%s = %s and %s %s %s' % (ok, ok, left, op, name))
+            left = name
+        self.values.append(msg)
+        return ok, '%s'
+
+    def statement(self, node, tokens):
+        test, fmt = self.expression(node.test, tokens)
+        self.statements.append('assert %s, %r %% (%s,)' % (test, fmt, ', '.join(self.values)))
+        return '; '.join(self.statements)
+
+
+def join(tokens):
+    """Return the source of tokens on one line"""
+    parts = []
+    prev = None
+    for tok in tokens:
+        if tok[0] in SKIP:
+            continue
+        if prev is not None and prev[3] != tok[2]:
+            parts.append(' ')
+        parts.append(tok[1])
+        prev = tok
+    return ''.join(parts)
+
+
+def strip_parens(tokens):
+    """Remove parentheses around the whole expression"""
+    tokens = [tok for tok in tokens if tok[0] not in SKIP]
+    while len(tokens) > 1 and tokens[0][1] == '(' and tokens[-1][1] == ')':
+        depth = 0
+        for i, tok in enumerate(tokens):
+            if tok[0] != tokenize.OP:
+                continue
+            if tok[1] in OPEN:
+                depth += 1
+            elif tok[1] in CLOSE:
+                depth -= 1
+                if depth == 0 and i != len(tokens) - 1:
+                    return tokens  # (a) == (b)
+        tokens = tokens[1:-1]
+    return tokens
+
+
+def split_compare(tokens):
+    """Split tokens on the comparison operators outside brackets"""
+    operands = [[]]
+    depth = 0
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        string = tok[1] if tok[0] in (tokenize.OP, tokenize.NAME) else ''
+        nxt = tokens[i + 1][1] if i + 1 < len(tokens) else None
+        if string in OPEN:
+            depth += 1
+        elif string in CLOSE:
+            depth -= 1
+        elif depth == 0 and string in ('==', '!=', '<', '<=', '>', '>=', 'is', 'in', 'not'):
+            if (string, nxt) in (('is', 'not'), ('not', 'in')):
+                i += 1
+            operands.append([])
+            i += 1
+            continue
+        operands[-1].append(tok)
+        i += 1
+    return operands
+
+
+def statement_tokens(tokens, start):
+    """Return the expression tokens of the statement starting after start and the index of its end"""
+    depth = 0
+    i = start + 1
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok[0] == tokenize.OP and tok[1] in OPEN:
+            depth += 1
+        elif tok[0] == tokenize.OP and tok[1] in CLOSE:
+            depth -= 1
+        elif depth == 0 and (tok[0] in (tokenize.NEWLINE, tokenize.ENDMARKER) or tok[1] == ';'):
+            break
+        i += 1
+    expr = tokens[start + 1:i]
+    while expr and expr[-1][0] in SKIP:
+        expr.pop()
+    return expr, i
+
+
+def line_offsets(source):
+    offsets = [0, 0]
+    for line in io.StringIO(source):
+        offsets.append(offsets[-1] + len(line))
+    return offsets
+
+
+def rewrite_asserts(source):
+    """Return source with the asserts rewritten or None if there's nothing to rewrite"""
+    try:
+        tree = ast.parse(source)
+        tokens = list(tokenize.generate_tokens(io.StringIO(source).readline))
+    except (SyntaxError, tokenize.TokenError):
+        return None
+
+    asserts = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assert) and node.msg is None:
+            asserts[(node.lineno, node.col_offset)] = node
+    if not asserts:
+        return None
+
+    offsets = line_offsets(source)
+    edits = []
+    for index, tok in enumerate(tokens):
+        if tok[0] != tokenize.NAME or tok[1] != 'assert' or tok[2] not in asserts:
+            continue
+        node = asserts[tok[2]]
+        expr, end = statement_tokens(tokens, index)
+        if not expr:
+            continue
+        rewrite = Rewriter().statement(node, expr)
+
+        start = offsets[tok[2][0]] + tok[2][1]
+        stop = offsets[expr[-1][3][0]] + expr[-1][3][1]
+        edits.append((start, stop, rewrite))
+
+        # Keep the following lines where they were
+        lines = expr[-1][3][0] - tok[2][0] - rewrite.count('\n')
+        if lines:
+            while end < len(tokens) and tokens[end][0] != tokenize.NEWLINE:
+                end += 1
+            pos = offsets[tokens[end][3][0]] + tokens[end][3][1] if end < len(tokens) else len(source)
+            edits.append((pos, pos, '\n' * lines))
+
+    if not edits:
+        return None
+
+    for start, stop, text in sorted(edits, reverse=True):
+        source = source[:start] + text + source[stop:]
+    return source
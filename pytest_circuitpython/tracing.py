@@ -0,0 +1,71 @@
+"""Transport tracing (--board-trace=out.json)
+
+The REPL reads and writes, the command round trips, the file copies (see cpboard.Tracer) and the test
+phases are recorded as spans and written as a Chrome trace event file at the end of the session.
+Open it in chrome://tracing or https://ui.perfetto.dev.
+
+The xdist workers and the --board-matrix processes write their own file with the worker id or board
+label added to the name: out-gw0.json, out-feather.json.
+"""
+
+import os
+
+import pytest
+
+import cpboard
+
+
+def trace_path(path, suffix=None):
+    if not suffix:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s-%s%s' % (root, suffix, ext or '.json')
+
+
+class TracePlugin:
+    def __init__(self, config, path):
+        self.config = config
+        self.path = path
+        self.tracer = cpboard.Tracer()
+        cpboard.set_tracer(self.tracer)
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtestloop(self, session):
+        with cpboard.trace('runtestloop', 'pytest'):
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_setup(self, item):
+        with cpboard.trace('setup', 'pytest', nodeid=item.nodeid):
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_call(self, item):
+        with cpboard.trace('call', 'pytest', nodeid=item.nodeid):
+            yield
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item, nextitem):
+        with cpboard.trace('teardown', 'pytest', nodeid=item.nodeid):
+            yield
+
+    def save(self, suffix=None):
+        workerinput = getattr(self.config, 'workerinput', None)
+        if suffix is None and workerinput is not None:
+            suffix = workerinput.get('workerid')
+        path = trace_path(self.path, suffix)
+        self.tracer.save(path)
+        return path
+
+    @pytest.hookimpl(trylast=True)
+    def pytest_sessionfinish(self, session):
+        self.saved = self.save()
+        cpboard.set_tracer(None)
+
+    def pytest_terminal_summary(self, terminalreporter):
+        summary = self.tracer.summary()
+        tr = terminalreporter
+        tr.write_sep('=', 'board trace')
+        tr.write_line('%d round trips, %d bytes written, %d bytes read, %.3fs blocked on the link' % (
+            summary['round_trips'], summary['bytes_written'], summary['bytes_read'], summary['blocked']))
+        tr.write_line('trace written to %s' % (getattr(self, 'saved', self.path),))
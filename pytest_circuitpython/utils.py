@@ -1,5 +1,15 @@
 import cpboard
+import fnmatch
+import glob
+import hashlib
+import os
 import pytest
+import time
+
+from collections import OrderedDict
+
+from .durations import Timing
+from .recovery import check_board, is_link_error, recover
 
 
 def get_board(session):
@@ -9,14 +19,184 @@ def get_board(session):
     if not session.config.option.boarddev:
         raise pytest.exit('--board has to be set')
 
+    session.board_files = {}
+    session.board_cleanup = []
+    modules = {}
+
     try:
-        board = cpboard.CPboard.from_try_all(session.config.option.boarddev)
+        if session.config.option.board_daemon:
+            board = cpboard.DaemonBoard(session.config.option.boarddev, path=session.config.option.board_daemon)
+            state = board.client.state(board.name)
+            session.board_files.update(state['files'])
+            modules = state['modules']
+        else:
+            board = cpboard.CPboard.from_try_all(session.config.option.boarddev)
         board.open()
         board.repl.reset()
     except cpboard.CPboardError as e:
         # FIXME: How is print to console done with pytest?
         print('\nError:', str(e))
         raise session.Interrupted('Failed to access board') from e
+    except OSError as e:
+        print('\nError:', str(e))
+        raise session.Interrupted('Failed to access board daemon') from e
 
     session.board = board
+    session.board_modules = ModuleRegistry(board, modules)
+    if session.config.option.board_durations is not None:
+        session.board_timing = Timing()
     return session.board
+
+
+class ModuleRegistry:
+    """The modules imported on the board and the hash of the file they were imported from
+
+    A soft reboot or reset of the board (REPL.reboots changing) empties it,
+    so does an interrupt or a lost board (see board_exec()).
+    """
+    def __init__(self, board, modules=None):
+        self.board = board
+        self.reboots = board.repl.reboots
+        self._modules = dict(modules or {})
+
+    @property
+    def modules(self):
+        if self.board.repl.reboots != self.reboots:
+            self.reboots = self.board.repl.reboots
+            self._modules.clear()
+        return self._modules
+
+    def get(self, modname):
+        return self.modules.get(modname)
+
+    def __setitem__(self, modname, digest):
+        self.modules[modname] = digest
+
+    def pop(self, modname, default=None):
+        return self.modules.pop(modname, default)
+
+    def clear(self):
+        self._modules.clear()
+
+
+def delete_variables(session, variables):
+    """Queue variables to be deleted from the board namespace by the next command"""
+    pending = session.board_cleanup
+    for var in variables:
+        if var not in pending:
+            pending.append(var)
+
+
+def board_command(session, command):
+    """Prepend the queued cleanup to command"""
+    pending = getattr(session, 'board_cleanup', None)
+    if not pending:
+        return command
+    cleanup = '[globals().pop(_v, None) for _v in %r]\n__import__("gc").collect()\n' % (tuple(pending),)
+    del pending[:]
+    return cleanup + command
+
+
+def board_exec(session, command, **kwargs):
+    """Run command on the session board with the queued cleanup in front
+
+    A timeout or lost connection is recovered from (see recovery.py) before the error is raised.
+    """
+    check_board(session)
+    option = getattr(getattr(session, 'config', None), 'option', None)
+    kwargs.setdefault('timeout', getattr(option, 'board_timeout', 10))
+    cleanup = list(getattr(session, 'board_cleanup', None) or ())
+    start = time.monotonic()
+    try:
+        return session.board.exec(board_command(session, command), **kwargs)
+    except cpboard.CPboardRemoteError:
+        raise
+    except BaseException as e:
+        if getattr(option, 'board_recover_timeout', 0) and is_link_error(e) and recover(session, e, cleanup):
+            raise
+        # Interrupt or lost board, the board state is unknown
+        modules = getattr(session, 'board_modules', None)
+        if modules is not None:
+            modules.clear()
+        raise
+    finally:
+        round_trip(session, start)
+
+
+def round_trip(session, start):
+    """Account a request to the board that started at start (--board-durations)"""
+    timing = getattr(session, 'board_timing', None)
+    if timing is not None:
+        timing.round_trip(time.monotonic() - start)
+
+
+def flush_cleanup(session):
+    if getattr(session, 'board_cleanup', None) and getattr(session, 'board', None) and \
+            getattr(session, 'board_lost', None) is None:
+        board_exec(session, '', reset_repl=False, raise_remote=True)
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def board_pool(spec):
+    """Expand the --board value into a list of boards
+
+    spec is a comma separated list of build names, vid:pid's, serial numbers or tty's.
+    Glob patterns are matched against the build name, serial number and tty of the attached boards,
+    each match is added by serial number (tty if it has none) so it refers to one specific board.
+    """
+    pool = []
+    for pattern in spec.split(','):
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        if glob.has_magic(pattern):
+            names = match_boards(pattern)
+            if not names:
+                raise pytest.UsageError('--board: no attached board matches %r' % (pattern,))
+        else:
+            names = [pattern]
+        for name in names:
+            if name not in pool:
+                pool.append(name)
+    if not pool:
+        raise pytest.UsageError('--board: no board given')
+    return pool
+
+
+def match_boards(pattern):
+    registry = cpboard.get_registry()
+    names = []
+    for dev in registry.devices:
+        build_name, bootloader = registry.lookup(dev)
+        if bootloader or not dev.ttys:
+            continue
+        ttys = [os.path.realpath(tty) for tty in dev.ttys]
+        candidates = [build_name, dev.serial_number] + ttys
+        if any(candidate and fnmatch.fnmatchcase(candidate, pattern) for candidate in candidates):
+            names.append(dev.serial_number or ttys[0])
+    return names
+
+
+def board_labels(pool):
+    """Return an OrderedDict mapping a label, the build name if known, to each board in the pool"""
+    registry = cpboard.get_registry()
+    names = []
+    for name in pool:
+        if name in registry.boards:
+            names.append(name)
+            continue
+        devs = registry.find(serial_number=name) or \
+            [dev for dev in registry.devices if name in [os.path.realpath(tty) for tty in dev.ttys]]
+        build_name = registry.lookup(devs[0])[0] if devs else None
+        names.append(build_name or os.path.basename(name))
+
+    labels = OrderedDict()
+    for name, label in zip(pool, names):
+        if names.count(label) > 1:
+            label = '%s-%s' % (label, os.path.basename(name))
+        labels[label] = name
+    return labels
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import pytest
+
 
 def test_help_message(testdir):
     result = testdir.runpytest(
@@ -76,3 +78,979 @@ def xtest_hello_ini_setting(testdir):
 
     # make sure that that we get a '0' exit code for the testsuite
     assert result.ret == 0
+
+
+def test_pool_glob(monkeypatch):
+    import cpboard
+    from pytest_circuitpython.utils import board_pool
+
+    registry = cpboard.BoardRegistry({'metro_m4_express': {'usb': ['239a:8021'], 'bootloader': ['239a:0021']}})
+    registry._devices = []
+    for port, pid, serial_number, tty in [('1-1', 0x8021, 'AAAA', 'ttyACM0'), ('1-2', 0x8021, None, 'ttyACM1'),
+                                          ('1-3', 0x0021, 'CCCC', 'ttyACM2'), ('1-4', 0x1234, 'DDDD', 'ttyUSB0')]:
+        dev = cpboard.UsbDevice('/sys/devices/usb1/' + port, 0x239a, pid, serial_number=serial_number)
+        dev.ttys.append('/dev/' + tty)
+        registry._devices.append(dev)
+    monkeypatch.setattr(cpboard, '_registry', registry)
+
+    assert board_pool('metro_m4_express*') == ['AAAA', '/dev/ttyACM1']
+    assert board_pool('/dev/ttyUSB*,AAAA, metro_m4_express') == ['DDDD', 'AAAA', 'metro_m4_express']
+
+    with pytest.raises(pytest.UsageError):
+        board_pool('feather*')
+
+    from pytest_circuitpython.utils import board_labels
+    assert list(board_labels(['AAAA', '/dev/ttyACM1']).items()) == [('metro_m4_express-AAAA', 'AAAA'),
+                                                                    ('metro_m4_express-ttyACM1', '/dev/ttyACM1')]
+    assert list(board_labels(['DDDD', 'metro_m4_express'])) == ['DDDD', 'metro_m4_express']
+
+
+def test_pool_xdist(testdir):
+    pytest.importorskip('xdist')
+    outdir = testdir.mkdir('out')
+    testdir.makepyfile(test_lease="""
+        import pytest
+
+        @pytest.mark.parametrize('n', range(6))
+        def test_lease(request, worker_id, n):
+            with open(%r + '/' + worker_id, 'w') as f:
+                f.write(request.config.option.boarddev)
+    """ % str(outdir))
+
+    result = testdir.runpytest('-n', '3', '--board=/dev/a, /dev/b')
+
+    result.stdout.fnmatch_lines([
+        'board pool: /dev/a, /dev/b (2 workers)',
+        '*6 passed*',
+    ])
+    assert sorted(outdir.listdir()) == [outdir.join('gw0'), outdir.join('gw1')]
+    assert outdir.join('gw0').read() == '/dev/a'
+    assert outdir.join('gw1').read() == '/dev/b'
+
+
+def test_matrix(testdir):
+    testdir.makepyfile(test_board_matrix_x="""
+        def test_one(board_name):
+            assert board_name
+    """)
+    testdir.makepyfile(test_host="""
+        def test_host(board_name):
+            assert board_name == '/dev/noexist-a'
+    """)
+
+    result = testdir.runpytest('--collect-only', '--board-matrix', '--board=/dev/noexist-a,/dev/noexist-b')
+    result.stdout.fnmatch_lines([
+        'board matrix: noexist-a (/dev/noexist-a), noexist-b (/dev/noexist-b)',
+        "*<Function 'test_one[[]noexist-a[]]'>",
+        "*<Function 'test_one[[]noexist-b[]]'>",
+        "*<Function 'test_host'>",
+    ])
+
+    # Each board runs in its own process, the host test in the main process
+    result = testdir.runpytest('-v', '--board-matrix', '--board=/dev/noexist-a,/dev/noexist-b')
+    result.stdout.fnmatch_lines([
+        '*test_host.py::test_host PASSED*',
+        '*- board noexist-a (/dev/noexist-a): 1 tests in * -*',
+        '*test_one[[]noexist-a[]] ERROR*',
+        '*- board noexist-b (/dev/noexist-b): 1 tests in * -*',
+        '*test_one[[]noexist-b[]] ERROR*',
+        '*ERROR at setup of test_one[[]noexist-a[]]*',
+        'Interrupted: Failed to access board',
+        '*failed to access /dev/noexist-a',
+        '*1 passed, 2 error*',
+    ])
+
+
+def test_batch_runner(testdir, monkeypatch, capsys):
+    import importlib.util
+    import os
+    import sys
+    from pytest_circuitpython.batch import BatchReader
+
+    boardlib = os.path.join(os.path.dirname(__file__), '..', 'pytest_circuitpython', 'boardlib')
+    modules = {}
+    for name in ('pytest', 'pytest_runner'):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(boardlib, name + '.py'))
+        modules[name] = importlib.util.module_from_spec(spec)
+        # pytest_runner imports the board pytest module
+        monkeypatch.setitem(sys.modules, name, modules[name])
+        spec.loader.exec_module(modules[name])
+    runner = modules['pytest_runner']
+
+    testdir.makepyfile(test_board_batched="""
+        events = []
+
+        def one(request):
+            events.append('one')
+            yield 1
+            events.append('one done')
+
+        def two(request, one):
+            return one + 1
+
+        def mod(request):
+            events.append('mod')
+            yield
+            events.append('mod done')
+
+        def sess(request):
+            yield
+            events.append('sess done')
+
+        def test_pass(two):
+            print('output', end='')
+            assert two == 2
+
+        def test_fail(one, x):
+            assert one == x, 'message'
+
+        class TestBoardClass:
+            def test_events(self):
+                self.t = 1
+                assert events == ['mod', 'one', 'one done', 'one', 'one done']
+
+            def test_instance(self):
+                assert self.t == 1
+
+        def test_last():
+            assert 'mod done' not in events
+    """)
+    monkeypatch.chdir(testdir.tmpdir)
+    monkeypatch.syspath_prepend(str(testdir.tmpdir))
+    capsys.readouterr()
+
+    mod = 'test_board_batched'
+    fixtures = {
+        'one': (mod, 'one', ('request',), 'function', True),
+        'two': (mod, 'two', ('request', 'one'), 'function', False),
+        'mod': (mod, 'mod', ('request',), 'module', True),
+        'sess': (mod, 'sess', ('request',), 'session', True),
+    }
+    tests = [
+        (mod, None, 'test_pass', ('two',), ('mod', 'sess', 'two', 'one'), {}),
+        (mod, None, 'test_fail', ('one', 'x'), ('mod', 'sess', 'one'), {'x': 3}),
+        (mod, 'TestBoardClass', 'test_events', (), ('mod', 'sess'), {}),
+        (mod, 'TestBoardClass', 'test_instance', (), ('mod', 'sess'), {}),
+        (mod, None, 'test_last', (), ('sess',), {}),
+    ]
+    runner.run([(mod, str(testdir.tmpdir))], fixtures, tests, True)
+
+    reader = BatchReader()
+    out = capsys.readouterr().out
+    # Frames split across reads
+    for i in range(0, len(out), 7):
+        reader.write(out[i:i + 7])
+    records = reader.records
+    assert len(records) == 15
+    assert all(records[(i, when)][0] == 'passed' for i in range(5) for when in ('setup', 'teardown'))
+    assert [records[(i, 'call')][0] for i in range(5)] == ['passed', 'failed', 'passed', 'passed', 'passed']
+    assert records[(0, 'call')][2] == 'output'
+    outcome, duration, output, exc, where, tb = records[(1, 'call')]
+    assert exc[0] == 'AssertionError' and exc[1].startswith('message')
+    assert where == (mod + '.py', 25, 'test_fail')
+    assert 'AssertionError' in tb
+    assert 0 < duration < 1
+    assert runner._session == {}
+    assert sys.modules[mod].events[-2:] == ['mod done', 'sess done']
+
+    # Heap measurements, the module fixture allocation is reported as wider
+    heap = [1000]
+    gc = type('gc', (), {'collect': staticmethod(lambda: None), 'mem_alloc': staticmethod(lambda: heap[0]),
+                         'mem_free': staticmethod(lambda: 10000 - heap[0])})
+    monkeypatch.setattr(runner, 'gc', gc)
+    fixtures['mod'] = (mod, 'grow', ('request',), 'module', False)
+    monkeypatch.setattr(sys.modules[mod], 'grow', lambda request: heap.__setitem__(0, heap[0] + 100), raising=False)
+    runner.run([], fixtures, [(mod, None, 'test_last', (), ('mod',), {})], True, True)
+    reader = BatchReader()
+    reader.write(capsys.readouterr().out)
+    assert reader.memory[(0, 'setup')] == (9000, 1000, 8900, 1100, 100)
+    assert reader.memory[(0, 'teardown')] == (8900, 1100, 8900, 1100, 0)
+
+
+def test_deferred_cleanup():
+    from pytest_circuitpython.utils import delete_variables, board_exec, flush_cleanup
+
+    class Board:
+        def __init__(self):
+            self.namespace = {'funcarg_a_val': 1, 'res': 2, 'keep': 3}
+            self.commands = []
+
+        def exec(self, command, **kwargs):
+            self.commands.append(command)
+            exec(command, self.namespace)
+            return b''
+
+    class Session:
+        board = Board()
+        board_cleanup = []
+
+    session = Session()
+    delete_variables(session, ['funcarg_a_val', 'res'])
+    delete_variables(session, ['res', 'fixture_b_val'])
+    assert session.board.commands == []
+
+    board_exec(session, 'x = 1')
+    assert len(session.board.commands) == 1
+    assert sorted(k for k in session.board.namespace if k != '__builtins__') == ['keep', 'x']
+
+    # Nothing queued, nothing prepended
+    board_exec(session, 'y = 2')
+    assert session.board.commands[-1] == 'y = 2'
+
+    flush_cleanup(session)
+    assert len(session.board.commands) == 2
+    delete_variables(session, ['x'])
+    flush_cleanup(session)
+    assert len(session.board.commands) == 3
+    assert 'x' not in session.board.namespace
+
+
+def test_recovery_cleanup():
+    import cpboard
+    from pytest_circuitpython.utils import delete_variables, board_exec
+
+    class Board:
+        repl = type('REPL', (), {'reboots': 0})()
+
+        def exec(self, command, **kwargs):
+            raise cpboard.CPboardError('read error') from TimeoutError(110, 'timeout waiting for', b'\x04')
+
+        def recover(self, timeout):
+            return ['interrupt']
+
+    class Session:
+        board = Board()
+        board_cleanup = []
+        config = type('Config', (), {'option': type('Option', (), {'board_timeout': 1,
+                                                                   'board_recover_timeout': 30})})
+
+    session = Session()
+    delete_variables(session, ['funcarg_a_val', 'res'])
+    with pytest.raises(cpboard.CPboardError):
+        board_exec(session, 'x = 1')
+    # The interrupted command might not have deleted them
+    assert session.board_cleanup == ['funcarg_a_val', 'res']
+    assert session.board_recovery[0]['steps'] == ['interrupt']
+    assert session.board_recovery[0]['error'].startswith('TimeoutError')
+
+
+def test_remote_import_registry():
+    from pytest_circuitpython import remote_import
+    from pytest_circuitpython.utils import ModuleRegistry, board_exec
+
+    class Board:
+        def __init__(self):
+            self.repl = type('REPL', (), {'reboots': 0})()
+            self.commands = []
+            self.error = None
+
+        def exec(self, command, **kwargs):
+            if self.error:
+                raise self.error
+            self.commands.append(command)
+            return b''
+
+    class Session:
+        config = type('Config', (), {'option': type('Option', (), {'verbose': 0})()})()
+        board = Board()
+        board_cleanup = []
+        board_files = {'/tmp.pytest/s/test_board_x.py': 'aaa'}
+
+    session = Session()
+    session.board_modules = ModuleRegistry(session.board)
+    path = '/tmp.pytest/s/test_board_x.py'
+
+    remote_import(session, path)
+    remote_import(session, path)
+    assert len(session.board.commands) == 1
+    assert "sys.modules.pop('test_board_x', None)" in session.board.commands[0]
+    assert 'import test_board_x\n' in session.board.commands[0]
+
+    # Changed file
+    session.board_files[path] = 'bbb'
+    remote_import(session, path)
+    remote_import(session, path)
+    assert len(session.board.commands) == 2
+
+    # Soft reboot
+    session.board.repl.reboots += 1
+    remote_import(session, path)
+    assert len(session.board.commands) == 3
+
+    # Lost track of the board state
+    session.board.error = TimeoutError()
+    with pytest.raises(TimeoutError):
+        board_exec(session, 'pass')
+    session.board.error = None
+    remote_import(session, path)
+    assert len(session.board.commands) == 4
+
+
+def test_assert_rewrite():
+    from pytest_circuitpython.rewrite import rewrite_asserts
+
+    source = '''def check(a, b):
+    if a == 'eq':
+        assert b == 2  # comment
+    elif a == 'not':
+        assert not b == 2
+    elif a == 'is not':
+        assert b is not None
+    elif a == 'multiline':
+        assert (b
+                not in [1, 2])
+    elif a == 'chain':
+        assert 0 <= b <= 1 < len(b)
+    elif a == 'message':
+        assert b, 'message'
+    elif a == 'not chain':
+        assert not 0 <= b <= 1
+    return b
+'''
+    rewrite = rewrite_asserts(source)
+    assert len(rewrite.splitlines()) == len(source.splitlines())
+    assert rewrite.splitlines()[12:15] == source.splitlines()[12:15]
+
+    namespace = {}
+    exec(compile(rewrite, 'test_board_x.py', 'exec'), namespace)
+
+    def failure(*args):
+        with pytest.raises(AssertionError) as excinfo:
+            namespace['check'](*args)
+        return str(excinfo.value), excinfo.tb.tb_next.tb_lineno
+
+    assert failure('eq', 1) == ('1 == 2', 3)
+    assert failure('not', 2) == ('not (2 == 2)', 5)
+    assert failure('is not', None) == ('None is not None', 7)
+    assert failure('multiline', 2) == ('2 not in [1, 2]', 9)
+    # The operands after a false comparison are not evaluated nor shown
+    assert failure('chain', -1) == ('0 <= -1', 12)
+    assert failure('chain', 2) == ('0 <= 2 <= 1', 12)
+    assert failure('not chain', 1) == ('not (0 <= 1 <= 1)', 16)
+    assert failure('message', 0) == ('message', 14)
+    assert namespace['check']('multiline', 3) == 3
+
+    assert rewrite_asserts('x = 1\n') is None
+    assert rewrite_asserts('assert x, "message"\n') is None
+    assert rewrite_asserts('assert (\n') is None
+
+
+def test_prepare_files(tmpdir, monkeypatch):
+    import os
+    from pytest_circuitpython import prepare
+
+    class Config:
+        option = type('Option', (), {'verbose': 0})()
+        assertmode = 'rewrite'
+
+        def getvalue(self, name):
+            return getattr(self, name)
+
+    class Session:
+        fspath = tmpdir
+        config = Config()
+
+    one = tmpdir.join('test_board_one.py')
+    one.write('def test_one():\n    assert 1 == 2\n')
+    two = tmpdir.join('sub').ensure('test_board_two.py')
+    two.write('def test_two():\n    assert True\n')
+
+    # Both files are missing from the cache and prepared in parallel
+    monkeypatch.setattr(prepare, 'POOL_MIN_FILES', 2)
+    prepared = prepare.prepare_files(Session(), [str(one), str(two)])
+    assert [os.path.basename(p) for p in prepared] == ['test_board_one.py', 'test_board_two.py']
+    assert all(p.startswith(str(tmpdir.join('.pytest_board_cache'))) for p in prepared)
+    with open(prepared[0]) as f:
+        assert '%r == %r' in f.read()
+
+    # Unchanged files are looked up
+    def transform(path, transforms):
+        raise AssertionError('transformed %s' % (path,))
+
+    monkeypatch.setattr(prepare, 'transform', transform)
+    assert prepare.prepare_files(Session(), [str(one), str(two)]) == prepared
+
+    one.write('def test_one():\n    assert 1 == 3\n')
+    with pytest.raises(AssertionError):
+        prepare.prepare_files(Session(), [str(one)])
+    monkeypatch.undo()
+
+    # A few files are prepared without starting a process pool
+    def pool(*args):
+        raise AssertionError('process pool started')
+
+    monkeypatch.setattr(prepare.concurrent.futures, 'ProcessPoolExecutor', pool)
+    changed = prepare.prepare_files(Session(), [str(one)])
+    assert changed != prepared[:1]
+
+    # The entry of the previous version is removed, the other files and the collect cache are kept
+    cache = tmpdir.join('.pytest_board_cache')
+    cache.ensure('collect', dir=True)
+    assert not os.path.exists(prepared[0])
+    assert os.path.exists(prepared[1]) and os.path.exists(changed[0])
+    one.write('def test_one():\n    assert 1 == 2\n')
+    assert prepare.prepare_files(Session(), [str(one)]) == prepared[:1]
+    assert sorted(entry.basename for entry in cache.listdir()) == sorted(
+        [os.path.basename(os.path.dirname(p)) for p in prepared] + ['collect'])
+
+    Session.config.assertmode = 'plain'
+    assert prepare.prepare_files(Session(), [str(one)]) == [str(one)]
+
+
+def test_static_collect(testdir):
+    testdir.makepyfile(test_board_static='''
+        import board
+        import pytest
+        from pytest import fixture
+
+        open('module_ran', 'w').close()
+        DATA = [(1, 2), (3, 4)]
+
+
+        @fixture(scope='module')
+        def pin(request):
+            yield board.D0
+
+
+        @pytest.mark.parametrize('a, b', DATA)
+        def test_data(pin, a, b, c=board.D1):
+            assert a < b
+
+
+        class TestBoardClass:
+            values = DATA[:1]
+
+            def test_one(self):
+                pass
+    ''')
+    result = testdir.runpytest('--board', 'dummy', '--board-collect', 'static', '--collect-only')
+    result.stdout.fnmatch_lines([
+        "*<Function 'test_data?1-2?'>",
+        "*<Function 'test_data?3-4?'>",
+        "*<Function 'test_one'>",
+    ])
+    assert not testdir.tmpdir.join('module_ran').exists()
+    assert testdir.tmpdir.join('.pytest_board_cache', 'collect').listdir()
+
+    # Collected from the cache
+    result = testdir.runpytest('--board', 'dummy', '--board-collect', 'static', '--collect-only')
+    result.stdout.fnmatch_lines(["*3 items*"])
+    assert not testdir.tmpdir.join('module_ran').exists()
+
+    result = testdir.runpytest('--board', 'dummy', '--collect-only')
+    result.stdout.fnmatch_lines(["*3 items*"])
+    assert testdir.tmpdir.join('module_ran').exists()
+
+
+def test_static_collect_helper(testdir):
+    testdir.makepyfile(test_board_helper='''
+        import pytest
+
+        def make_data():
+            return [1, 2, 3]
+
+        DATA = make_data()
+
+        @pytest.mark.parametrize('x', DATA)
+        def test_x(x):
+            pass
+
+        @pytest.mark.parametrize('y', make_data()[:2])
+        def test_y(y):
+            pass
+    ''')
+    # The helper has no body in the stub, so the module is imported
+    result = testdir.runpytest('--board', 'dummy', '--board-collect', 'static', '--collect-only')
+    result.stdout.fnmatch_lines([
+        "*5 items*",
+        "*<Function 'test_x?1?'>",
+        "*<Function 'test_x?3?'>",
+        "*<Function 'test_y?2?'>",
+    ])
+
+
+def test_remote_object():
+    import contextlib
+    import gc
+    import io
+    from pytest_circuitpython.remote import RemoteObject, frame_value, value_command, FrameFilter
+
+    class Pin:
+        def __init__(self, name):
+            self.name = name
+            self.value = False
+
+        def sibling(self, name):
+            return Pin(name)
+
+        def names(self):
+            return [self.name]
+
+    class Board:
+        def __init__(self):
+            self.namespace = {'Pin': Pin}
+            self.commands = []
+
+        def exec(self, command, out=None, **kwargs):
+            self.commands.append(command)
+            buf = io.StringIO()
+            with contextlib.redirect_stdout(buf):
+                exec(command, self.namespace)
+            if out:
+                out.write(buf.getvalue())
+            return buf.getvalue().encode()
+
+    class Session:
+        board = Board()
+        board_cleanup = []
+
+    session = Session()
+    board = session.board
+
+    # Plain values are transferred, the rest stays on the board
+    out = FrameFilter(io.StringIO())
+    board.exec('res = 42\nprint("hello")\n' + value_command('res'), out=out)
+    assert out.out.getvalue() == 'hello\n'
+    assert frame_value(session, out.frames['V'], 'res') == 42
+    out = FrameFilter(io.StringIO())
+    board.exec('res = Pin("D0")\n' + value_command('res'), out=out)
+    assert out.frames == {'V': ''}
+    pin = frame_value(session, out.frames['V'], 'res')
+    assert isinstance(pin, RemoteObject)
+    assert repr(pin) == '<RemoteObject res>'
+
+    # Attribute access doesn't talk to the board
+    count = len(board.commands)
+    name = pin.name
+    assert len(board.commands) == count
+    assert name == 'D0'
+    assert 'D0' in pin.names()
+
+    pin.value = True
+    assert board.namespace['res'].value is True
+    assert pin.value
+
+    sibling = pin.sibling('D1')
+    assert isinstance(sibling, RemoteObject)
+    assert sibling.name == 'D1'
+    variable = repr(sibling)[len('<RemoteObject '):-1]
+    assert variable in board.namespace
+    del sibling
+    gc.collect()
+    assert session.board_cleanup == [variable]
+
+
+def test_memory(monkeypatch):
+    import io
+    import sys
+    import types
+    from pytest_circuitpython.memory import heap_command, add_measurement, end_heap_phase, possible_leaks, LEAK_RUNS
+    from pytest_circuitpython.remote import FrameFilter
+
+    heap = {'alloc': 1000}
+    gc = types.ModuleType('gc')
+    gc.collect = lambda: None
+    gc.mem_alloc = lambda: heap['alloc']
+    gc.mem_free = lambda: 10000 - heap['alloc']
+    monkeypatch.setitem(sys.modules, 'gc', gc)
+
+    def alloc(n):
+        heap['alloc'] += n
+
+    def fail():
+        alloc(50)
+        raise ValueError()
+
+    namespace = {'alloc': alloc, 'fail': fail}
+    out = FrameFilter(io.StringIO())
+    with monkeypatch.context() as m:
+        m.setattr(sys, 'stdout', out)
+        exec(heap_command('alloc(100)\nprint("output")'), namespace)
+        assert out.frames['M'] == repr((9000, 1000, 8900, 1100))
+        with pytest.raises(ValueError):
+            exec(heap_command('fail()'), namespace)
+    assert out.frames['M'] == repr((8900, 1100, 8850, 1150))
+    assert out.out.getvalue() == 'output\n'
+    assert '____mem' not in namespace
+
+    class Config:
+        cache = None
+
+    class Item:
+        config = Config()
+        nodeid = 'test_board_x.py::test_x'
+        user_properties = []
+
+    item = Item()
+    add_measurement(item.config, '(9000, 1000, 8900, 1100)', wider=True)  # module fixture
+    add_measurement(item.config, '(8900, 1100, 8880, 1120)')
+    end_heap_phase(item, 'setup')
+    add_measurement(item.config, '(8880, 1120, 8700, 1300)')
+    end_heap_phase(item, 'call')
+    add_measurement(item.config, (8700, 1300, 8860, 1140, 0))
+    end_heap_phase(item, 'teardown')
+    assert item.user_properties == [('board_mem_setup', 120), ('board_mem_call', 180), ('board_mem_teardown', -160),
+                                    ('board_mem_retained', 40), ('board_mem_free', 8700)]
+    assert item.config.board_heap.peak == 1300
+    assert item.config.board_heap.lowest == 8700
+
+    class Cache(dict):
+        def set(self, key, value):
+            self[key] = value
+
+    Config.cache = Cache()
+    for run in range(LEAK_RUNS):
+        # b retains the same each run (a cached import), c stops growing
+        retained = {'a': 10 * (run + 1), 'b': 16, 'c': 10 * min(run, 1) + 10, 'd': 0}
+        assert possible_leaks(Config(), retained) == (['a'] if run == LEAK_RUNS - 1 else [])
+    assert possible_leaks(Config(), {'a': -10}) == []
+
+
+def test_durations(monkeypatch):
+    import io
+    import sys
+    from pytest_circuitpython.durations import timed_command, add_board_time, end_timing_phase, Timing
+    from pytest_circuitpython.remote import FrameFilter
+    from pytest_circuitpython.utils import board_exec
+
+    class Board:
+        namespace = {}
+
+        def exec(self, command, out=None, **kwargs):
+            with monkeypatch.context() as m:
+                m.setattr(sys, 'stdout', out)
+                exec(command, self.namespace)
+            return b''
+
+    class Session:
+        board = Board()
+        board_cleanup = []
+        board_timing = Timing()
+
+    session = Session()
+    out = FrameFilter(io.StringIO())
+    board_exec(session, timed_command('print("output")\nx = sum(range(1000))'), out=out)
+    assert out.out.getvalue() == 'output\n'
+    assert 0 < int(out.frames['T']) < 1e9
+    assert '____t' not in session.board.namespace
+    out = FrameFilter(io.StringIO())
+    with pytest.raises(ZeroDivisionError):
+        board_exec(session, timed_command('1 / 0'), out=out)
+    assert 'T' in out.frames
+
+    # Board time in ns from the T frame or seconds from the batch runner
+    session.board_timing.board = 0
+    add_board_time(session, '2000000')
+    add_board_time(session, 0.5)
+    session.board_timing.link = 1.0
+
+    class Item:
+        pass
+
+    class Call:
+        start = 10.0
+        stop = 12.0
+
+    class Report:
+        pass
+
+    item = Item()
+    item.session = session
+    report = Report()
+    end_timing_phase(item, Call(), report)
+    total, board, link, round_trips = report.board_timing
+    assert (total, round_trips) == (2.0, 2)
+    assert abs(board - 0.502) < 1e-9 and abs(link - 0.498) < 1e-9
+
+    # Nothing happened on the board
+    report = Report()
+    end_timing_phase(item, Call(), report)
+    assert not hasattr(report, 'board_timing')
+
+    # The batch request is split over the phases, the time not on the board in equal parts
+    from pytest_circuitpython.batch import BoardBatch
+    batch = BoardBatch(session)
+    batch.items = [Item(), Item()]
+    batch.reader = Item()
+    batch.reader.records = dict(((index, when), ('passed', duration, '', None, None, None)) for index, when, duration in
+                                ((0, 'setup', 0.1), (0, 'call', 0.3), (1, 'call', 0.6)))
+    batch.elapsed = 2.0
+    batch.trigger = (0, 'setup')
+    for item in batch.items:
+        item.session = session
+        item.board_batch = batch
+
+    class SetupCall:
+        when = 'setup'
+        start = 10.0
+        stop = 12.1  # The request and 0.1s on the host
+
+    add_board_time(session, 0.1)
+    report = Report()
+    end_timing_phase(batch.items[0], SetupCall(), report)
+    total, board, link, round_trips = report.board_timing
+    assert round_trips == 1 and abs(total - (0.1 + 0.1 + 1 / 3)) < 1e-9
+    assert abs(board - 0.1) < 1e-9 and abs(link - 1 / 3) < 1e-9
+
+    class CallCall:
+        when = 'call'
+        start = 12.1
+        stop = 12.15
+
+    add_board_time(session, 0.6)
+    report = Report()
+    end_timing_phase(batch.items[1], CallCall(), report)
+    total, board, link, round_trips = report.board_timing
+    assert round_trips == 0 and abs(total - (0.05 + 0.6 + 1 / 3)) < 1e-9 and abs(link - 1 / 3) < 1e-9
+
+
+def test_trace(testdir):
+    import json
+    import cpboard
+    from pytest_circuitpython.tracing import trace_path
+
+    assert trace_path('out.json') == 'out.json'
+    assert trace_path('out.json', 'gw1') == 'out-gw1.json'
+    assert trace_path('out', 'feather') == 'out-feather.json'
+
+    testdir.makepyfile(test_board_trace="""
+        def test_host():
+            pass
+    """)
+    result = testdir.runpytest('--board-trace=trace.json')
+    result.stdout.fnmatch_lines([
+        '*board trace*',
+        '0 round trips, 0 bytes written, 0 bytes read, 0.000s blocked on the link',
+        'trace written to trace.json',
+    ])
+    assert result.ret == 0
+    assert cpboard.get_tracer() is None
+    events = json.loads(testdir.tmpdir.join('trace.json').read())['traceEvents']
+    assert [(event['name'], event['args'].get('nodeid')) for event in events] == [
+        ('setup', 'test_board_trace.py::test_host'),
+        ('call', 'test_board_trace.py::test_host'),
+        ('teardown', 'test_board_trace.py::test_host'),
+        ('runtestloop', None),
+    ]
+
+
+def test_benchmark(testdir, monkeypatch):
+    import sys
+    from pytest_circuitpython.benchmark import BoardBenchmark, summarize
+
+    class Board:
+        namespace = {'math': __import__('math')}
+
+        def exec(self, command, out=None, **kwargs):
+            with monkeypatch.context() as m:
+                m.setattr(sys, 'stdout', out)
+                exec(command, self.namespace)
+            return b''
+
+    class Session:
+        board = Board()
+        board_cleanup = []
+
+    class Item:
+        session = Session()
+
+    item = Item()
+    benchmark = BoardBenchmark(item)
+    stats = benchmark.pedantic('math.factorial', args=(20,), rounds=3, round_time=0.01)
+    assert stats['rounds'] == 3 and stats['iterations'] > 1
+    assert 0 <= stats['min'] <= stats['median'] <= stats['max'] < 0.01
+    assert item.board_benchmark is stats
+    assert '____f' in Session.board_cleanup and '____loop' in Session.board_cleanup
+    with pytest.raises(RuntimeError):
+        benchmark('math.factorial', 20)
+    with pytest.raises(TypeError):
+        BoardBenchmark(item)(lambda: None)
+
+    stats = summarize(10, [(3000, 1000), (5000, 1000), (4000, 1000), (900, 1000)])
+    assert (stats['min'], stats['median'], stats['max']) == (0, 2.5e-7, 4e-7)
+    assert stats['baseline'] == 1e-7
+
+    # Results saved by the first run are compared by the second
+    testdir.makepyfile(test_board_benchmark="""
+        import os
+
+        def test_speed(request):
+            request.node.board_benchmark = {'min': 1e-6, 'max': 3e-6, 'mean': 2e-6, 'median': 2e-6, 'stddev': 1e-6,
+                                            'rounds': 5, 'iterations': 100 * int(os.environ.get('FACTOR', 1))}
+    """)
+    result = testdir.runpytest('--board-benchmark-json=first.json')
+    result.stdout.fnmatch_lines([
+        '*board benchmark (times in us)*',
+        '*1.000*2.000*3.000*1.000*5*100 *test_board_benchmark.py::test_speed',
+        'results saved to first.json',
+    ])
+    monkeypatch.setenv('FACTOR', '2')
+    result = testdir.runpytest('--board-benchmark-compare=first.json')
+    result.stdout.fnmatch_lines([
+        '*200*+0.0%  test_board_benchmark.py::test_speed',
+    ])
+
+
+def test_sim(testdir):
+    testdir.makepyfile(test_board_sim="""
+        import pytest
+
+        @pytest.fixture
+        def board_value(request):
+            yield 21
+
+        def test_value(board_value):
+            import sys
+            assert sys.platform == 'sim'
+            assert board_value * 2 == 42
+
+        def test_fail():
+            x = 1
+            assert x == 2
+    """)
+    result = testdir.runpytest('--board', 'sim:plugin', '-v')
+    result.stdout.fnmatch_lines([
+        '*::test_value PASSED*',
+        '*::test_fail FAILED*',
+        '*AssertionError: 1 == 2',
+    ])
+    assert result.ret == 1
+
+
+def test_recovery(testdir):
+    testdir.makepyfile(test_board_recovery="""
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def board_values(request):
+            yield [0]
+
+        def test_append(board_values):
+            board_values.append(1)
+
+        def test_hang():
+            while True:
+                pass
+
+        def test_interrupted(board_values):
+            assert board_values == [0, 1]
+
+        def test_crash():
+            import microcontroller
+            microcontroller.on_next_reset(microcontroller.RunMode.SAFE_MODE)
+            microcontroller.reset()
+
+        def test_rebooted(board_values):
+            assert board_values == [0]
+    """)
+    result = testdir.runpytest('--board', 'sim:recovery', '--board-timeout', '1', '-v')
+    result.stdout.fnmatch_lines([
+        '*::test_append PASSED*',
+        '*::test_hang ERROR*',
+        '*::test_interrupted PASSED*',
+        '*::test_crash ERROR*',
+        '*::test_rebooted PASSED*',
+        '*= board recovery =*',
+        '*s call     test_board_recovery.py::test_hang',
+        '*TimeoutError: * -> interrupt',
+        '*s call     test_board_recovery.py::test_crash',
+        '* -> interrupt, reopen, soft reboot, hard reset',
+        '*3 passed, 2 error*',
+    ])
+    assert result.ret == 1
+
+
+def test_recovery_batch(testdir):
+    testdir.makepyfile(test_board_recovery_batch="""
+        def test_before():
+            pass
+
+        def test_hang():
+            while True:
+                pass
+
+        def test_after():
+            pass
+    """)
+    result = testdir.runpytest('--board', 'sim:recovery', '--board-timeout', '1', '--board-batch=module', '-v')
+    result.stdout.fnmatch_lines([
+        '*::test_before PASSED*',
+        '*::test_hang ERROR*',
+        '*::test_after PASSED*',
+        '*s call     test_board_recovery_batch.py::test_hang',
+        '*2 passed, 1 error*',
+    ])
+
+
+def test_hostbench(tmpdir):
+    import json
+    from pytest_circuitpython import hostbench
+
+    results = {}
+    hostbench.bench_read_until(results, 2, sizes=(4,))
+    hostbench.bench_eval(results, 1)
+    hostbench.bench_rewrite(results, 1, sizes=(10,))
+    assert results['read_until_4k']['n'] == 2 and results['read_until_4k']['bytes'] == 4 * 1024
+    assert 'unpickle_namedtuple' in results and 'rewrite_10' in results
+    assert not [name for name, res in results.items() if 'error' in res]
+
+    # Too few tests to tell the overhead apart from the noise
+    results = {}
+    hostbench.bench_session(results, 'sim:hostbench', tests=2)
+    assert results['session_2']['n'] == 2 and 'per_test' in results['session_2']
+    assert results['session_batch_2']['n'] == 2
+
+    path = tmpdir.join('results.json')
+    hostbench.main(['eval', '-n', '1', '--json', str(path)])
+    report = json.loads(path.read())
+    assert report['board'] == 'sim:hostbench' and report['results']['eval_str_64k']['n'] == 1
+
+
+def test_order(testdir):
+    testdir.makepyfile(test_board_a="""
+        import pytest
+
+        @pytest.fixture(scope='module')
+        def board_m(request):
+            return 1
+
+        def test_1(board_m):
+            pass
+
+        def test_2(board_m):
+            pass
+
+        @pytest.mark.dependency()
+        def test_3(board_m):
+            pass
+    """, test_board_b="""
+        def test_1():
+            pass
+    """, test_host="""
+        def test_h():
+            pass
+    """)
+    args = ['test_board_a.py::test_1', 'test_host.py::test_h', 'test_board_b.py::test_1', 'test_board_a.py::test_2']
+    result = testdir.runpytest('--board', 'sim:', '--board-order=cost', '-v', *args)
+    # The host test stays in place
+    result.stdout.fnmatch_lines([
+        'board order: 3 module changes and fixture setups, 5 in collection order',
+        'test_board_a.py::test_1 PASSED*',
+        'test_host.py::test_h PASSED*',
+        'test_board_a.py::test_2 PASSED*',
+        'test_board_b.py::test_1 PASSED*',
+    ])
+    assert result.ret == 0
+
+    # Nothing moves past an item with an ordering marker
+    args = ['test_board_a.py::test_1', 'test_board_b.py::test_1', 'test_board_a.py::test_3', 'test_board_a.py::test_2']
+    result = testdir.runpytest('--board', 'sim:', '--board-order=cost', '--collect-only', *args)
+    result.stdout.fnmatch_lines([
+        "*<Module 'test_board_a.py'>",
+        "  <Function 'test_1'>",
+        "*<Module 'test_board_b.py'>",
+        "  <Function 'test_1'>",
+        "*<Module 'test_board_a.py'>",
+        "  <Function 'test_3'>",
+        "  <Function 'test_2'>",
+    ])
@@ -1,4 +1,11 @@
+import contextlib
+import io
+import os
+import pty
 import pytest
+import threading
+import traceback
+import tty
 
 def pytest_addoption(parser):
     group = parser.getgroup('cpboard')
@@ -7,3 +14,78 @@ def pytest_addoption(parser):
 def pytest_cmdline_main(config):
     if config.option.boarddev:
         raise pytest.UsageError('Use --cpboard for these tests, not --board')
+
+
+class FakeBoard:
+    """Minimal CircuitPython REPL behind a pty, just enough for exec() and eval()"""
+    def __init__(self):
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.device = os.ttyname(self.slave)
+        self.globals = {}
+        self.raw = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def execute(self, code):
+        out = io.StringIO()
+        error = ''
+        try:
+            with contextlib.redirect_stdout(out):
+                exec(compile(code, '<stdin>', 'exec'), self.globals)
+        except Exception as e:
+            lines = ['Traceback (most recent call last):']
+            for entry in traceback.extract_tb(e.__traceback__):
+                if entry[0] == '<stdin>':
+                    lines.append('  File "<stdin>", line %d, in %s' % (entry[1], entry[2]))
+            lines.append('%s: %s' % (type(e).__name__, e))
+            error = '\n'.join(lines) + '\n'
+        return out.getvalue().replace('\n', '\r\n').encode(), error.replace('\n', '\r\n').encode()
+
+    def soft_reboot(self):
+        self.globals = {}
+        self.write(b'\r\nsoft reboot\r\n\r\nAuto-reload is off.\r\ncode.py output:\r\n\r\n'
+                   b'\r\nPress any key to enter the REPL. Use CTRL-D to reload.\r\n')
+
+    def run(self):
+        code = b''
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            for c in data:
+                c = bytes([c])
+                if c == b'\x01':
+                    self.raw = True
+                    code = b''
+                    self.write(b'raw REPL; CTRL-B to exit\r\n>')
+                elif c == b'\x02':
+                    self.raw = False
+                    self.write(b'\r\nAdafruit CircuitPython 3.0.0 on 2018-07-09; Fake Board\r\n>>> ')
+                elif c == b'\x03':
+                    code = b''
+                elif c == b'\x04':
+                    if self.raw:
+                        self.write(b'OK')
+                        out, err = self.execute(code.decode())
+                        self.write(out + b'\x04' + err + b'\x04>')
+                        code = b''
+                    else:
+                        self.soft_reboot()
+                elif self.raw:
+                    code += c
+
+    def close(self):
+        os.close(self.slave)
+        os.close(self.master)
+
+
+@pytest.fixture
+def fakeboard():
+    board = FakeBoard()
+    yield board
+    board.close()
@@ -1,5 +1,8 @@
+import collections
 import pytest
 import sys
+import threading
+import time
 import traceback
 sys.path.append('/home/pi')
 import cpboard
@@ -9,7 +12,51 @@ import os.path
 import usb.core
 
 
-def test_new(monkeypatch):
+def _symlink(link, target):
+    link.dirpath().ensure(dir=True)
+    link.mksymlinkto(target, absolute=False)
+
+
+def make_sysroot(root, devices):
+    """Create a fake /sys and /dev tree with USB devices: (port, vid, pid, serial_number, tty, disk)"""
+    for port, vid, pid, serial_number, tty, disk in devices:
+        usbdir = root.join('sys', 'devices', 'pci0000:00', 'usb1', port)
+        usbdir.ensure(dir=True)
+        usbdir.join('idVendor').write('%04x\n' % vid)
+        usbdir.join('idProduct').write('%04x\n' % pid)
+        usbdir.join('serial').write(serial_number + '\n')
+        usbdir.join('product').write('Board %s\n' % port)
+        by_path = 'pci-0000:00:14.0-usb-0:%s' % port.partition('-')[2]
+        if tty:
+            classdir = usbdir.join(port + ':1.0', 'tty', tty)
+            classdir.ensure(dir=True)
+            _symlink(root.join('sys', 'class', 'tty', tty), classdir)
+            root.join('dev', tty).ensure()
+            _symlink(root.join('dev', 'serial', 'by-path', by_path + ':1.0'), root.join('dev', tty))
+        if disk:
+            for name, suffix in ((disk, ''), (disk + '1', '-part1')):
+                classdir = usbdir.join(port + ':1.2', 'host0', 'target0:0:0', '0:0:0:0', 'block', disk)
+                if suffix:
+                    classdir = classdir.join(name)
+                classdir.ensure(dir=True)
+                _symlink(root.join('sys', 'class', 'block', name), classdir)
+                root.join('dev', name).ensure()
+                _symlink(root.join('dev', 'disk', 'by-path', by_path + ':1.2-scsi-0:0:0:0' + suffix), root.join('dev', name))
+
+
+@pytest.fixture
+def sysroot(tmpdir, monkeypatch):
+    make_sysroot(tmpdir, [
+        ('1-1.3', 0x239a, 0x8023, 'ABCDEF0123', 'ttyACM0', 'sda'),
+        ('1-1.4', 0x239a, 0x0021, '9876543210', 'ttyACM1', 'sdb'),
+        ('1-2', 0x1234, 0x5678, 'UNKNOWN', 'ttyUSB0', None),
+    ])
+    registry = cpboard.BoardRegistry.load(root=str(tmpdir))
+    monkeypatch.setattr(cpboard, '_registry', registry)
+    return tmpdir
+
+
+def test_new(monkeypatch, sysroot):
     device = '/dev/tty0'
     board = cpboard.CPboard(device)
     assert board.device == device
@@ -22,32 +69,99 @@ def test_new(monkeypatch):
     with pytest.raises(RuntimeError):
         cpboard.CPboard.from_usb(idVendor=0xdead, idProduct=0xbeef)
 
+    with pytest.raises(RuntimeError):
+        cpboard.CPboard.from_build_name('metro_m4_express')
+
+    device = str(sysroot.join('dev', 'ttyACM0'))
+
+    board = cpboard.CPboard.from_usb(idVendor=0x239a, idProduct=0x8023)
+    assert board.device == device
+    assert board.serial_number == 'ABCDEF0123'
+    assert [os.path.basename(disk) for disk in board.get_disks()] == \
+        ['pci-0000:00:14.0-usb-0:1.3:1.2-scsi-0:0:0:0', 'pci-0000:00:14.0-usb-0:1.3:1.2-scsi-0:0:0:0-part1']
+
+    board = cpboard.CPboard.from_build_name('feather_m0_express')
+    assert board.device == device
+
+    board = cpboard.CPboard.from_try_all('feather_m0_express')
+    assert board.device == device
+
+    board = cpboard.CPboard.from_try_all('239a:8023')
+    assert board.device == device
+
+    board = cpboard.CPboard.from_try_all('ABCDEF0123')
+    assert board.device == device
+
     class Device:
         def __init__(self):
             self.port_numbers = [91, 19]
 
-    def find(*args, **kwargs):
-        return Device()
-
     def listdir(path):
         return ['pre:91.19:post']
 
     def realpath(path):
         return '/dev/tty9119'
 
-    monkeypatch.setattr(usb.core, 'find', find)
     monkeypatch.setattr(os, 'listdir', listdir)
     monkeypatch.setattr(os.path, 'realpath', realpath)
-    device = realpath('')
 
-    board = cpboard.CPboard.from_usb(idVendor=0xabcd, idProduct=0xdcba)
-    assert board.device == device
+    board = cpboard.CPboard(Device())
+    assert board.device == realpath('')
 
-    board = cpboard.CPboard.from_build_name('feather_m0_express')
-    assert board.device == device
 
-    board = cpboard.CPboard.from_try_all('feather_m0_express')
-    assert board.device == device
+def test_registry(sysroot):
+    registry = cpboard._registry
+    assert [dev.port_numbers for dev in registry.devices] == [[1, 3], [1, 4], [2]]
+    assert registry.devices is registry.devices
+
+    devs = registry.find_build_name('metro_m4_express', bootloader=True)
+    assert len(devs) == 1
+    assert devs[0].serial_number == '9876543210'
+    assert len(devs[0].ttys) == 1
+    assert len(devs[0].disks) == 2
+
+    assert registry.find_build_name('metro_m4_express') == []
+    assert registry.find(serial_number='UNKNOWN')[0].idVendor == 0x1234
+    assert registry.lookup(registry.devices[0]) == ('feather_m0_express', False)
+    assert registry.lookup(registry.devices[2]) == (None, False)
+
+    board = cpboard.CPboard.from_build_name_bootloader('metro_m4_express')
+    assert board.bootloader
+
+    registry.update({'my_board': {'usb': ['1234:5678']}})
+    assert registry.find_build_name('my_board')[0].serial_number == 'UNKNOWN'
+
+
+def test_registry_threads(sysroot):
+    # flash_fleet() refreshes from the worker threads via _in_bootloader()
+    class Registry(cpboard.BoardRegistry):
+        def __setattr__(self, name, value):
+            super().__setattr__(name, value)
+            if name == '_devices' and value is not None:
+                # Another thread refreshes right after enumerating
+                thread = threading.Thread(target=self.refresh)
+                thread.start()
+                thread.join(0.2)
+                threads.append(thread)
+
+    threads = []
+    registry = Registry.load(root=str(sysroot))
+    assert len(registry.find(serial_number='9876543210')) == 1
+    for thread in threads:
+        thread.join()
+    assert len(threads) == 1
+    assert registry._devices is None
+
+
+def test_list_json(sysroot, monkeypatch, capsys):
+    import json
+    monkeypatch.setattr(sys, 'argv', ['cpboard', 'list', '--json'])
+    cpboard.main()
+    boards = json.loads(capsys.readouterr().out)
+    assert [board['build_name'] for board in boards] == ['feather_m0_express', 'metro_m4_express', None]
+    assert boards[0]['usb'] == '239a:8023'
+    assert boards[0]['ttys'] == [str(sysroot.join('dev', 'ttyACM0'))]
+    assert boards[1]['bootloader']
 
 
 test_parse_traceback_data = [
@@ -102,3 +216,320 @@ def test_create_traceback(exc_str, lineno, check):
     assert line in tb_str
     assert check in tb_str
     #print(tb_str); assert 0
+
+
+class FakeREPL:
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.written = []
+        self.session = b''
+        self.code = None
+
+    def reset(self):
+        pass
+
+    def execute(self, code, timeout=10, async=False, out=None):
+        self.code = code
+        return b'', b''
+
+    def write(self, data, chunk_size=None):
+        self.written.append(data)
+
+    def read_until(self, ending, timeout=10, out=None):
+        return self.reads.pop(0)
+
+    def result(self, timeout=10, out=None):
+        output = self.read_until(b'\x04')[:-1]
+        error = self.read_until(b'\x04')[:-1]
+        return output, error
+
+
+def _generator_func(n):
+    for i in range(n):
+        yield i * i
+
+
+def test_exec_generator():
+    repl = FakeREPL([b'BEGINMARKER>0<ENDMARKER', b'\r\nBEGINMARKER>1<ENDMARKER', b'\r\n\x04', b'\x04'])
+    gen = cpboard.ExecGenerator(repl, _generator_func)(2)
+    assert 'gen = _generator_func(2)' in repl.code
+    assert list(gen) == [0, 1]
+    assert repl.written == ['n', 'n']
+    gen.close()
+    assert repl.written == ['n', 'n']
+
+
+def test_exec_generator_close():
+    repl = FakeREPL([b'BEGINMARKER>0<ENDMARKER', b'\r\nBEGINMARKER>1<ENDMARKER\r\n\x04', b'\x04'])
+    with cpboard.ExecGenerator(repl, _generator_func)(1000) as gen:
+        assert next(gen) == 0
+    assert repl.written == ['q']
+    with pytest.raises(StopIteration):
+        next(gen)
+
+
+def test_exec_generator_raises():
+    error = b'Traceback (most recent call last):\r\n  File "<stdin>", line 8, in <module>\r\nValueError: Oh no\r\n'
+    repl = FakeREPL([b'\x04', error + b'\x04'])
+    gen = cpboard.ExecGenerator(repl, _generator_func)(1)
+    with pytest.raises(ValueError) as excinfo:
+        next(gen)
+    assert 'Oh no' in str(excinfo.value)
+
+
+def locked_elsewhere(lock):
+    """Return True if another thread can't take lock"""
+    res = []
+
+    def take():
+        res.append(lock.acquire(blocking=False))
+        if res[0]:
+            lock.release()
+
+    thread = threading.Thread(target=take)
+    thread.start()
+    thread.join()
+    return not res[0]
+
+
+def test_exec_generator_lock():
+    lock = threading.RLock()
+    repl = FakeREPL([b'BEGINMARKER>0<ENDMARKER', b'\r\nBEGINMARKER>1<ENDMARKER\r\n\x04', b'\x04'])
+    with cpboard.ExecGenerator(repl, _generator_func, lock=lock)(1000) as gen:
+        assert next(gen) == 0
+        assert locked_elsewhere(lock)
+    assert not locked_elsewhere(lock)
+
+    error = b'Traceback (most recent call last):\r\n  File "<stdin>", line 8, in <module>\r\nValueError: Oh no\r\n'
+    repl = FakeREPL([b'\x04', error + b'\x04'])
+    gen = cpboard.ExecGenerator(repl, _generator_func, lock=lock)(1)
+    with pytest.raises(ValueError):
+        next(gen)
+    assert not locked_elsewhere(lock)
+
+
+def test_submit():
+    board = cpboard.CPboard('/dev/tty0')
+    order = []
+
+    def func(a, b=0):
+        assert locked_elsewhere(board.lock)
+        order.append(a)
+        return a + b
+
+    futures = [board.submit(func, i, b=1) for i in range(10)]
+    assert [future.result() for future in futures] == list(range(1, 11))
+    assert order == list(range(10))
+    assert not locked_elsewhere(board.lock)
+
+    # close() stops the worker, a new one is started when needed
+    futures = [board.submit(func, i) for i in range(3)] + [board.submit(board.close)]
+    assert [future.result() for future in futures] == [0, 1, 2, None]
+    assert board.submit(func, 5).result() == 5
+    board.close()
+
+
+def test_submit_generator():
+    board = cpboard.CPboard('/dev/tty0')
+    board.repl = FakeREPL([b'BEGINMARKER>0<ENDMARKER', b'\r\nBEGINMARKER>1<ENDMARKER', b'\r\n\x04', b'\x04'])
+
+    @cpboard.remote
+    def squares(n):
+        for i in range(n):
+            yield i * i
+
+    # Iterated on the worker thread which starts and releases the stream
+    assert squares.submit(board, 2).result(timeout=5) == [0, 1]
+    assert not locked_elsewhere(board.lock)
+    assert board.lock.acquire(blocking=False)
+    board.lock.release()
+    board.close()
+
+
+def test_wait_for():
+    values = [0, None, 7]
+    assert cpboard.wait_for(lambda: values.pop(0), 5) == 7
+
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        cpboard.wait_for(lambda: False, 0.2, 'never')
+    assert 0.2 <= time.monotonic() - start < 1
+
+
+def test_wait_ready(tmpdir, fakeboard):
+    link = tmpdir.join('ttyFAKE')
+    board = cpboard.CPboard(str(link))
+    timer = threading.Timer(0.3, lambda: link.mksymlinkto(fakeboard.device))
+    timer.start()
+    elapsed = board.wait_ready(timeout=5)
+    assert 0.3 <= elapsed < 3
+    assert board.eval('1 + 1', reset_repl=False) == 2
+    board.close()
+
+    link.remove()
+    assert board.wait_gone(1)
+    with pytest.raises(TimeoutError):
+        board.wait_ready(timeout=0.2)
+
+
+def make_uf2(payload, tags=None, chunk_size=256):
+    import struct
+    blocks = []
+    numblocks = (len(payload) + chunk_size - 1) // chunk_size
+    for blockno in range(numblocks):
+        data = payload[blockno * chunk_size:(blockno + 1) * chunk_size]
+        flags = 0
+        extra = b''
+        if tags and blockno == 0:
+            flags |= cpboard.UF2File.FLAG_EXTENSION_TAGS
+            for tag, value in tags.items():
+                value = value.encode()
+                tag_data = struct.pack('<I', (len(value) + 4) | tag << 8) + value
+                extra += tag_data + b'\0' * (-len(tag_data) % 4)
+        header = struct.pack('<8I', 0x0A324655, 0x9E5D5157, flags, 0x2000 + blockno * chunk_size, len(data),
+                             blockno, numblocks, 0)
+        body = data + b'\0' * (-len(data) % 4) + extra
+        blocks.append(header + body + b'\0' * (476 - len(body)) + struct.pack('<I', 0x0AB16F30))
+    return b''.join(blocks)
+
+
+def test_uf2file(tmpdir):
+    version = b'3.0.0 on 2018-07-09'
+    machine = b'Adafruit Feather M0 Express with samd21g18'
+    payload = b'\xff' * 300 + version + b'\0' + machine + b'\0' * 200
+    fw = tmpdir.join('firmware.uf2')
+    fw.write_binary(make_uf2(payload))
+
+    uf2 = cpboard.UF2File(str(fw))
+    assert uf2.payload.startswith(payload)
+    assert uf2.version is None
+    Uname = collections.namedtuple('uname', ['sysname', 'nodename', 'release', 'version', 'machine'])
+    assert uf2.is_current(Uname('samd21', 'samd21', '3.0.0', version.decode(), machine.decode()))
+    assert not uf2.is_current(Uname('samd21', 'samd21', '3.0.1', '3.0.1 on 2018-08-01', machine.decode()))
+    assert not uf2.is_current(Uname('samd21', 'samd21', '3.0.0', version.decode(), 'Adafruit Metro M0 Express with samd21g18'))
+
+    fw.write_binary(make_uf2(payload, tags={cpboard.UF2File.TAG_VERSION: '3.0.1', cpboard.UF2File.TAG_DEVICE: 'SAMD21G18A-Feather-v0'}))
+    uf2 = cpboard.UF2File(str(fw))
+    assert uf2.version == '3.0.1'
+    assert uf2.board_id == 'SAMD21G18A-Feather-v0'
+
+    fw.write_binary(b'UF2\n' + b'\0' * 1000)
+    with pytest.raises(ValueError):
+        cpboard.UF2File(str(fw))
+
+
+def test_flash_board_current(tmpdir, fakeboard):
+    # The fake board runs os.uname() on the host
+    uname = os.uname()
+    fw = tmpdir.join('firmware.uf2')
+    fw.write_binary(make_uf2(b'\0' * 100 + uname.version.encode() + b'\0' + uname.machine.encode()))
+
+    results = cpboard.flash_fleet([cpboard.CPboard(fakeboard.device)], str(fw))
+    assert len(results) == 1
+    assert results[0]['status'] == 'current'
+    assert results[0]['old'] == uname.version
+    assert list(results[0]['times']) == ['check', 'total']
+
+    # Fails since the fake board has no microcontroller module
+    fw.write_binary(make_uf2(b'\0' * 100))
+    res = cpboard.flash_board(cpboard.CPboard(fakeboard.device), cpboard.UF2File(str(fw)), timeout=1)
+    assert res['status'] == 'failed'
+    assert 'microcontroller' in res['error']
+
+
+def test_firmware_board_id(tmpdir):
+    class FakeDisk:
+        path = str(tmpdir.join('drive'))
+        copied = []
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def copy(self, src, dst=None, sync=True):
+            self.copied.append(os.path.basename(src))
+
+    class FakeBoard:
+        def close(self):
+            pass
+
+    class FakeFirmware(cpboard.Firmware):
+        disk = FakeDisk()
+
+    drive = tmpdir.join('drive')
+    drive.join('INFO_UF2.TXT').write('UF2 Bootloader v1.23.0\nModel: Metro M0\nBoard-ID: SAMD21G18A-Metro-v0\n', ensure=True)
+    drive.join('CURRENT.UF2').write_binary(make_uf2(b'\0' * 100))
+    fw = tmpdir.join('firmware.uf2')
+    fw.write_binary(make_uf2(b'\1' * 100))
+
+    # The board isn't left in the bootloader on a mismatch
+    firmware = FakeFirmware(FakeBoard())
+    with pytest.raises(ValueError) as excinfo:
+        firmware.flash(str(fw), board_id='SAMD21G18A-Feather-v0')
+    assert 'SAMD21G18A-Metro-v0' in str(excinfo.value)
+    assert FakeDisk.copied == ['CURRENT.UF2']
+
+    del FakeDisk.copied[:]
+    info = firmware.flash(str(fw), board_id='SAMD21G18A-Metro-v0')
+    assert info['Board-ID'] == 'SAMD21G18A-Metro-v0'
+    assert FakeDisk.copied == ['firmware.uf2']
+
+
+def test_percentiles():
+    res = cpboard.percentiles([float(i) for i in range(100, 0, -1)])
+    assert res['n'] == 100
+    assert (res['min'], res['p50'], res['p90'], res['p99'], res['max']) == (1, 50, 90, 99, 100)
+    assert res['mean'] == 50.5
+    assert cpboard.percentiles([3.0])['p99'] == 3.0
+
+
+def test_bench(tmpdir, fakeboard):
+    with cpboard.CPboard(fakeboard.device) as board:
+        results = cpboard.bench(board, repeat=3, copy_repeat=1, copy_sizes=(1, 4), path=str(tmpdir.join('bench.bin')))
+    assert list(results) == ['exec_empty', 'eval_str_16', 'eval_str_256', 'eval_str_1024', 'eval_str_4096',
+                             'eval_list_16', 'eval_list_256', 'copy_1k', 'copy_4k',
+                             'remote_call', 'soft_reset']
+    for name, res in results.items():
+        assert 'error' not in res, name
+    assert results['exec_empty']['n'] == 3
+    assert results['copy_4k']['bytes'] == 4 * 1024
+    assert not tmpdir.join('bench.bin').check()
+
+
+def test_trace(tmpdir, fakeboard):
+    assert cpboard.trace('exec') is cpboard.trace('eval')  # Shared no-op span when off
+
+    tracer = cpboard.Tracer()
+    cpboard.set_tracer(tracer)
+    try:
+        with cpboard.CPboard(fakeboard.device) as board:
+            assert board.eval('1 + 1', reset_repl=False) == 2
+            with pytest.raises(ZeroDivisionError):
+                board.exec('1 / 0', reset_repl=False)
+            with pytest.raises(cpboard.CPboardError):
+                board.repl.read_until(b'never', timeout=0.1)
+    finally:
+        cpboard.set_tracer(None)
+
+    names = [event['name'] for event in tracer.events]
+    assert names.count('execute') == 2
+    assert 'eval' in names and 'write' in names and 'read_until' in names
+    for event in tracer.events:
+        assert event['ph'] == 'X' and event['dur'] >= 0
+    eval_span = [event for event in tracer.events if event['name'] == 'eval'][0]
+    assert eval_span['args']['expression'] == '1 + 1'
+    assert [event['args'] for event in tracer.events if 'error' in event['args']] == [
+        {'ending': "b'never'", 'error': 'CPboardError'}]
+
+    summary = tracer.summary()
+    assert summary['round_trips'] == 2
+    assert summary['bytes_written'] >= len('print(1 + 1, end="")') + len('1 / 0')
+    assert summary['bytes_read'] > 0
+    assert 0 < summary['blocked'] < 10
+
+    path = tmpdir.join('trace.json')
+    tracer.save(str(path))
+    import json
+    assert len(json.loads(path.read())['traceEvents']) == len(tracer.events)
@@ -0,0 +1,76 @@
+import pytest
+import threading
+import cpboard
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    daemon = cpboard.BoardDaemon(str(tmpdir.join('cpboard.sock')), open_timeout=0.5, busy_timeout=0.5)
+    daemon.start()
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    thread.join()
+
+
+def test_daemon(daemon, fakeboard):
+    board = cpboard.DaemonBoard(fakeboard.device, path=daemon.path)
+    with board:
+        assert board.device == fakeboard.device
+        board.repl.reset()
+        board.exec('a = 5')
+        assert board.eval('a + 2', reset_repl=False) == 7
+        with pytest.raises(NameError):
+            board.exec('not_defined')
+
+    # The board stays open and keeps its state between connections
+    served = daemon.boards[fakeboard.device]
+    assert served.board.serial
+    with cpboard.DaemonBoard(fakeboard.device, path=daemon.path) as board:
+        assert board.eval('a') == 5
+
+
+def test_daemon_state(daemon, fakeboard):
+    client = cpboard.DaemonClient(daemon.path)
+    assert client.state(fakeboard.device) == {'files': {}, 'modules': {}}
+
+    client.update(fakeboard.device, files={'/a.py': '1', '/b.py': '2'}, modules={'a': '1'})
+    client.update(fakeboard.device, files={'/b.py': None})
+    assert client.state(fakeboard.device) == {'files': {'/a.py': '1'}, 'modules': {'a': '1'}}
+
+    assert client.request(op='list') == {'boards': {fakeboard.device: fakeboard.device}}
+
+    # Soft reboot clears the imported modules
+    with cpboard.DaemonBoard(fakeboard.device, path=daemon.path) as board:
+        board.repl.reset()
+        board.repl.write(cpboard.REPL.CHAR_CTRL_D)
+        board.repl.read_until(b'soft reboot\r\n')
+    assert client.state(fakeboard.device) == {'files': {'/a.py': '1'}, 'modules': {}}
+
+    with pytest.raises(cpboard.CPboardError):
+        client.request(op='nonexistent')
+
+
+def test_daemon_not_running(tmpdir):
+    board = cpboard.DaemonBoard('feather_m0_express', path=str(tmpdir.join('nonexistent.sock')))
+    with pytest.raises(cpboard.CPboardError):
+        board.open()
+
+
+def test_daemon_errors(daemon, fakeboard):
+    # A second connection gets an error while the board stays in use
+    with cpboard.DaemonBoard(fakeboard.device, path=daemon.path) as board:
+        assert board.eval('1 + 1') == 2
+        with pytest.raises(cpboard.CPboardError) as excinfo:
+            cpboard.DaemonBoard(fakeboard.device, path=daemon.path).open()
+        assert 'board is busy' in str(excinfo.value)
+    # Reconnecting right away waits for the pipe to notice the close
+    for _ in range(5):
+        with cpboard.DaemonBoard(fakeboard.device, path=daemon.path) as board:
+            assert board.eval('1 + 1') == 2
+
+    with pytest.raises(cpboard.CPboardError) as excinfo:
+        cpboard.DaemonBoard('/dev/nonexistent_board', path=daemon.path).open()
+    assert 'closed' not in str(excinfo.value)
+    assert 'nonexistent_board' in str(excinfo.value)
@@ -117,6 +117,14 @@ def test_args(board, args, kwargs):
     res = board_test_args(board, *args, **kwargs)
     assert obj == res
 
+def test_submit(board):
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(board_test_args, board, i, a=i) for i in range(8)]
+        futures += [board_test_args.submit(board, i, a=i) for i in range(8)]
+    res = [future.result() for future in futures]
+    assert res == [((i,), {'a' : i}) for i in range(8)] * 2
+
 
 @cpboard.remote
 def board_test_exception_missing_argument(arg):
@@ -279,3 +287,20 @@ def test_server_raises(board, stop):
 
 
 # test unicode
+
+
+@cpboard.remote
+def board_test_generator(n):
+    for i in range(n):
+        yield i * i
+
+def test_generator(board):
+    res = list(board_test_generator(board, 5, _out=sys.stdout))
+    assert res == [0, 1, 4, 9, 16]
+
+def test_generator_close(board):
+    gen = board_test_generator(board, 100000)
+    assert next(gen) == 0
+    assert next(gen) == 1
+    gen.close()
+    assert board.eval('1 + 1', reset_repl=False) == 2
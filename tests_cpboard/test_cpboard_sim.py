@@ -0,0 +1,193 @@
+import os
+import pytest
+import struct
+import sys
+import time
+sys.path.append('/home/pi')
+import cpboard
+
+
+@pytest.fixture(scope='module')
+def board():
+    with cpboard.CPboard.from_try_all('sim:test') as board:
+        board.repl.reset()
+        yield board
+
+
+def sim_root(name):
+    link = cpboard.simulate(name)
+    return os.path.join(os.path.dirname(link), 'root')
+
+
+def test_parse_sim():
+    assert cpboard.parse_sim('sim:') == {}
+    assert cpboard.parse_sim('sim:a:latency=0.01:bandwidth=11520:root=/tmp/x:pins=D0,LED') == {
+        'latency': 0.01, 'bandwidth': 11520.0, 'root': '/tmp/x', 'pins': ('D0', 'LED')}
+    with pytest.raises(ValueError):
+        cpboard.parse_sim('sim::speed=1')
+
+
+def test_sim_exec(board):
+    assert board.eval('1 + 1') == 2
+    board.exec('a = 5')
+    assert board.eval('a + 2', reset_repl=False) == 7
+    with pytest.raises(ZeroDivisionError):
+        board.exec('def f():\n    1 / 0\nf()')
+    with pytest.raises(ImportError):
+        board.exec('import socket')
+    assert cpboard.os_uname(board).sysname == 'sim'
+    free, alloc = board.eval('(__import__("gc").mem_free(), __import__("gc").mem_alloc())')
+    # Estimated, each call allocates a bit
+    assert 0 < alloc < free and abs(free + alloc - 1024 * 1024) < 100000
+
+
+def test_sim_filesystem(board, tmpdir):
+    root = sim_root('sim:test')
+    src = tmpdir.join('mod_sim.py')
+    src.write('def double(x):\n    return 2 * x\n')
+    disk = cpboard.ReplDisk(board)
+    disk.makedirs('/tmp.sim', exist_ok=True)
+    assert disk.copy(str(src), '/tmp.sim/mod_sim.py')
+    assert open(os.path.join(root, 'tmp.sim', 'mod_sim.py')).read() == src.read()
+    assert disk.stat('/tmp.sim/mod_sim.py').st_size == src.size()
+
+    board.exec('import os\nos.chdir("/tmp.sim")\nimport mod_sim')
+    assert board.eval('mod_sim.double(21)', reset_repl=False) == 42
+    assert board.eval('sorted(os.listdir("/"))', reset_repl=False) == ['lib', 'tmp.sim']
+    # The root can't be escaped
+    assert board.eval('sorted(os.listdir("/../.."))', reset_repl=False) == ['lib', 'tmp.sim']
+    with pytest.raises(OSError) as excinfo:
+        board.exec('os.stat("/nothere")', reset_repl=False)
+    assert root not in str(excinfo.value)
+
+    # io.open() is confined the same way
+    board.exec('import io\nwith io.open("/../../io.txt", "w") as f:\n    f.write("io")', reset_repl=False)
+    assert open(os.path.join(root, 'io.txt')).read() == 'io'
+    assert board.eval('io.open("/io.txt").read() == "io"', reset_repl=False)
+    board.exec('os.remove("/io.txt")', reset_repl=False)
+    with pytest.raises(AttributeError):
+        board.exec('io.FileIO', reset_repl=False)
+
+
+def test_sim_board_pins(board):
+    board.exec('import board')
+    assert board.eval('repr(board.D0) == "board.D0"', reset_repl=False)
+    assert board.eval('board.LED is board.LED', reset_repl=False)
+    assert 'NEOPIXEL' in board.eval('dir(board)', reset_repl=False)
+
+    with cpboard.CPboard.from_try_all('sim:pins:pins=D5,SDA') as board:
+        board.exec('import board')
+        assert board.eval('[name for name in dir(board) if not name.startswith("_")]', reset_repl=False) == [
+            'D5', 'SDA']
+
+
+def test_sim_friendly_repl(board):
+    repl = board.repl
+    repl.reset()
+    repl.write(b'x = 3\r')
+    repl.read_until(b'>>> ')
+    repl.write(b'x * 2\r')
+    assert repl.read_until(b'>>> ').endswith(b'x * 2\r\n6\r\n>>> ')
+    repl.write(b'for i in range(2):\r')
+    assert repl.read_until(b'... ').endswith(b'range(2):\r\n... ')
+    repl.write(b'    print(i)\r\r')
+    assert repl.read_until(b'>>> ').endswith(b'0\r\n1\r\n>>> ')
+    repl.write(b'1 / 0\r')
+    assert b'ZeroDivisionError: division by zero\r\n>>> ' in repl.read_until(b'>>> ')
+
+
+def test_sim_raw_paste(board):
+    repl = board.repl
+    repl.reset()
+    repl.write(b'\x01')
+    repl.read_until(b'\r\n>')
+    repl.write(b'\x05A\x01')
+    assert repl.read_until(b'R\x01').endswith(b'>R\x01')
+    window = struct.unpack('<H', board.serial.read(2))[0]
+    code = b'print("x" * 10)\n' * 20
+    sent = 0
+    while sent < len(code):
+        if sent and not sent % window:
+            assert board.serial.read(1) == b'\x01'
+        repl.write(code[sent:sent + window])
+        sent += window
+    repl.write(b'\x04')
+    repl.read_until(b'\x04')
+    output, error = repl.result()
+    assert output == b'xxxxxxxxxx\r\n' * 20 and error == b''
+
+
+@cpboard.remote
+def squares(n):
+    for i in range(n):
+        yield i * i
+
+
+def test_sim_interrupt(board):
+    board.exec('while True:\n    pass', async=True)
+    time.sleep(0.2)
+    board.repl.reset()
+    assert board.eval('2 + 2', reset_repl=False) == 4
+
+    with squares(board, 1000) as values:
+        assert [next(values) for _ in range(3)] == [0, 1, 4]
+    assert board.eval('3', reset_repl=False) == 3
+
+
+def test_sim_soft_reboot(board, tmpdir):
+    code = tmpdir.join('code.py')
+    code.write('print("hello from code.py")\n')
+    cpboard.ReplDisk(board).copy(str(code), '/code.py')
+    board.exec('b = 1')
+    reboots = board.repl.reboots
+    assert board.repl.run() == b'hello from code.py\r\n'
+    assert board.repl.reboots == reboots + 1
+    with pytest.raises(NameError):
+        board.exec('b')
+    board.exec('import os\nos.remove("/code.py")')
+
+
+def test_sim_reset_safe_mode():
+    with cpboard.CPboard.from_try_all('sim:reset') as board:
+        board.exec('a = 1')
+        assert 0.4 < board.reset(safe_mode=True, timeout=10) < 10
+        board.repl.write(b'\x04')
+        data = board.repl.read_until(cpboard.MSG_WAIT_BEFORE_REPL)
+        assert b'Running in safe mode' in data
+
+        board.reset(timeout=10)
+        board.repl.reset()
+        board.repl.write(b'\x04')
+        assert b'Running in safe mode' not in board.repl.read_until(cpboard.MSG_WAIT_BEFORE_REPL)
+        with pytest.raises(NameError):
+            board.exec('a')
+
+
+def test_sim_latency_bandwidth():
+    with cpboard.CPboard.from_try_all('sim:slow:latency=0.05:bandwidth=4000') as board:
+        board.eval('1')
+        start = time.monotonic()
+        assert board.eval("repr('a' * 2000)") == 'a' * 2000
+        # Half a second for the bytes alone
+        assert time.monotonic() - start > 0.5
+
+
+def test_sim_recover():
+    with cpboard.CPboard.from_try_all('sim:recover') as board:
+        board.exec('a = 1')
+        reboots = board.repl.reboots
+        board.exec('while True:\n    pass', async=True)
+        assert board.recover(timeout=10) == ['interrupt']
+        assert board.eval('a', reset_repl=False) == 1
+        assert board.repl.reboots == reboots
+
+        # A crash into safe mode takes the tty away
+        with pytest.raises(cpboard.CPboardError):
+            board.exec('import microcontroller\nmicrocontroller.on_next_reset(microcontroller.RunMode.SAFE_MODE)\n'
+                       'microcontroller.reset()', timeout=2)
+        assert board.recover(timeout=20) == ['interrupt', 'reopen', 'soft reboot', 'hard reset']
+        assert not board.repl.safe_mode and board.repl.reboots > reboots
+        with pytest.raises(NameError):
+            board.exec('a')
+        # No code file
+        assert board.repl.run() == b''